@@ -0,0 +1,121 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# asyncio front-end for the DS8R, the D188 and the serial trigger board
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from API.trigger_protocol import STATUS_OK, STATUS_NAMES
+
+# ------------------------------------------------------------------------------
+# Declare asyncio classes
+class AsyncDevice:
+    '''
+    Runs the blocking calls of one device on a dedicated single-thread executor, so that calls to the
+    same device stay in order while calls to different devices overlap.
+    Every method of the wrapped object is available as a coroutine function:
+        await ds8r.Configure(demand=2)
+    completes once the blocking DLL call returned, i.e. when the device acknowledged the update.
+    '''
+    def __init__(self, name, device):
+        self.name = name
+        self.device = device
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    async def Call(self, method, *args, **kwargs):
+        '''
+        Run device.method(*args, **kwargs) on the executor of the device and return its result.
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(getattr(self.device, method), *args, **kwargs))
+
+    def __getattr__(self, attr):
+        if attr.startswith('_') or attr == 'device' or not callable(getattr(self.device, attr)):
+            raise AttributeError(f'{attr} is not a method of {self.name}')
+        async def call(*args, **kwargs):
+            return await self.Call(attr, *args, **kwargs)
+        call.__name__ = attr
+        return call
+
+    def Shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class AsyncDS8R(AsyncDevice):
+    '''
+    asyncio DS8R. Defaults to the stimulator of the process-wide hardware session.
+    '''
+    def __init__(self, stimulator=None):
+        if stimulator is None:
+            from API.session import get_session
+            stimulator = get_session().stimulator
+        super().__init__('DS8R', stimulator)
+
+
+class AsyncD188(AsyncDevice):
+    '''
+    asyncio D188. Defaults to the selector of the process-wide hardware session.
+    '''
+    def __init__(self, selector=None):
+        if selector is None:
+            from API.session import get_session
+            selector = get_session().selector
+        super().__init__('D188', selector)
+
+
+class AsyncTrigger(AsyncDevice):
+    '''
+    asyncio access to the trigger microcontroller through a TriggerLink (API/trigger_protocol.py).
+    Commands are sent on the dedicated executor of the link; waiting for a completion does not hold that
+    executor, so e.g. Stop can be sent while a train is running.
+    '''
+    def __init__(self, link):
+        super().__init__('uC', link)
+
+    async def Run(self, method, *args, timeout=None):
+        '''
+        Send a command of the link, wait for its acknowledgement then for its completion frame.
+        Returns:
+            Pending: replies of the command
+        Raises:
+            RuntimeError: the board rejected the command (bad CRC, unknown opcode, busy, ...)
+            TimeoutError: no acknowledgement, or no completion within timeout [s]
+        '''
+        pending = await self.Call(method, *args, wait='ack')
+        if not pending.ack.is_set():
+            raise TimeoutError(f'No acknowledgement from the trigger board for {method}{args}')
+        if pending.status != STATUS_OK:
+            raise RuntimeError(f'Trigger board rejected {method}{args}: {STATUS_NAMES.get(pending.status, pending.status)}')
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, pending.done.wait, timeout):
+            raise TimeoutError(f'No completion from the trigger board for {method}{args} within {timeout} s')
+        return pending
+
+    async def TriggerD(self, freq, duration):
+        '''
+        Trigger at freq [Hz] during duration [ms] and return once the train is over.
+        '''
+        return await self.Run('TriggerD', freq, duration, timeout=duration * 1e-3 + 1.0)
+
+    async def TriggerN(self, freq, numTriggers):
+        '''
+        Send numTriggers triggers at freq [Hz] and return once the train is over.
+        '''
+        return await self.Run('TriggerN', freq, numTriggers, timeout=numTriggers / freq + 1.0)
+
+
+if __name__ == "__main__":
+    async def main():
+        ds8r = AsyncDS8R()
+        d188 = AsyncD188()
+        await asyncio.gather(ds8r.Open(), d188.Open())
+        # Channel switch and parameter upload overlap
+        await asyncio.gather(
+            d188.Configure(mode='USB', indicator='ON', delay=1, channel=2),
+            ds8r.Configure(mode='Bi-phasic', polarity='Negative', demand=2, pulsewidth=50, enable=True)
+        )
+        await ds8r.Enable(False)
+        await asyncio.gather(ds8r.Close(), d188.Close())
+        ds8r.Shutdown()
+        d188.Shutdown()
+
+    asyncio.run(main())
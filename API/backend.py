@@ -0,0 +1,123 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Device backends: lazily loaded Digitimer DLLs or in-process simulators
+import os
+import threading
+
+# ------------------------------------------------------------------------------
+# Error codes returned by the DLLs (see the DS8R programmers reference, shared by the D188 API)
+ERROR_SUCCESS = 0
+ERROR_BAD_ARGUMENTS = 160
+ERROR_NOT_INITIALISED = 100002
+ERROR_PROCESS_TERMINATED = 100003
+ERROR_UNEXPECTED_TERMINATION = 100004
+ERROR_DEVICE_NOT_FOUND = 100018
+ERROR_INVALID_PARAMETER = 100019
+ERROR_INVALID_STRUCTURE = 100020
+ERROR_DGHOST_STARTUP_TIMEOUT = 100026
+ERROR_PIPE_WRITE_TIMEOUT = 100029
+ERROR_PIPE_READ_TIMEOUT = 100030
+ERROR_PIPE_READ_NULL = 100031
+
+# ------------------------------------------------------------------------------
+# Declare backend classes
+class DLLBackend:
+    '''
+    Binding to one of the Digitimer DLLs (D128API.DLL or DGD188API.DLL).
+    The DLL is only loaded, and the WINFUNCTYPE prototypes only bound, on the first call so that the
+    controllers can be imported on any platform and without paying the load cost at import time.
+    Initialise, Update and Close take the same arguments as the DLL functions.
+    '''
+    def __init__(self, dll_name, prefix):
+        self.dll_name = dll_name        # e.g. "D128API.DLL"
+        self.prefix = prefix            # e.g. "DGD128"
+        self.lock = threading.Lock()
+        self.functions = None
+
+    def Load(self):
+        '''
+        Load the DLL and bind the API functions if not already done.
+        '''
+        with self.lock:
+            if self.functions is not None:
+                return self.functions
+            from ctypes import c_int, c_void_p, WINFUNCTYPE, WinDLL       # Only available on windows
+
+            hApi = WinDLL(self.dll_name)
+
+            protoInitialise = WINFUNCTYPE (
+                c_int,       #Function result
+                c_void_p,    #Instance Reference
+                c_void_p,    #Initialise Result
+                c_int,       #Callback pointer (not used MUST be 0)
+                c_int        #Callback parameters (not used MUST be 0)
+                )
+
+            protoUpdate = WINFUNCTYPE (
+                c_int,       #Function result
+                c_int,       #Instance Reference
+                c_void_p,    #Update Result
+                c_void_p,    #NewState
+                c_int,       #cbNewState
+                c_void_p,    #CurrentState
+                c_void_p,    #cbCurrentState
+                c_int,       #Callback pointer (not used MUST be 0)
+                c_int        #Callback parameters (not used MUST be 0)
+                )
+
+            protoClose = WINFUNCTYPE (
+                c_int,       #Function result
+                c_void_p,    #Instance Reference
+                c_void_p,    #Close Result
+                c_int,       #Callback pointer (not used MUST be 0)
+                c_int        #Callback parameters (not used MUST be 0)
+                )
+
+            paramsInitialise = (1,"Reference",0),(1,"InitResult",0),(1,"CallbackProc",0),(1,"CallbackParam",0),
+            paramsUpdate =  (1,"Reference",0),(1,"updateResult",0),(1,"NewState",0),(1,"cbNewState",0),(1,"CurrentState",0),(1,"cbCurrentState",0),(1,"CallbackProc",0),(1,"CallbackParam",0),
+            paramsClose =  (1,"Reference",0),(1,"CloseResult",0),(1,"CallbackProc",0),(1,"CallbackParam",0),
+
+            self.functions = (
+                protoInitialise((self.prefix + "_Initialise", hApi), paramsInitialise),
+                protoUpdate((self.prefix + "_Update", hApi), paramsUpdate),
+                protoClose((self.prefix + "_Close", hApi), paramsClose),
+            )
+            return self.functions
+
+    def Initialise(self, *args):
+        return self.Load()[0](*args)
+
+    def Update(self, *args):
+        return self.Load()[1](*args)
+
+    def Close(self, *args):
+        return self.Load()[2](*args)
+
+
+DEVICES = {
+    'DS8R': ("D128API.DLL", "DGD128"),
+    'D188': ("DGD188API.DLL", "DGD188"),
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def get_backend(device, kind=None):
+    '''
+    Return the backend shared by all the controllers of a device type.
+    Args:
+        device (string): 'DS8R' or 'D188'
+        kind (string): 'dll' for the Digitimer DLL or 'sim' for the in-process simulator.
+                       Defaults to the TTENS_BACKEND environment variable, then 'dll'.
+    '''
+    kind = (kind or os.environ.get('TTENS_BACKEND', 'dll')).lower()
+    with _backends_lock:
+        if (device, kind) not in _backends:
+            if kind == 'dll':
+                _backends[(device, kind)] = DLLBackend(*DEVICES[device])
+            elif kind == 'sim':
+                from API.simulator import SimulatedDS8R, SimulatedD188
+                _backends[(device, kind)] = {'DS8R': SimulatedDS8R, 'D188': SimulatedD188}[device]()
+            else:
+                raise ValueError(f'Unknown backend: {kind}')
+        return _backends[(device, kind)]
@@ -1,10 +1,11 @@
 # Author: Mohamed Habib Ben Abda
 # Date: Fall semester 2024
 # API for D188 Digitimer Electrode Selector
-from ctypes import Structure, c_ubyte, c_ushort, c_int, WINFUNCTYPE, c_void_p, byref, WinDLL #, sizeof, cast
-from sys import getsizeof
-
-hDGD188Api = WinDLL("DGD188API.DLL")
+from ctypes import Structure, c_ubyte, c_ushort, c_int, byref, sizeof, memmove, addressof
+from time import perf_counter
+from functools import lru_cache
+from API.backend import get_backend, ERROR_BAD_ARGUMENTS, ERROR_DEVICE_NOT_FOUND
+from API.instrumentation import get_recorder
 
 # ------------------------------------------------------------------------------
 # Declare D188 classes 
@@ -35,54 +36,63 @@ class D188(Structure):
         ("State", D188DEVICESTATE_T)
     ]
 
-# ------------------------------------------------------------------------------
-# Declare DLL API function and associated parameters
-protoDGD188_Initialise = WINFUNCTYPE (
-    c_int,       #Function result
-    c_void_p,    #Instance Reference
-    c_void_p,    #Initialise Result
-    c_int,       #Callback pointer (not used MUST be 0)
-    c_int        #Callback parameters (not used MUST be 0)
-    )
-
-protoDGD188_Update = WINFUNCTYPE (
-    c_int,       #Function result
-    c_int,       #Instance Reference
-    c_void_p,    #Update Result
-    c_void_p,    #NewState
-    c_int,       #cbNewState
-    c_void_p,    #CurrentState
-    c_void_p,    #cbCurrentState
-    c_int,       #Callback pointer (not used MUST be 0)
-    c_int        #Callback parameters (not used MUST be 0)
-    )
-
-protoDGD188_Close = WINFUNCTYPE (
-    c_int,       #Function result
-    c_void_p,    #Instance Reference
-    c_void_p,    #Close Result
-    c_int,       #Callback pointer (not used MUST be 0)
-    c_int        #Callback parameters (not used MUST be 0)
-    )
-
-
-paramsDGD188_Initialise = (1,"Reference",0),(1,"InitResult",0),(1,"CallbackProc",0),(1,"CallbackParam",0),
-paramsDGD188_Update =  (1,"Reference",0),(1,"updateResult",0),(1,"NewState",0),(1,"cbNewState",0),(1,"CurrentState",0),(1,"cbCurrentState",0),(1,"CallbackProc",0),(1,"CallbackParam",0),
-paramsDGD188_Close =  (1,"Reference",0),(1,"CloseResult",0),(1,"CallbackProc",0),(1,"CallbackParam",0),
-
-
-DGD188_Initialise = protoDGD188_Initialise(("DGD188_Initialise",hDGD188Api), paramsDGD188_Initialise)
-DGD188_Update = protoDGD188_Update(("DGD188_Update",hDGD188Api), paramsDGD188_Update)
-DGD188_Close = protoDGD188_Close(("DGD188_Close",hDGD188Api), paramsDGD188_Close)
+@lru_cache(maxsize=None)
+def D188_N(count):
+    '''
+    D188 structure type describing count devices (State is then an array). D188_N(1) has the same layout as D188.
+    '''
+    class D188N(Structure):
+        _fields_ = [
+            ("Header", DEVHDR),
+            ("State", D188DEVICESTATE_T * count)
+        ]
+    return D188N
 
 # ------------------------------------------------------------------------------
 # Declare D188 class
 class D188Controller:
-    def __init__(self):
+    # Field of D188STATE_T holding each parameter
+    STATE_FIELDS = {
+        'mode': 'D188_Mode',
+        'channel': 'D188_Select',
+        'indicator': 'D188_Indicator',
+        'delay': 'D188_Delay',
+    }
+
+    def __init__(self, backend=None):
+        '''
+        Args:
+            backend: object providing Initialise/Update/Close with the DLL semantics.
+                     Defaults to get_backend('D188'): DGD188API.DLL loaded on first use, or the simulator
+                     if the TTENS_BACKEND environment variable is 'sim'
+        '''
+        self.backend = backend or get_backend('D188')
+        self.update = get_recorder().Wrap('DGD188_Update', self.backend.Update)   # Timed only if latency recording is enabled
         self.apiRef = c_int(0)          
         self.retError = c_int(0)         
         self.retAPIError = c_int(0)   
         self.closeResult = c_int(0)   
+        self.shadowValid = False            # False until the shadow is refreshed from the device
+        self.deviceIndex = 0                # Position of the controlled D188 among the connected ones
+        self.deviceID = 0                   # Device ID (serial number) of the controlled D188, 0 for the one at deviceIndex
+        self.lastSwitchLatency = None       # Duration of the last channel switch [s]
+        self.switchCount = 0                # Statistics of the channel switches of the session
+        self.switchTotal = 0.0
+        self.switchMax = 0.0
+
+        # Preallocated buffers and references reused by every DLL call
+        self.request = D188()               # NewState, always describes the controlled device only
+        self.request.Header.DeviceCount = 1
+        self.cbRequest = sizeof(self.request)
+        self.requestState = self.request.State.D188_State
+        self.requestFields = None           # Raw fields of the request being sent, to rebuild it if the buffers are resized
+        self.cbResponse = c_int(0)
+        self.pApiRef = byref(self.apiRef)
+        self.pRetAPIError = byref(self.retAPIError)
+        self.pCloseResult = byref(self.closeResult)
+        self.pRequest = byref(self.request)
+        self.pCbResponse = byref(self.cbResponse)
+        self.Allocate(1)
 
         self.D188Mode = {
             'OFF': c_ubyte(0),
@@ -102,6 +112,7 @@ class D188Controller:
             7: c_ubyte(64),
             8: c_ubyte(128)
         }
+        self.D188SelectMask = {channel: select.value for channel, select in self.D188Select.items()}  # Precomputed raw masks
 
         self.D188Indicator = {
             'OFF': c_ubyte(0),          # 0 = Channel active indicators OFF
@@ -113,9 +124,13 @@ class D188Controller:
         Must be the first function called to initialise the D188 stack and return an
         instance reference.
         '''        
-        self.apiRef = c_int(0)
-        self.retAPIError = c_int(0)
-        return DGD188_Initialise(byref(self.apiRef), byref(self.retAPIError), 0,0)
+        self.apiRef.value = 0
+        self.retAPIError.value = 0
+        self.Invalidate()
+        self.retError.value = self.backend.Initialise(self.pApiRef, self.pRetAPIError, 0,0)
+        if self.retError.value == 0:
+            self.QuerySize()
+        return self.retError.value
     
     def Close(self):
         '''
@@ -123,44 +138,225 @@ class D188Controller:
         Called once D188 has been finished with. It is advisable to hold on to the
         refernce until the end of the program
         '''
-        self.closeResult = c_int(0)
-        DGD188_Close(byref(self.apiRef), byref(self.closeResult), 0,0)
+        self.Invalidate()
+        self.closeResult.value = 0
+        self.backend.Close(self.pApiRef, self.pCloseResult, 0,0)
+
+    def Allocate(self, count):
+        '''
+        (Re)allocate the response buffer for count connected devices.
+        '''
+        self.response = D188_N(count)()          # CurrentState of all the connected devices
+        self.pResponse = byref(self.response)
+        self.deviceIndex = min(self.deviceIndex, count - 1)
+        self.shadow = self.response.State[self.deviceIndex]     # Last known state of the controlled device
+        self.shadowState = self.shadow.D188_State
+        self.Invalidate()
+
+    def QuerySize(self):
+        '''
+        Ask the DLL for the size of the state of all the connected devices and resize the response buffer.
+        Returns:
+            int: number of connected devices
+        '''
+        self.cbResponse.value = 0
+        self.retError.value = self.update(self.apiRef, self.pRetAPIError, 0, 0, 0, self.pCbResponse, 0,0)
+        count = (self.cbResponse.value - D188.State.offset) // sizeof(D188DEVICESTATE_T)
+        if self.retError.value == 0 and count >= 1 and count != len(self.response.State):
+            self.Allocate(count)
+        return len(self.response.State)
+
+    def Exchange(self, send):
+        '''
+        Single DGD188_Update call with the preallocated buffers: optionally send the request buffer and
+        receive the state of all the connected devices in the response buffer.
+        If the number of connected devices changed, the buffer is resized and the call made again: a write
+        is rebuilt from the new state of the selector (requestFields) before it is sent again.
+        '''
+        self.retAPIError.value = 0
+        self.cbResponse.value = sizeof(self.response)
+        if send:
+            self.retError.value = self.update(self.apiRef, self.pRetAPIError, self.pRequest, self.cbRequest, self.pResponse, self.pCbResponse, 0,0)
+        else:
+            self.retError.value = self.update(self.apiRef, self.pRetAPIError, 0, 0, self.pResponse, self.pCbResponse, 0,0)
+        if self.retError.value == ERROR_BAD_ARGUMENTS:
+            size = sizeof(self.response)
+            if self.QuerySize() and sizeof(self.response) != size:
+                if send and self.requestFields is not None:
+                    if self.Exchange(False):                    # State of the selector in the new buffer
+                        return self.retError.value
+                    self.BuildRequest(self.requestFields)
+                return self.Exchange(send)
+        if self.retError.value == 0 and self.deviceID and self.shadow.D188_DeviceID != self.deviceID:
+            self.Locate()
+        return self.retError.value
+
+    def Locate(self):
+        '''
+        Point the shadow copy at the connected device whose ID is deviceID (the DLL addresses the
+        device of a request by the ID copied from the shadow).
+        Returns:
+            bool: False if the device is not connected
+        '''
+        for index in range(min(self.response.Header.DeviceCount, len(self.response.State))):
+            if self.response.State[index].D188_DeviceID == self.deviceID:
+                self.deviceIndex = index
+                self.shadow = self.response.State[index]
+                self.shadowState = self.shadow.D188_State
+                return True
+        print(f'ERROR! D188 {self.deviceID} is not connected')
+        self.retError.value = ERROR_DEVICE_NOT_FOUND
+        return False
+
+    def Devices(self):
+        '''
+        Returns:
+            list of int: device ID (serial number) of every connected D188, as of the last update
+        '''
+        return [self.response.State[index].D188_DeviceID for index in range(min(self.response.Header.DeviceCount, len(self.response.State)))]
+
+    def SelectDevice(self, deviceID):
+        '''
+        Control the connected D188 with this device ID (serial number) when several are connected.
+        '''
+        self.deviceID = deviceID
+        self.Invalidate()
 
-    def UpdateGet(self, STATE):
+    def UpdateGet(self, STATE=None):
         '''
-        Fetch the current state associated with the supplied instance reference.
+        Fetch the current state associated with the supplied instance reference into the response buffer.
+        Args:
+            STATE (D188): optional structure receiving a copy of the header and of the controlled device state
         '''         
-        self.retAPIError = c_int(0)  
-        _STATE = D188()
-        _cbSTATE = c_int(getsizeof(_STATE))
-        DGD188_Update(self.apiRef, byref(self.retAPIError), 0, 0, byref(_STATE), byref(_cbSTATE), 0,0)
-        STATE.Header = _STATE.Header
-        STATE.State = _STATE.State
+        result = self.Exchange(False)
+        if STATE is not None:
+            self.Copy(STATE)
+        return result
     
-    def UpdateSet(self, STATE):
+    def UpdateSet(self, STATE=None):
+        '''
+        Updates the connected device to match the request buffer, or STATE (object of type D188) if given.
+        The state returned by the device is received in the response buffer (and copied into STATE).
+        '''
+        if STATE is not None:
+            memmove(addressof(self.request), addressof(STATE), self.cbRequest)
+            self.requestFields = None           # Sent as given, not rebuilt
+        result = self.Exchange(True)
+        if STATE is not None:
+            self.Copy(STATE)
+        return result
+
+    def Copy(self, STATE):
+        STATE.Header = self.response.Header
+        STATE.State = self.shadow
+
+    def StateView(self):
+        '''
+        Read-only view of the raw bytes of the last state received from the DLL (header and all the
+        connected devices). The view follows the buffer: it shows the new state after each update.
+        '''
+        return memoryview(self.response).cast('B').toreadonly()
+
+    def StateBytes(self):
         '''
-        Takes an object of type D188 and updates the connected device to match the state
+        Snapshot copy of the raw bytes of the last state received from the DLL.
         '''
-        self.retAPIError = c_int(0)  
-        _STATE = D188()
-        _cbSTATE = c_int(getsizeof(_STATE))
-        _STATE.Header = STATE.Header
-        _STATE.State = STATE.State
-        DGD188_Update(self.apiRef, byref(self.retAPIError), byref(_STATE), _cbSTATE, 0, 0, 0,0)
+        return bytes(self.response)
+
+    def Refresh(self):
+        '''
+        Re-read the selector state into the shadow copy. Must be called when the state may have been
+        changed outside of this controller (D188 software, front panel).
+        '''
+        result = self.UpdateGet()
+        self.shadowValid = result == 0 and self.retAPIError.value == 0
+        return result
+
+    def Invalidate(self):
+        '''
+        Mark the shadow copy as out of date. The next write refreshes it from the device first.
+        '''
+        self.shadowValid = False
+
+    def Encode(self, param, value):
+        '''
+        Validate one parameter and convert it to the raw value expected in the D188STATE_T.
+        Args:
+            param (string): one of the keys of STATE_FIELDS
+            value: value respecting the requirements of the corresponding setter
+        Returns:
+            The raw value, or None (after printing the reason) if the value is invalid
+        '''
+        if param == 'channel':
+            if value in self.D188SelectMask:
+                return self.D188SelectMask[value]
+            print('ERROR! Channel argument invalid')
+        elif param == 'mode':
+            if value in self.D188Mode:
+                return self.D188Mode[value].value
+            print('ERROR! Mode argument invalid')
+        elif param == 'indicator':
+            if value in self.D188Indicator:
+                return self.D188Indicator[value].value
+            print('ERROR! Indicator argument invalid')
+        elif param == 'delay':
+            if 0.1 <= value <= 1000:
+                return round(value * 1000 / 100)    # convert to us and devide by 100us to get n
+            print('ERROR! Delay argument invalid')
+        else:
+            print(f'ERROR! Unrecognized parameter for the D188: {param}')
+        return None
+
+    def Configure(self, **params):
+        '''
+        Validate several parameters and apply them with a single write built from the shadow copy.
+        Fields that already have the requested value are not rewritten and nothing is sent if the
+        selector already is in the requested state. Selecting channel 0 (all off) is always sent.
+        Args:
+            **params: channel, mode, indicator and/or delay with the same values as the corresponding setters
+        Returns:
+            bool: True if all the values were accepted and written
+        '''
+        fields = {}
+        for param, value in params.items():
+            raw = self.Encode(param, value)
+            if raw is None:
+                return False
+            fields[param] = raw
+        if not self.shadowValid:
+            self.Refresh()
+        dirty = {param: raw for param, raw in fields.items()
+                 if (param == 'channel' and raw == 0) or getattr(self.shadowState, self.STATE_FIELDS[param]) != raw}
+        if not dirty:
+            return True
+        self.BuildRequest(dirty)
+        self.requestFields = dirty
+        start = perf_counter()
+        self.UpdateSet()                        # The shadow receives the new selector state
+        self.requestFields = None
+        if 'channel' in dirty:
+            self.lastSwitchLatency = perf_counter() - start
+            self.switchCount += 1
+            self.switchTotal += self.lastSwitchLatency
+            self.switchMax = max(self.switchMax, self.lastSwitchLatency)
+        self.shadowValid = self.retError.value == 0 and self.retAPIError.value == 0
+        return self.shadowValid
+
+    def BuildRequest(self, fields):
+        '''
+        Request buffer = last known state of the selector with fields (raw values) changed.
+        '''
+        self.request.State = self.shadow        # Start from the last known state
+        for param, raw in fields.items():
+            setattr(self.requestState, self.STATE_FIELDS[param], raw)
 
     def SetChannel(self, channel):
         '''
-        Set which channel is active
+        Set which channel is active. Only one DGD188_Update call is made once the shadow copy is valid.
         Args:
             channel (self.D1288Select): 0,1,2,...,8
         '''
-        if channel in self.D188Select:
-            STATE = D188()
-            self.UpdateGet(STATE)
-            STATE.State.D188_State.D188_Select = self.D188Select[channel]
-            self.UpdateSet(STATE)
-        else:
-            print('ERROR! Channel argument invalid')
+        self.Configure(channel=channel)
     
     def SetMode(self, mode):
         '''
@@ -168,13 +364,7 @@ class D188Controller:
         Args:
             mode (self.D1288Mode): 'OFF', 'USB', '8TTL' or '4TTL'
         '''
-        if mode in self.D188Mode:
-            STATE = D188()
-            self.UpdateGet(STATE)
-            STATE.State.D188_State.D188_Mode = self.D188Mode[mode]
-            self.UpdateSet(STATE)
-        else:
-            print('ERROR! Mode argument invalid')
+        self.Configure(mode=mode)
 
     def SetIndicator(self, indicator):
         '''
@@ -182,13 +372,7 @@ class D188Controller:
         Args:
             indicator (self.D188Indicator): 'ON' or 'OFF'
         '''
-        if indicator in self.D188Indicator:
-            STATE = D188()
-            self.UpdateGet(STATE)
-            STATE.State.D188_State.D188_Indicator = self.D188Indicator[indicator]
-            self.UpdateSet(STATE)
-        else:
-            print('ERROR! Indicator argument invalid')
+        self.Configure(indicator=indicator)
 
     def SetDelay(self, delay):
         '''
@@ -198,41 +382,47 @@ class D188Controller:
         Args:
             delay (float): between 0.1-1000 milliseconds
         '''
-        if 0.1 <= delay <= 1000:
-            STATE = D188()
-            self.UpdateGet(STATE)
-            n = int(delay * 1000 / 100)     # convert to us and devide by 100us to get n 
-            c_n = c_ushort(n)              # devide by 100us to get n 
-            STATE.State.D188_State.D188_Delay = c_n
-            self.UpdateSet(STATE)
-        else:
-            print('ERROR! Indicator argument invalid')
+        self.Configure(delay=delay)
+
+    def SwitchLatency(self):
+        '''
+        Measured duration of the DGD188_Update calls that switched channel during this session.
+        Returns:
+            dict: 'count', 'last', 'mean' and 'max' in milliseconds (None if no switch was made yet)
+        '''
+        if not self.switchCount:
+            return {'count': 0, 'last': None, 'mean': None, 'max': None}
+        return {
+            'count': self.switchCount,
+            'last': self.lastSwitchLatency * 1e3,
+            'mean': self.switchTotal / self.switchCount * 1e3,
+            'max': self.switchMax * 1e3
+        }
 
     def PrintState(self):
         '''
         Print the current content of the D188 STATE
         '''
-        STATE = D188()
-        self.UpdateGet(STATE)
+        self.Refresh()
+        STATE = self.shadow
         print(
             {
-                'D188_Mode': STATE.State.D188_State.D188_Mode,
-                'D188_Select': STATE.State.D188_State.D188_Select,
-                'D188_Indicator': STATE.State.D188_State.D188_Indicator,
-                'D188_Delay': STATE.State.D188_State.D188_Delay,
-                'D188_DeviceID': STATE.State.D188_DeviceID,
-                'D188_VersionID': STATE.State.D188_VersionID,
-                'D188_Error': STATE.State.D188_Error,
-                'DeviceCount': STATE.Header.DeviceCount
+                'D188_Mode': STATE.D188_State.D188_Mode,
+                'D188_Select': STATE.D188_State.D188_Select,
+                'D188_Indicator': STATE.D188_State.D188_Indicator,
+                'D188_Delay': STATE.D188_State.D188_Delay,
+                'D188_DeviceID': STATE.D188_DeviceID,
+                'D188_VersionID': STATE.D188_VersionID,
+                'D188_Error': STATE.D188_Error,
+                'DeviceCount': self.response.Header.DeviceCount
             }
         )
 
 if __name__ == "__main__":
     d188 = D188Controller()
     d188.Initialise()
-    d188.SetChannel(6)
-    d188.SetDelay(1)
-    d188.SetIndicator('ON')
-    d188.SetMode('USB')
+    d188.Configure(mode='USB', indicator='ON', delay=1, channel=6)
+    d188.SetChannel(2)
     d188.PrintState()
+    print(d188.SwitchLatency())
     d188.Close()
@@ -1,10 +1,11 @@
 # Author: Mohamed Habib Ben Abda
 # Date: Fall semester 2024
 # API for DS8R Digitimer Stimulator
-from ctypes import c_int, c_uint, c_void_p, Structure, Union, WINFUNCTYPE, LittleEndianStructure, byref, WinDLL
-from sys import getsizeof
-
-hDGD128Api = WinDLL("D128API.DLL")
+from ctypes import c_int, c_uint, Structure, Union, LittleEndianStructure, byref, sizeof, memmove, addressof
+from contextlib import contextmanager
+from functools import lru_cache
+from API.backend import get_backend, ERROR_BAD_ARGUMENTS, ERROR_DEVICE_NOT_FOUND
+from API.instrumentation import get_recorder
 
 # ------------------------------------------------------------------------------
 # Declare DS8R classes 
@@ -71,55 +72,68 @@ class D128(Structure):
         ("State", D128DEVICESTATE),
     ]
 
-# ------------------------------------------------------------------------------
-# Declare DLL API function and associated parameters
-protoDGD128_Initialise = WINFUNCTYPE (
-    c_int,       #Function result
-    c_void_p,    #Instance Reference
-    c_void_p,    #Initialise Result
-    c_int,       #Callback pointer (not used MUST be 0)
-    c_int        #Callback parameters (not used MUST be 0)
-    )
-
-protoDGD128_Update = WINFUNCTYPE (
-    c_int,       #Function result
-    c_int,       #Instance Reference
-    c_void_p,    #Update Result
-    c_void_p,    #NewState
-    c_int,       #cbNewState
-    c_void_p,    #CurrentState
-    c_void_p,    #cbCurrentState
-    c_int,       #Callback pointer (not used MUST be 0)
-    c_int        #Callback parameters (not used MUST be 0)
-    )
-
-protoDGD128_Close = WINFUNCTYPE (
-    c_int,       #Function result
-    c_void_p,    #Instance Reference
-    c_void_p,    #Close Result
-    c_int,       #Callback pointer (not used MUST be 0)
-    c_int        #Callback parameters (not used MUST be 0)
-    )
-
-
-paramsDGD128_Initialise = (1,"Reference",0),(1,"InitResult",0),(1,"CallbackProc",0),(1,"CallbackParam",0),
-paramsDGD128_Update =  (1,"Reference",0),(1,"updateResult",0),(1,"NewState",0),(1,"cbNewState",0),(1,"CurrentState",0),(1,"cbCurrentState",0),(1,"CallbackProc",0),(1,"CallbackParam",0),
-paramsDGD128_Close =  (1,"Reference",0),(1,"CloseResult",0),(1,"CallbackProc",0),(1,"CallbackParam",0),
-
-
-DGD128_Initialise = protoDGD128_Initialise(("DGD128_Initialise",hDGD128Api), paramsDGD128_Initialise)
-DGD128_Update = protoDGD128_Update(("DGD128_Update",hDGD128Api), paramsDGD128_Update)
-DGD128_Close = protoDGD128_Close(("DGD128_Close",hDGD128Api), paramsDGD128_Close)
+@lru_cache(maxsize=None)
+def D128_N(count):
+    '''
+    D128 structure type describing count devices (State is then an array), as returned by the DLL
+    when several DS8R are connected. D128_N(1) has the same layout as D128.
+    '''
+    class D128N(Structure):
+        _fields_ = [
+            ("Header", DEVHDR),
+            ("State", D128DEVICESTATE * count),
+        ]
+    return D128N
 
 # ------------------------------------------------------------------------------
 # Declare DS8R class
 
 class DS8RController:
-    def __init__(self):
+    # Location of each parameter inside D128STATE: (sub-structure, field). None means a direct member
+    STATE_FIELDS = {
+        'mode': ('CONTROL', 'MODE'),
+        'polarity': ('CONTROL', 'POLARITY'),
+        'source': ('CONTROL', 'SOURCE'),
+        'enable': ('CONTROL', 'ENABLE'),
+        'trigger': ('CONTROL', 'TRIGGER'),
+        'demand': (None, 'DEMAND'),
+        'pulsewidth': (None, 'WIDTH'),
+        'dwell': (None, 'DWELL'),
+        'recovery': (None, 'RECOVERY'),
+    }
+
+    def __init__(self, backend=None):
+        '''
+        Args:
+            backend: object providing Initialise/Update/Close with the DLL semantics.
+                     Defaults to get_backend('DS8R'): D128API.DLL loaded on first use, or the simulator
+                     if the TTENS_BACKEND environment variable is 'sim'
+        '''
+        self.backend = backend or get_backend('DS8R')
+        self.update = get_recorder().Wrap('DGD128_Update', self.backend.Update)   # Timed only if latency recording is enabled
         self.apiRef = c_int(0)          # Session reference
-        self.retError = c_int(0)         # Initialization error
+        self.retError = c_int(0)         # Result of the last DLL function call
         self.retAPIError = c_int(0)      # General API error code
         self.closeResult = c_int(0)   
+        self.transaction = None          # Pending raw fields while a Transaction is open
+        self.transactionValid = True     # False as soon as one value of the open Transaction is rejected
+        self.shadowValid = False         # False until the shadow is refreshed from the device
+        self.deviceIndex = 0             # Position of the controlled DS8R among the connected ones
+        self.deviceID = 0                # Device ID (serial number) of the controlled DS8R, 0 for the one at deviceIndex
+
+        # Preallocated buffers and references reused by every DLL call
+        self.request = D128()            # NewState, always describes the controlled device only
+        self.request.Header.DeviceCount = 1
+        self.cbRequest = sizeof(self.request)
+        self.requestTargets = self.Targets(self.request.State)
+        self.requestFields = None        # Raw fields of the request being sent, to rebuild it if the buffers are resized
+        self.cbResponse = c_int(0)
+        self.pApiRef = byref(self.apiRef)
+        self.pRetAPIError = byref(self.retAPIError)
+        self.pCloseResult = byref(self.closeResult)
+        self.pRequest = byref(self.request)
+        self.pCbResponse = byref(self.cbResponse)
+        self.Allocate(1)
 
         self.DS8RMode = {
             'Mono-phasic': 1,
@@ -145,14 +159,29 @@ class DS8RController:
             False: 0
         }
 
+        self.DS8RCmdUsage = {
+            'mode': 'mode - ' + ', '.join(self.DS8RMode.keys()),
+            'polarity': 'polarity - ' + ', '.join(self.DS8RPol.keys()),
+            'source': 'source - ' + ', '.join(self.DS8RSrc.keys()),
+            'demand': 'demand - float value between 0 and 1000. max one decimal point',
+            'pulsewidth': 'pulsewidth - integer value between 50 and 2000',
+            'dwell': 'Interpulse delay - integer value between 1 and 990',
+            'recovery': 'recovery - integer value between 10 and 100',
+            'enable': 'enable - True or False'
+        }
+
     def Initialise(self):
         '''
         Must be the first function called to initialise the DS8R stack and return an
         instance reference.
         '''        
-        self.apiRef = c_int(0)
-        self.retAPIError = c_int(0)
-        return DGD128_Initialise(byref(self.apiRef), byref(self.retAPIError), 0,0)
+        self.apiRef.value = 0
+        self.retAPIError.value = 0
+        self.Invalidate()
+        self.retError.value = self.backend.Initialise(self.pApiRef, self.pRetAPIError, 0,0)
+        if self.retError.value == 0:
+            self.QuerySize()
+        return self.retError.value
         
     def Close(self):
         '''
@@ -160,30 +189,312 @@ class DS8RController:
         Called once DS8R has been finished with. It is advisable to hold on to the
         refernce until the end of the program
         '''
-        self.closeResult = c_int(0)
-        DGD128_Close(byref(self.apiRef), byref(self.closeResult), 0,0)
+        self.Invalidate()
+        self.closeResult.value = 0
+        self.backend.Close(self.pApiRef, self.pCloseResult, 0,0)
+
+    def Targets(self, device_state):
+        '''
+        Resolve STATE_FIELDS to (structure, field) pairs of one D128DEVICESTATE once, so that reading
+        and writing fields does not create new ctypes views on every call.
+        '''
+        state = device_state.D128_State
+        control = state.CONTROL
+        return {param: (control if sub == 'CONTROL' else state, name) for param, (sub, name) in self.STATE_FIELDS.items()}
+
+    def Allocate(self, count):
+        '''
+        (Re)allocate the response buffer for count connected devices.
+        '''
+        self.response = D128_N(count)()          # CurrentState of all the connected devices
+        self.pResponse = byref(self.response)
+        self.deviceIndex = min(self.deviceIndex, count - 1)
+        self.shadow = self.response.State[self.deviceIndex]     # Last known state of the controlled device
+        self.shadowTargets = self.Targets(self.shadow)
+        self.Invalidate()
+
+    def QuerySize(self):
+        '''
+        Ask the DLL for the size of the state of all the connected devices and resize the response buffer.
+        Returns:
+            int: number of connected devices
+        '''
+        self.cbResponse.value = 0
+        self.retError.value = self.update(self.apiRef, self.pRetAPIError, 0, 0, 0, self.pCbResponse, 0,0)
+        count = (self.cbResponse.value - D128.State.offset) // sizeof(D128DEVICESTATE)
+        if self.retError.value == 0 and count >= 1 and count != len(self.response.State):
+            self.Allocate(count)
+        return len(self.response.State)
+
+    def Exchange(self, send):
+        '''
+        Single DGD128_Update call with the preallocated buffers: optionally send the request buffer and
+        receive the state of all the connected devices in the response buffer.
+        If the number of connected devices changed, the buffer is resized and the call made again: a write
+        is rebuilt from the new state of the device (requestFields) before it is sent again.
+        '''
+        self.retAPIError.value = 0
+        self.cbResponse.value = sizeof(self.response)
+        if send:
+            self.retError.value = self.update(self.apiRef, self.pRetAPIError, self.pRequest, self.cbRequest, self.pResponse, self.pCbResponse, 0,0)
+        else:
+            self.retError.value = self.update(self.apiRef, self.pRetAPIError, 0, 0, self.pResponse, self.pCbResponse, 0,0)
+        if self.retError.value == ERROR_BAD_ARGUMENTS:
+            size = sizeof(self.response)
+            if self.QuerySize() and sizeof(self.response) != size:
+                if send and self.requestFields is not None:
+                    if self.Exchange(False):                    # State of the device in the new buffer
+                        return self.retError.value
+                    self.BuildRequest(self.requestFields)
+                return self.Exchange(send)
+        if self.retError.value == 0 and self.deviceID and self.shadow.D128_DeviceID != self.deviceID:
+            self.Locate()
+        return self.retError.value
+
+    def Locate(self):
+        '''
+        Point the shadow copy at the connected device whose ID is deviceID (the DLL addresses the
+        device of a request by the ID copied from the shadow).
+        Returns:
+            bool: False if the device is not connected
+        '''
+        for index in range(min(self.response.Header.DeviceCount, len(self.response.State))):
+            if self.response.State[index].D128_DeviceID == self.deviceID:
+                self.deviceIndex = index
+                self.shadow = self.response.State[index]
+                self.shadowTargets = self.Targets(self.shadow)
+                return True
+        print(f'ERROR! DS8R {self.deviceID} is not connected')
+        self.retError.value = ERROR_DEVICE_NOT_FOUND
+        return False
+
+    def Devices(self):
+        '''
+        Returns:
+            list of int: device ID (serial number) of every connected DS8R, as of the last update
+        '''
+        return [self.response.State[index].D128_DeviceID for index in range(min(self.response.Header.DeviceCount, len(self.response.State)))]
+
+    def SelectDevice(self, deviceID):
+        '''
+        Control the connected DS8R with this device ID (serial number) when several are connected.
+        '''
+        self.deviceID = deviceID
+        self.Invalidate()
         
-    def UpdateGet(self, STATE):
+    def UpdateGet(self, STATE=None):
         '''
-        Fetch the current state associated with the supplied instance reference.
+        Fetch the current state associated with the supplied instance reference into the response buffer.
+        Args:
+            STATE (D128): optional structure receiving a copy of the header and of the controlled device state
         '''         
-        self.retAPIError = c_int(0)  
-        _STATE = D128()
-        _cbSTATE = c_int(getsizeof(_STATE))
-        DGD128_Update(self.apiRef, byref(self.retAPIError), 0, 0, byref(_STATE), byref(_cbSTATE), 0,0)
-        STATE.Header = _STATE.Header
-        STATE.State = _STATE.State
+        result = self.Exchange(False)
+        if STATE is not None:
+            self.Copy(STATE)
+        return result
     
-    def UpdateSet(self, STATE):
+    def UpdateSet(self, STATE=None):
+        '''
+        Updates the connected device to match the request buffer, or STATE (object of type D128) if given.
+        The state returned by the device is received in the response buffer (and copied into STATE).
+        '''
+        if STATE is not None:
+            memmove(addressof(self.request), addressof(STATE), self.cbRequest)
+            self.requestFields = None                                       # Sent as given, not rebuilt
+        result = self.Exchange(True)
+        if STATE is not None:
+            self.Copy(STATE)
+        return result
+
+    def Copy(self, STATE):
+        STATE.Header = self.response.Header
+        STATE.State = self.shadow
+
+    def StateView(self):
         '''
-        Takes an object of type DS8R and updates the connected device to match the state
+        Read-only view of the raw bytes of the last state received from the DLL (header and all the
+        connected devices). The view follows the buffer: it shows the new state after each update.
         '''
-        self.retAPIError = c_int(0)  
-        _STATE = D128()
-        _cbSTATE = c_int(getsizeof(_STATE))
-        _STATE.Header = STATE.Header
-        _STATE.State = STATE.State
-        DGD128_Update(self.apiRef, byref(self.retAPIError), byref(_STATE), _cbSTATE, byref(STATE), byref(_cbSTATE), 0,0)
+        return memoryview(self.response).cast('B').toreadonly()
+
+    def StateBytes(self):
+        '''
+        Snapshot copy of the raw bytes of the last state received from the DLL.
+        '''
+        return bytes(self.response)
+
+    def Refresh(self):
+        '''
+        Re-read the device state into the shadow copy. Must be called when the state may have been
+        changed outside of this controller (front panel, another application).
+        '''
+        result = self.UpdateGet()
+        self.shadowValid = result == 0 and self.retAPIError.value == 0
+        return result
+
+    def Invalidate(self):
+        '''
+        Mark the shadow copy as out of date. The next write refreshes it from the device first.
+        '''
+        self.shadowValid = False
+
+    def Cached(self, param):
+        '''
+        Return the raw value of a parameter in the shadow copy, refreshing it first if needed.
+        Args:
+            param (string): one of the keys of STATE_FIELDS
+        '''
+        if not self.shadowValid:
+            self.Refresh()
+        target, name = self.shadowTargets[param]
+        return getattr(target, name)
+
+    def Counters(self):
+        '''
+        Read the pulse counters and fault flags of the device (reset when the output is enabled again).
+        Returns:
+            dict: cpulse (pulses delivered), cooc (out of compliance), ctoofast (triggers too fast), overenergy, hwerror.
+                  None if the device could not be read
+        '''
+        if self.Refresh() != 0:
+            return None
+        state = self.shadow.D128_State
+        return {
+            'cpulse': state.CPULSE,
+            'cooc': state.COOC,
+            'ctoofast': state.CTOOFAST,
+            'overenergy': bool(state.FSTATE.OVERENERGY),
+            'hwerror': bool(state.FSTATE.HWERROR),
+        }
+
+    def Encode(self, param, value):
+        '''
+        Validate one parameter and convert it to the raw value expected in the D128STATE.
+        Args:
+            param (string): one of the keys of STATE_FIELDS except 'trigger'
+            value: value respecting the requirements of the corresponding setter
+        Returns:
+            The raw value, or None (after printing the reason) if the value is invalid
+        '''
+        if param == 'mode':
+            if value in self.DS8RMode:
+                return self.DS8RMode[value]
+            print(f'ERROR! Mode argument invalid: {value}')
+        elif param == 'polarity':
+            if value in self.DS8RPol:
+                return self.DS8RPol[value]
+            print(f'ERROR! Polarity argument invalid: {value}')
+        elif param == 'source':
+            if value in self.DS8RSrc:
+                return self.DS8RSrc[value]
+            print(f'ERROR! Source argument invalid: {value}')
+        elif param == 'demand':
+            if 0 <= value <= 1000:
+                return int(round(value * 10))   # function takes (mA * 10) with one decimal precision
+            print(f'ERROR! Amplitude argument out of range')
+        elif param == 'pulsewidth':
+            if 50 <= value <= 2000:
+                return int(value)
+            print(f'ERROR! Pulsewidth argument out of range')
+        elif param == 'dwell':
+            if 1 <= value <= 990 and (value == 1 or value % 10 == 0):
+                return int(value)
+            print(f'ERROR! Interpulse argument invalid')
+        elif param == 'recovery':
+            if 10 <= value <= 100:
+                return int(value)
+            print(f'ERROR! Recovery argument out of range')
+        elif param == 'enable':
+            if isinstance(value, bool):
+                return self.DS8REnabled[value]
+            print(f'ERROR! Enable argument invalid: {value}')
+        else:
+            print(f'ERROR! Unrecognized parameter for the DS8R: {param}')
+        return None
+
+    def Configure(self, **params):
+        '''
+        Validate a full parameter set and apply it with a single write of the D128 state, instead of
+        one UpdateGet/UpdateSet pair per parameter. Nothing is sent if any value is invalid.
+        Inside a Transaction the values are only collected and sent when the transaction ends.
+        Args:
+            **params: mode, polarity, source, demand, pulsewidth, dwell, recovery and/or enable
+                      with the same values as the corresponding single setters
+        Returns:
+            bool: True if all the values were accepted and written (or collected by the open Transaction)
+        '''
+        fields = {}
+        for param, value in params.items():
+            raw = self.Encode(param.lower(), value)
+            if raw is None:
+                if self.transaction is not None:
+                    self.transactionValid = False
+                return False
+            fields[param.lower()] = raw
+        return self.Apply(fields)
+
+    @contextmanager
+    def Transaction(self):
+        '''
+        Collect every Configure, Cmd, setter and Trigger call made inside the with-block and send them
+        to the device in one write when the block exits. If one of the values is invalid or an exception
+        is raised inside the block, nothing is sent.
+        Example:
+            with ds8r.Transaction():
+                ds8r.Cmd('demand', 2)
+                ds8r.Enable(True)
+        '''
+        if self.transaction is not None:            # Nested transactions are merged into the outer one
+            yield self
+            return
+        self.transaction = {}
+        self.transactionValid = True
+        try:
+            yield self
+            fields, valid = self.transaction, self.transactionValid
+        finally:
+            self.transaction = None
+        if not valid:
+            print('ERROR! Transaction discarded because of an invalid argument')
+        elif fields:
+            self.Apply(fields)
+
+    def Apply(self, fields):
+        '''
+        Write already validated raw fields to the device in a single write, or add them to the open
+        Transaction. The write is built from the shadow copy and only contains the fields that differ
+        from it; nothing is sent when all the fields already have the requested value.
+        Args:
+            fields (dict): raw values indexed by the keys of STATE_FIELDS
+        Returns:
+            bool: False if the write failed
+        '''
+        if self.transaction is not None:
+            self.transaction.update(fields)
+            return True
+        dirty = {param: raw for param, raw in fields.items()
+                 if param == 'trigger'                                      # Commands are never skipped
+                 or (param == 'enable' and raw == self.DS8REnabled[False])  # Neither are safety disables
+                 or self.Cached(param) != raw}
+        if not dirty:                                                       # The device already is in this state
+            return True
+        self.BuildRequest(dirty)
+        self.requestFields = dirty
+        self.UpdateSet()                                                    # The shadow receives the new device state
+        self.requestFields = None
+        self.shadowValid = self.retError.value == 0 and self.retAPIError.value == 0
+        return self.shadowValid
+
+    def BuildRequest(self, fields):
+        '''
+        Request buffer = last known state of the device with fields (raw values) changed.
+        '''
+        self.request.State = self.shadow                                    # Start from the last known state
+        control, _ = self.requestTargets['trigger']
+        control.TRIGGER = 0                                                 # Only trigger if asked to
+        for param, raw in fields.items():
+            target, name = self.requestTargets[param]
+            setattr(target, name, raw)
 
     def Mode(self, mode_str):
         '''
@@ -191,13 +502,7 @@ class DS8RController:
         Args:
             mode (string): from self.DS8RMode typedef
         '''
-        if mode_str in self.DS8RMode:
-            STATE = D128()
-            self.UpdateGet(STATE)
-            STATE.State.D128_State.CONTROL.MODE = self.DS8RMode[mode_str]
-            self.UpdateSet(STATE)
-        else:
-            print(f'ERROR! Mode argument invalid: {mode_str}')
+        self.Configure(mode=mode_str)
 
     def Polarity(self, pol_str):
         '''
@@ -205,13 +510,7 @@ class DS8RController:
         Args:
             pol_str (string): from self.DS8RPol typedef
         '''
-        if pol_str in self.DS8RPol:
-            STATE = D128()
-            self.UpdateGet(STATE)
-            STATE.State.D128_State.CONTROL.POLARITY = self.DS8RPol[pol_str]
-            self.UpdateSet(STATE)
-        else:
-            print(f'ERROR! Polarity argument invalid: {pol_str}')
+        self.Configure(polarity=pol_str)
 
     def Source(self, src_str):
         '''
@@ -219,13 +518,7 @@ class DS8RController:
         Args:
             src_str (string): from self.DS8RSrc typedef
         '''
-        if src_str in self.DS8RSrc:
-            STATE = D128()
-            self.UpdateGet(STATE)
-            STATE.State.D128_State.CONTROL.SOURCE = self.DS8RSrc[src_str]
-            self.UpdateSet(STATE)
-        else:
-            print(f'ERROR! Source argument invalid: {src_str}')
+        self.Configure(source=src_str)
 
     def Demand(self, value):
         '''
@@ -233,14 +526,7 @@ class DS8RController:
         Args:
             value (float): acceptable amplitude in [0-1000] mA with one decimal precision
         '''
-        if 0 <= value <= 1000:
-            value = round(value, 1)
-            STATE = D128()
-            self.UpdateGet(STATE)
-            STATE.State.D128_State.DEMAND = int(value * 10) # function takes (mA * 10)
-            self.UpdateSet(STATE)
-        else:
-            print(f'ERROR! Amplitude argument out of range')
+        self.Configure(demand=value)
 
     def Pulsewidth(self, value):
         '''
@@ -248,13 +534,7 @@ class DS8RController:
         Args:
             value (int): acceptable pulsewidth in [50-2000] us 
         '''
-        if 50 <= value <= 2000:
-            STATE = D128()
-            self.UpdateGet(STATE)
-            STATE.State.D128_State.WIDTH = int(value)
-            self.UpdateSet(STATE)
-        else:
-            print(f'ERROR! Pulsewidth argument out of range')
+        self.Configure(pulsewidth=value)
 
     def Dwell(self, value):
         '''
@@ -262,13 +542,7 @@ class DS8RController:
         Args:
             value (int): acceptable interpulse width in [1-990] us 
         '''
-        if 1 <= value <= 990 and (value == 1 or value % 10 == 0):
-            STATE = D128()
-            self.UpdateGet(STATE)
-            STATE.State.D128_State.DWELL = int(value)
-            self.UpdateSet(STATE)
-        else:
-            print(f'ERROR! Interpulse argument invalid')
+        self.Configure(dwell=value)
 
     def Recovery(self, value):
         '''
@@ -278,13 +552,7 @@ class DS8RController:
         Args:
             value (int): acceptable recovery phase value in [10-100] %
         '''
-        if 10 <= value <= 100:
-            STATE = D128()
-            self.UpdateGet(STATE)
-            STATE.State.D128_State.RECOVERY = int(value)
-            self.UpdateSet(STATE)
-        else:
-            print(f'ERROR! Recovery argument out of range')
+        self.Configure(recovery=value)
 
     def Enable(self, enabled):
         '''
@@ -292,108 +560,56 @@ class DS8RController:
         Args:
             enabled (bool)
         '''
-        if isinstance(enabled, bool):
-            STATE = D128()
-            self.UpdateGet(STATE)
-            STATE.State.D128_State.CONTROL.ENABLE = self.DS8REnabled[enabled]
-            self.UpdateSet(STATE)
-        else:
-            print(f'ERROR! Enable argument invalid: {enabled}')
+        self.Configure(enable=enabled)
     
     def Trigger(self):
         '''
         Triggers one time. TRIGGER is 0 in idle. Setting it to 1 triggers. After triggering it will be set back to zero automatically by the device 
         REMARK: Max trigger at 10Hz using USB, otherwise can have bugs
         '''
-        STATE = D128()
-        self.UpdateGet(STATE)
-        STATE.State.D128_State.CONTROL.TRIGGER = 1
-        self.UpdateSet(STATE)
+        self.Apply({'trigger': 1})
 
     def PrintState(self):
         '''
         Print the current content of the DS8R STATE
         '''
-        STATE = D128()
-        self.UpdateGet(STATE)
+        self.Refresh()
+        STATE = self.shadow.D128_State
         print(
             {
-                'mode': STATE.State.D128_State.CONTROL.MODE,
-                'polarity': STATE.State.D128_State.CONTROL.POLARITY,
-                'source': STATE.State.D128_State.CONTROL.SOURCE,
-                'demand': STATE.State.D128_State.DEMAND,
-                'pulsewidth': STATE.State.D128_State.WIDTH,
-                'dwell': STATE.State.D128_State.DWELL,
-                'recovery': STATE.State.D128_State.RECOVERY,
-                'enabled': STATE.State.D128_State.CONTROL.ENABLE
+                'mode': STATE.CONTROL.MODE,
+                'polarity': STATE.CONTROL.POLARITY,
+                'source': STATE.CONTROL.SOURCE,
+                'demand': STATE.DEMAND,
+                'pulsewidth': STATE.WIDTH,
+                'dwell': STATE.DWELL,
+                'recovery': STATE.RECOVERY,
+                'enabled': STATE.CONTROL.ENABLE,
+                'pulses': STATE.CPULSE,
+                'out_of_compliance': STATE.COOC,
+                'too_fast': STATE.CTOOFAST,
+                'over_energy': STATE.FSTATE.OVERENERGY,
+                'hw_error': STATE.FSTATE.HWERROR
             }
         )
 
     def Cmd(self, command, *args):
         '''
         This is just a dispatcher function that provides a different format for calling the previous functions:
-        Mode, Polarity, Source, Demand, Pulsewidth, Dwell, Recovery
+        Mode, Polarity, Source, Demand, Pulsewidth, Dwell, Recovery, Enable
+        It goes through Configure, so several Cmd calls inside a Transaction are sent in one write.
         Args:
             command (string): different commands
             *args: different possible values depending on the command
         '''
-        if command.lower() == 'mode':
-            if len(args) == 1:
-                mode_str = args[0]
-                self.Mode(mode_str)
-            else:
-                print('Unexpected number of arguments for mode command')
-                print('\tmode - ' + ', '.join(self.DS8RMode.keys()))
-
-        elif command.lower() == 'polarity':
-            if len(args) == 1:
-                pol_str = args[0]
-                self.Polarity(pol_str)
-            else:
-                print('Unexpected number of arguments for polarity command')
-                print('\tpolarity - ' + ', '.join(self.DS8RPol.keys()))
-
-        elif command.lower() == 'source':
-            if len(args) == 1:
-                src_str = args[0]
-                self.Source(src_str)
-            else:
-                print('Unexpected number of arguments for source command')
-                print('\tsource - ' + ', '.join(self.DS8RSrc.keys()))
-
-        elif command.lower() == 'demand':
-            if len(args) == 1:
-                pulse_amp = args[0]
-                self.Demand(pulse_amp)
-            else:
-                print('Unexpected number of arguments for demand command')
-                print('\tdemand - float value between 0 and 1000. max one decimal point') 
-
-        elif command.lower() == 'pulsewidth':
-            if len(args) == 1:
-                pulse_width = args[0]
-                self.Pulsewidth(pulse_width)
-            else:
-                print('Unexpected number of arguments for pulsewidth command')
-                print('\tpulsewidth - integer value between 50 and 2000')
-
-        elif command.lower() == 'dwell':
-            if len(args) == 1:
-                inter_pulse = args[0]
-                self.Dwell(inter_pulse)
-            else:
-                print('Unexpected number of arguments for dwell command')
-                print('\tInterpulse delay - integer value between 1 and 990')
-
-        elif command.lower() == 'recovery':
-            if len(args) == 1:
-                rec_percentage = args[0]
-                self.Recovery(rec_percentage)
-            else:
-                print('Unexpected number of arguments for recovery command')
-                print('\trecovery - integer value between 10 and 100')
-        else:
+        command = command.lower()
+        if command not in self.DS8RCmdUsage:
             print('ERROR! Unrecognized command for the DS8R')
+        elif len(args) != 1:
+            print(f'Unexpected number of arguments for {command} command')
+            print('\t' + self.DS8RCmdUsage[command])
+        else:
+            self.Configure(**{command: args[0]})
 
 
 if __name__ == "__main__":
@@ -402,14 +618,11 @@ if __name__ == "__main__":
     '''
     ds8r = DS8RController()
     ds8r.Initialise()
-    ds8r.Mode('Bi-phasic')
-    ds8r.Polarity('Negative')
-    ds8r.Source('Internal')
-    ds8r.Cmd('demand', 2)
-    ds8r.Cmd('pulsewidth', 50)
-    ds8r.Cmd('dwell', 10)
-    ds8r.Cmd('recovery', 100)
-    ds8r.Enable(True)
+    ds8r.Configure(mode='Bi-phasic', polarity='Negative', source='Internal',
+                   demand=2, pulsewidth=50, dwell=10, recovery=100)
+    with ds8r.Transaction():
+        ds8r.Cmd('demand', 2.5)
+        ds8r.Enable(True)
     ds8r.Trigger()
     ds8r.Enable(False)
     ds8r.PrintState()
@@ -0,0 +1,200 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Per-call latency instrumentation of the DLL and serial I/O
+import os
+import threading
+from array import array
+from time import perf_counter_ns
+
+# ------------------------------------------------------------------------------
+# Declare instrumentation classes
+class LatencyHistogram:
+    '''
+    Fixed-size HDR-style (log-linear) histogram of durations in ns.
+    Values below 2**subBits are counted exactly, larger values in buckets of relative width 2**(1-subBits)
+    (< 1% with the default 7 bits). The memory is allocated once, recording never allocates.
+    '''
+    def __init__(self, name, subBits=7, maxValue=60 * 10**9):
+        self.name = name
+        self.subBits = subBits
+        self.subCount = 1 << subBits
+        self.halfCount = self.subCount >> 1
+        self.maxValue = maxValue
+        self.counts = array('Q', bytes(8 * (self.Index(maxValue) + 1)))
+        self.Reset()
+
+    def Reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+
+    def Index(self, value):
+        if value < self.subCount:
+            return value
+        shift = value.bit_length() - self.subBits
+        return self.subCount + (shift - 1) * self.halfCount + (value >> shift) - self.halfCount
+
+    def Value(self, index):
+        '''
+        Highest value counted in the bucket index.
+        '''
+        if index < self.subCount:
+            return index
+        shift = (index - self.subCount) // self.halfCount + 1
+        mantissa = (index - self.subCount) % self.halfCount + self.halfCount
+        return ((mantissa + 1) << shift) - 1
+
+    def Record(self, value):
+        '''
+        Args:
+            value (int): duration [ns]
+        '''
+        if value < 0:
+            value = 0
+        elif value > self.maxValue:
+            value = self.maxValue
+        self.counts[self.Index(value)] += 1
+        self.total += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def Percentile(self, p):
+        '''
+        Args:
+            p (float): percentile in [0, 100]
+        Returns:
+            int: duration [ns] below which p% of the recorded calls fall, None if nothing was recorded
+        '''
+        if self.total == 0:
+            return None
+        rank = max(1, -(-self.total * p // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.Value(index), self.max)
+        return self.max
+
+    def Summary(self):
+        '''
+        Returns:
+            dict: count, mean, min, p50, p95, p99, max. Durations in [us]
+        '''
+        us = lambda ns: None if ns is None else ns / 1000
+        return {
+            'count': self.total,
+            'mean': us(self.sum / self.total if self.total else None),
+            'min': us(self.min),
+            'p50': us(self.Percentile(50)),
+            'p95': us(self.Percentile(95)),
+            'p99': us(self.Percentile(99)),
+            'max': us(self.max if self.total else None),
+        }
+
+
+class LatencyRecorder:
+    '''
+    One LatencyHistogram per operation ('DGD128_Update', 'DGD188_Update', 'uC.write', ...).
+    The functions to time are wrapped once with Wrap: if the recorder is disabled at that moment the function
+    itself is returned, so a disabled recorder costs nothing on the calls.
+    Enabled by setting the environment variable TTENS_LATENCY to the file the results are exported to.
+    '''
+    def __init__(self, enabled=False, path=None):
+        self.enabled = enabled
+        self.path = path
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def Enable(self, path=None):
+        '''
+        Enable the recorder. Only the functions wrapped afterwards are timed.
+        '''
+        self.enabled = True
+        self.path = path or self.path
+
+    def Histogram(self, name):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram(name)
+            return self.histograms[name]
+
+    def Wrap(self, name, func):
+        '''
+        Args:
+            name (string): operation recorded
+            func (callable)
+        Returns:
+            callable: func timed into the histogram of name, or func itself if the recorder is disabled
+        '''
+        if not self.enabled:
+            return func
+        record = self.Histogram(name).Record
+        def timed(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(perf_counter_ns() - start)
+        timed.__wrapped__ = func
+        return timed
+
+    def Summary(self):
+        '''
+        Returns:
+            dict: {operation: LatencyHistogram.Summary()}
+        '''
+        with self.lock:
+            histograms = list(self.histograms.values())
+        return {histogram.name: histogram.Summary() for histogram in histograms}
+
+    def Report(self):
+        '''
+        Returns:
+            string: one line per operation with the count and the percentiles in [us]
+        '''
+        fmt = lambda v: '-' if v is None else f'{v:.1f}'
+        lines = [f"{'operation':<16}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}"]
+        for name, s in self.Summary().items():
+            lines.append(f"{name:<16}{s['count']:>8}" + ''.join(f'{fmt(s[k]):>10}' for k in ('mean', 'p50', 'p95', 'p99', 'max')))
+        return '\n'.join(lines)
+
+    def Export(self, path=None):
+        '''
+        Write the report to path (defaults to the path given at Enable or by TTENS_LATENCY).
+        Returns:
+            string: path written, None if nothing was written
+        '''
+        path = path or self.path
+        if not path or not self.histograms:
+            return None
+        try:
+            with open(path, 'w') as file:
+                file.write('Latency [us]\n' + self.Report() + '\n')
+        except OSError as e:
+            print(f"ERROR! Could not export the latency report to {path}: {e}")
+            return None
+        return path
+
+
+_recorder = LatencyRecorder(enabled=bool(os.environ.get('TTENS_LATENCY')), path=os.environ.get('TTENS_LATENCY'))
+
+def get_recorder():
+    '''
+    Return the process-wide latency recorder.
+    '''
+    return _recorder
+
+def instrument_serial(port, name='uC.write'):
+    '''
+    Time the writes to a serial port (serial.Serial) with the process-wide recorder.
+    Returns the port, left untouched if the recorder is disabled.
+    '''
+    if _recorder.enabled:
+        port.write = _recorder.Wrap(name, port.write)
+    return port
@@ -0,0 +1,125 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Pulse trains generated by the trigger microcontroller and verified with the DS8R pulse counter
+import time
+
+# ------------------------------------------------------------------------------
+# Declare pulse train classes
+class PulseTrain:
+    '''
+    Train of trigger pulses, given by a count or a duration, optionally repeated in bursts.
+    Args:
+        frequency (float): pulse frequency inside a burst [Hz]
+        count (int): pulses per burst
+        duration (float): duration of a burst [ms], used when count is not given
+        bursts (int): number of bursts
+        burst_interval (float): time between the starts of two bursts [ms]
+    '''
+    def __init__(self, frequency, count=None, duration=None, bursts=1, burst_interval=0):
+        if frequency <= 0:
+            raise ValueError('The frequency of a pulse train must be positive')
+        if count is None and duration is None:
+            raise ValueError('A pulse train needs a count or a duration')
+        self.frequency = frequency
+        self.count = count if count is not None else max(1, round(frequency * duration * 1e-3))
+        self.bursts = max(1, bursts)
+        self.burst_interval = burst_interval
+
+    def __repr__(self):
+        return f'PulseTrain({self.frequency} Hz, {self.count} pulses x {self.bursts} bursts, {self.burst_interval} ms)'
+
+    def Pulses(self):
+        return self.count * self.bursts
+
+    def Duration(self):
+        '''
+        Expected duration of the whole train [s].
+        '''
+        burst = self.count / self.frequency
+        return (self.bursts - 1) * max(burst, self.burst_interval * 1e-3) + burst
+
+
+class TrainResult:
+    '''
+    Outcome of a pulse train.
+    Attributes:
+        train (PulseTrain)
+        requested (int): pulses requested
+        emitted (int): trigger pulses reported by the microcontroller (None if no completion was received)
+        delivered (int): CPULSE delta, pulses delivered by the DS8R (None if the DS8R could not be read)
+        too_fast (int): CTOOFAST delta, triggers ignored by the DS8R
+        out_of_compliance (int): COOC delta
+        duration (float): time from the command to the completion [s]
+        ok (bool): every requested pulse was delivered, none out of compliance
+    '''
+    def __init__(self, train, emitted, before, after, duration):
+        self.train = train
+        self.requested = train.Pulses()
+        self.emitted = emitted
+        self.duration = duration
+        if before is None or after is None:
+            self.delivered = self.too_fast = self.out_of_compliance = None
+        else:
+            self.delivered = Delta(before, after, 'cpulse')
+            self.too_fast = Delta(before, after, 'ctoofast')
+            self.out_of_compliance = Delta(before, after, 'cooc')
+        self.ok = self.delivered == self.requested and self.out_of_compliance == 0
+
+    def __repr__(self):
+        return (f'TrainResult(ok={self.ok}, requested={self.requested}, emitted={self.emitted}, delivered={self.delivered}, '
+                f'too_fast={self.too_fast}, out_of_compliance={self.out_of_compliance}, duration={self.duration:.3f} s)')
+
+
+def Delta(before, after, counter):
+    # The counters restart when the output is enabled again
+    return after[counter] - before[counter] if after[counter] >= before[counter] else after[counter]
+
+
+class PulseTrainEngine:
+    '''
+    Runs pulse trains on the trigger microcontroller (train command, timed on micros() so trains of hundreds
+    of Hz are possible) and verifies each of them with the DS8R pulse counter.
+    The DS8R output must be enabled before Run: CPULSE restarts when the output is enabled.
+        engine = PulseTrainEngine(TriggerLink(uC), session.stimulator)
+        result = engine.Run(PulseTrain(200, count=50, bursts=3, burst_interval=500))
+    '''
+    SETTLE = 0.3        # Maximum wait for the DS8R state to show the last pulses [s] (DGHost refreshes at 10 Hz)
+
+    def __init__(self, link, stimulator, margin=1.0):
+        '''
+        Args:
+            link (TriggerLink): framed link to the trigger board
+            stimulator: DS8RController, session.stimulator or scheduler proxy
+            margin (float): time allowed on top of the train duration before giving up on the completion [s]
+        '''
+        self.link = link
+        self.stimulator = stimulator
+        self.margin = margin
+
+    def Run(self, train):
+        '''
+        Send the train, wait for its completion and compare the DS8R pulse counter with the requested count.
+        Returns:
+            TrainResult
+        '''
+        before = self.stimulator.Counters()
+        pending = self.link.Train(train.frequency, train.count, train.bursts, train.burst_interval,
+                                  wait='done', timeout=train.Duration() + self.margin)
+        emitted = pending.result if pending.done.is_set() else None
+        duration = (pending.doneTime or time.perf_counter()) - pending.sent
+        after = self.Settle(before, train.Pulses())
+        result = TrainResult(train, emitted, before, after, duration)
+        if not result.ok:
+            print(f'ERROR! Pulse train not delivered as requested: {result}')
+        return result
+
+    def Settle(self, before, pulses):
+        '''
+        Read the counters until they show the requested pulses or SETTLE elapsed.
+        '''
+        deadline = time.perf_counter() + self.SETTLE
+        after = self.stimulator.Counters()
+        while before is not None and after is not None and Delta(before, after, 'cpulse') < pulses and time.perf_counter() < deadline:
+            time.sleep(0.05)
+            after = self.stimulator.Counters()
+        return after
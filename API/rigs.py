@@ -0,0 +1,208 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Multi-rig orchestration: several DS8R + D188 + trigger board rigs driven from one workstation
+from concurrent.futures import ThreadPoolExecutor
+from API.ds8r_controller import DS8RController
+from API.d188_controller import D188Controller
+from API.session import HardwareSession
+from API.scheduler import HardwareScheduler
+from API.transport import TriggerTransport
+
+# ------------------------------------------------------------------------------
+# Device enumeration
+def enumerate_devices(device, backend=None):
+    '''
+    List the connected devices of one type.
+    Args:
+        device (string): 'DS8R' or 'D188'
+        backend: backend of the controller (see API/backend.py)
+    Returns:
+        list of int: device ID (serial number) of every connected device, in DLL order
+    '''
+    controller = {'DS8R': DS8RController, 'D188': D188Controller}[device](backend)
+    try:
+        controller.Initialise()
+        if controller.retError.value or controller.retAPIError.value:
+            print(f'ERROR! {device} enumeration failed: {controller.retError.value or controller.retAPIError.value}')
+            return []
+        controller.Refresh()
+        return controller.Devices()
+    finally:
+        controller.Close()                      # Free the session reference, also when the enumeration failed
+
+# ------------------------------------------------------------------------------
+# Declare rig classes
+class Rig:
+    '''
+    One DS8R, one D188 and one trigger board.
+    Each rig has its own DLL sessions, its own hardware scheduler thread owning the devices and its own
+    experiment thread, so a blocking call on one rig never waits for another rig.
+        rig.stimulator.Configure(demand=2)      # queued to the hardware thread of the rig
+        rig.Run(experiment)                     # experiment(rig) on the experiment thread of the rig
+    '''
+    def __init__(self, name, ds8r=0, d188=0, port=None, ds8r_backend=None, d188_backend=None):
+        '''
+        Args:
+            name (string)
+            ds8r (int): device ID of the DS8R, 0 for the first connected one
+            d188 (int): device ID of the D188, 0 for the first connected one
+            port (string): serial port of the trigger board, e.g. 'COM5' (None: no trigger board)
+        '''
+        self.name = name
+        self.port = port
+        self.transport = None
+        stimulator = DS8RController(ds8r_backend)
+        stimulator.SelectDevice(ds8r)
+        selector = D188Controller(d188_backend)
+        selector.SelectDevice(d188)
+        self.session = HardwareSession(stimulator=stimulator, selector=selector)
+        self.scheduler = HardwareScheduler({'DS8R': self.session.stimulator, 'D188': self.session.selector}, name=f'{name}-hw')
+        self.stimulator = self.scheduler.Device('DS8R')
+        self.selector = self.scheduler.Device('D188')
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def __repr__(self):
+        return f'Rig({self.name}, DS8R {self.session.stimulator.deviceID}, D188 {self.session.selector.deviceID}, {self.port})'
+
+    def Open(self):
+        '''
+        Open the DLL sessions and the serial port of the rig.
+        Returns:
+            bool: True if both devices are usable
+        '''
+        opened = self.scheduler.Call('DS8R', lambda device: self.session.Open())
+        if opened:
+            self.stimulator.Enable(False)
+        if self.port is not None and self.transport is None:
+            transport = TriggerTransport(self.port)
+            if transport.Open():                                # Ready on the banner of the board, no fixed delay
+                self.transport = transport
+                self.scheduler.Add('uC', transport.link)
+            else:
+                print(f"ERROR! {self.name} trigger board not ready on {self.port}")
+        return opened
+
+    def Trigger(self, method, *args, wait='ack', timeout=None):
+        '''
+        Send one framed command to the trigger board of the rig through its hardware thread. The hardware
+        thread only waits for the ACK; the completion is awaited on the calling thread, so a SAFETY Disable
+        or EmergencyStop of the DS8R is not held up by a running train.
+        Args:
+            method (string): command of the TriggerLink, e.g. 'TriggerN', 'TriggerD' or 'Train'
+            args: parameters of the command
+            wait (string): 'ack' or 'done' (None: do not wait for the ACK either)
+            timeout (float): [s] for the ACK and for the completion, from the sending (None: no limit for the completion)
+        Returns:
+            Pending: wait for the completion with pending.Wait('done')
+        '''
+        if wait not in (None, 'ack', 'done'):
+            raise ValueError(f'Unknown wait: {wait}')
+        pending = self.scheduler.Call('uC', method, *args, None if wait is None else 'ack', timeout)
+        if wait == 'done' and pending.ack.is_set() and not pending.Wait('done', timeout):
+            print(f'ERROR! No completion from the {self.name} trigger board for {method} {args}')
+        return pending
+
+    def TriggerN(self, freq, numTriggers, wait='ack', timeout=None):
+        return self.Trigger('TriggerN', freq, numTriggers, wait=wait, timeout=timeout or numTriggers / freq + 1.0)
+
+    def TriggerD(self, freq, duration, wait='ack', timeout=None):
+        return self.Trigger('TriggerD', freq, duration, wait=wait, timeout=timeout or duration * 1e-3 + 1.0)
+
+    def Train(self, freq, count, bursts=1, burst_interval=0, wait='ack', timeout=None):
+        duration = (max(bursts, 1) - 1) * max(count / freq, burst_interval * 1e-3) + count / freq
+        return self.Trigger('Train', freq, count, bursts, burst_interval, wait=wait, timeout=timeout or duration + 1.0)
+
+    def Run(self, experiment, *args, **kwargs):
+        '''
+        Run experiment(rig, *args, **kwargs) on the experiment thread of the rig.
+        Returns:
+            Future: result of the experiment
+        '''
+        return self.executor.submit(experiment, self, *args, **kwargs)
+
+    def Close(self):
+        '''
+        Disable the output, close the sessions and the serial port, stop the threads of the rig.
+        '''
+        self.executor.shutdown(wait=True)
+        if self.session.stimulator.opened:
+            self.scheduler.EmergencyStop().result()
+        self.scheduler.Call('DS8R', lambda device: self.session.Close())
+        self.scheduler.Stop()
+        if self.transport is not None:
+            self.transport.Close()
+
+
+class RigRegistry:
+    '''
+    The rigs of the workstation, by name.
+        registry = RigRegistry()
+        registry.Discover(ports=['COM5', 'COM6'])
+        results = registry.RunAll({'rig1': experiment1, 'rig2': experiment2})
+    '''
+    def __init__(self):
+        self.rigs = {}
+
+    def __getitem__(self, name):
+        return self.rigs[name]
+
+    def __iter__(self):
+        return iter(self.rigs.values())
+
+    def __len__(self):
+        return len(self.rigs)
+
+    def Add(self, rig):
+        if rig.name in self.rigs:
+            raise KeyError(f'Rig {rig.name} already registered')
+        self.rigs[rig.name] = rig
+        return rig
+
+    def Discover(self, ports=(), ds8r_backend=None, d188_backend=None):
+        '''
+        Enumerate the connected DS8R and D188 and register one rig per pair, in DLL order, with the serial
+        ports given in the same order.
+        Returns:
+            list of Rig: the new rigs
+        '''
+        stimulators = enumerate_devices('DS8R', ds8r_backend)
+        selectors = enumerate_devices('D188', d188_backend)
+        ports = list(ports)
+        if len(stimulators) != len(selectors):
+            print(f'{len(stimulators)} DS8R and {len(selectors)} D188 connected: only complete rigs are registered')
+        rigs = []
+        for index, (ds8r, d188) in enumerate(zip(stimulators, selectors)):
+            port = ports[index] if index < len(ports) else None
+            rigs.append(self.Add(Rig(f'rig{len(self.rigs) + 1}', ds8r, d188, port, ds8r_backend, d188_backend)))
+        return rigs
+
+    def Open(self):
+        '''
+        Open all the rigs concurrently.
+        Returns:
+            dict: {name: True if the rig is usable}
+        '''
+        futures = {name: rig.executor.submit(rig.Open) for name, rig in self.rigs.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+    def Run(self, experiments):
+        '''
+        Start independent experiments concurrently.
+        Args:
+            experiments (dict): {rig name: experiment(rig)}
+        Returns:
+            dict: {rig name: Future}
+        '''
+        return {name: self.rigs[name].Run(experiment) for name, experiment in experiments.items()}
+
+    def RunAll(self, experiments):
+        '''
+        Run independent experiments concurrently and wait until all are finished.
+        Returns:
+            dict: {rig name: result of the experiment}
+        '''
+        return {name: future.result() for name, future in self.Run(experiments).items()}
+
+    def Close(self):
+        for rig in self.rigs.values():
+            rig.Close()
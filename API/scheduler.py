@@ -0,0 +1,243 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Hardware command scheduler: one thread owns the devices, the other threads queue commands
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+
+# ------------------------------------------------------------------------------
+# Command priorities, lowest first
+SAFETY = 0          # Safety disables, jump ahead of everything queued
+HIGH = 1
+NORMAL = 2
+
+# Setters whose pending call is superseded by a newer call of the same setter on the same device
+SETTERS = {'Mode', 'Polarity', 'Source', 'Demand', 'Pulsewidth', 'Dwell', 'Recovery',
+           'SetChannel', 'SetMode', 'SetIndicator', 'SetDelay'}
+# Parameters that are never merged away: every enable/disable and trigger request reaches the device
+UNMERGEABLE = {'enable', 'trigger'}
+
+# ------------------------------------------------------------------------------
+# Declare scheduler classes
+class Command:
+    '''
+    One queued call: devices[device].method(*args, **kwargs), or method(devices[device], *args, **kwargs)
+    if method is a callable.
+    '''
+    __slots__ = ('device', 'method', 'args', 'kwargs', 'priority', 'future')
+
+    def __init__(self, device, method, args, kwargs, priority):
+        self.device = device
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = Future()
+
+    def Merge(self, method, args, kwargs):
+        '''
+        Replace this pending command by a newer one that supersedes it.
+        Returns:
+            bool: True if merged, False if both commands have to be sent
+        '''
+        if method != self.method or not isinstance(method, str):
+            return False
+        if method == 'Configure':
+            if args or self.args or UNMERGEABLE & (kwargs.keys() | self.kwargs.keys()):
+                return False
+            self.kwargs.update(kwargs)
+            return True
+        if method == 'Cmd':
+            if not args or not self.args or args[0] != self.args[0] or str(args[0]).lower() == 'enable':
+                return False
+            self.args = args
+            return True
+        if method in SETTERS:
+            self.args, self.kwargs = args, kwargs
+            return True
+        return False
+
+    def MayEnable(self):
+        '''
+        Returns:
+            bool: True unless the command certainly does not enable the output (functions are not inspected)
+        '''
+        if callable(self.method):
+            return True
+        if self.method == 'Enable':
+            return (self.args[0] if self.args else self.kwargs.get('enabled')) is not False
+        if self.method == 'Cmd':
+            return bool(self.args) and str(self.args[0]).lower() == 'enable' and self.args[1:] != (False,)
+        if self.method in ('Configure', 'Apply'):
+            fields = self.args[0] if self.args and isinstance(self.args[0], dict) else self.kwargs
+            return 'enable' in fields and fields['enable'] is not False
+        return False
+
+
+class HardwareScheduler:
+    '''
+    Single thread owning the hardware objects (session devices, serial port, ...). Any thread queues commands
+    with Submit (returns a Future) or Call (waits for the result); they are executed one at a time by the
+    scheduler thread, by priority then in submission order.
+    - SAFETY commands (Disable, EmergencyStop) jump the queue.
+    - A setter queued right after a pending call of the same setter on the same device supersedes it
+      (e.g. several Demand or Configure(demand=...) writes queued back to back become one DLL call).
+      Enable and trigger requests are never merged.
+    '''
+    def __init__(self, devices=None, name='hw-scheduler'):
+        '''
+        Args:
+            devices (dict): {name: object}, e.g. {'DS8R': session.stimulator, 'D188': session.selector}
+        '''
+        self.devices = dict(devices or {})
+        self.queue = []                             # Heap of (priority, sequence, Command)
+        self.tails = {}                             # Last pending command of each device
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+        self.executed = 0
+        self.merged = 0
+        self.thread = threading.Thread(target=self.Loop, name=name, daemon=True)
+        self.thread.start()
+
+    def Add(self, name, device):
+        '''
+        Hand a device over to the scheduler (e.g. the serial port once opened).
+        '''
+        with self.condition:
+            self.devices[name] = device
+
+    def Submit(self, device, method, *args, priority=NORMAL, **kwargs):
+        '''
+        Queue a command.
+        Args:
+            device (string): name of the device
+            method (string or callable): method name, or function called with the device as first argument
+            priority (int): SAFETY, HIGH or NORMAL
+        Returns:
+            Future: result of the call (shared with the superseded command if merged)
+        '''
+        with self.condition:
+            if not self.running:
+                raise RuntimeError('The hardware scheduler is stopped')
+            if device not in self.devices:
+                raise KeyError(f'Unknown device: {device}')
+            tail = self.tails.get(device)
+            if tail is not None and tail.priority == priority and priority != SAFETY and tail.Merge(method, args, kwargs):
+                self.merged += 1
+                return tail.future
+            command = Command(device, method, args, kwargs, priority)
+            heapq.heappush(self.queue, (priority, next(self.sequence), command))
+            self.tails[device] = command
+            self.condition.notify()
+            return command.future
+
+    def Call(self, device, method, *args, priority=NORMAL, timeout=None, **kwargs):
+        '''
+        Queue a command and wait for its result. Runs directly when called from the scheduler thread.
+        '''
+        if threading.current_thread() is self.thread:
+            return self.Execute(Command(device, method, args, kwargs, priority))
+        return self.Submit(device, method, *args, priority=priority, **kwargs).result(timeout)
+
+    def Disable(self, device='DS8R'):
+        '''
+        Disable the stimulator output ahead of all the queued commands. The pending commands of the stimulator that
+        may enable the output again (enables, transactions given as functions) are cancelled, the others still run.
+        '''
+        with self.condition:
+            self.Cancel(device, lambda command: command.MayEnable())
+            return self.Submit(device, 'Enable', False, priority=SAFETY)
+
+    def Cancel(self, device, selected):
+        '''
+        Cancel the pending commands of a device for which selected(command) is True. Call with the condition held.
+        '''
+        kept = []
+        for entry in self.queue:
+            command = entry[2]
+            if command.device == device and command.priority != SAFETY and selected(command):
+                command.future.cancel()
+                if self.tails.get(device) is command:
+                    del self.tails[device]
+            else:
+                kept.append(entry)
+        heapq.heapify(kept)
+        self.queue = kept
+
+    def EmergencyStop(self, device='DS8R'):
+        '''
+        Cancel every pending command of the stimulator and disable its output first.
+        '''
+        with self.condition:
+            self.Cancel(device, lambda command: True)
+            return self.Disable(device)
+
+    def Execute(self, command):
+        target = self.devices[command.device]
+        if callable(command.method):
+            return command.method(target, *command.args, **command.kwargs)
+        return getattr(target, command.method)(*command.args, **command.kwargs)
+
+    def Loop(self):
+        while True:
+            with self.condition:
+                while not self.queue and self.running:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                command = heapq.heappop(self.queue)[2]
+                if self.tails.get(command.device) is command:
+                    del self.tails[command.device]      # Running commands can no longer be superseded
+            if not command.future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = self.Execute(command)
+            except BaseException as e:
+                command.future.set_exception(e)
+            else:
+                command.future.set_result(result)
+            self.executed += 1
+
+    def Pending(self):
+        with self.condition:
+            return len(self.queue)
+
+    def Stop(self, timeout=None):
+        '''
+        Execute the commands already queued, then stop the scheduler thread.
+        '''
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if threading.current_thread() is not self.thread:
+            self.thread.join(timeout)
+
+    def Device(self, name, wait=True):
+        '''
+        Returns:
+            DeviceProxy: the device with all its methods going through the scheduler
+        '''
+        return DeviceProxy(self, name, wait)
+
+
+class DeviceProxy:
+    '''
+    Stand-in for a device owned by a HardwareScheduler: proxy.Demand(2) queues the call.
+    With wait=True the calls return the result like the device itself, otherwise they return a Future.
+    '''
+    def __init__(self, scheduler, name, wait=True):
+        self.scheduler = scheduler
+        self.name = name
+        self.wait = wait
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        def call(*args, priority=NORMAL, **kwargs):
+            if self.wait:
+                return self.scheduler.Call(self.name, attr, *args, priority=priority, **kwargs)
+            return self.scheduler.Submit(self.name, attr, *args, priority=priority, **kwargs)
+        call.__name__ = attr
+        return call
@@ -0,0 +1,217 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Long-lived hardware session for the DS8R and the D188
+import atexit
+import threading
+from contextlib import contextmanager
+from API.ds8r_controller import DS8RController
+from API.d188_controller import D188Controller
+from API.instrumentation import get_recorder
+from API.backend import (ERROR_NOT_INITIALISED, ERROR_PROCESS_TERMINATED, ERROR_UNEXPECTED_TERMINATION,
+                         ERROR_DEVICE_NOT_FOUND, ERROR_DGHOST_STARTUP_TIMEOUT, ERROR_PIPE_WRITE_TIMEOUT,
+                         ERROR_PIPE_READ_TIMEOUT, ERROR_PIPE_READ_NULL)
+
+# ------------------------------------------------------------------------------
+# DLL errors after which the session reference must be re-initialised
+RECOVERABLE_ERRORS = {
+    ERROR_NOT_INITIALISED,
+    ERROR_PROCESS_TERMINATED,
+    ERROR_UNEXPECTED_TERMINATION,
+    ERROR_DEVICE_NOT_FOUND,
+    ERROR_DGHOST_STARTUP_TIMEOUT,
+    ERROR_PIPE_WRITE_TIMEOUT,
+    ERROR_PIPE_READ_TIMEOUT,
+    ERROR_PIPE_READ_NULL,
+}
+
+# ------------------------------------------------------------------------------
+# Declare session classes
+class ManagedDevice:
+    '''
+    Wraps a DS8RController or D188Controller owned by a HardwareSession.
+    All the controller methods can be called as usual. Calls are serialised between threads, and a call
+    that fails with a recoverable DLL error (or an OSError raised by ctypes) re-initialises the session
+    reference and is retried once.
+    '''
+    def __init__(self, name, controller, retries=1):
+        self.name = name
+        self.controller = controller
+        self.retries = retries
+        self.lock = threading.RLock()
+        self.opened = False
+        self.reinitialisations = 0
+
+    def __getattr__(self, attr):
+        value = getattr(self.controller, attr)
+        if not callable(value) or attr in ('Initialise', 'Close'):
+            return value
+        def call(*args, **kwargs):
+            return self.Call(attr, *args, **kwargs)
+        return call
+
+    def LastError(self):
+        '''
+        Return the first non-zero error of the last DLL call: function result, then service result.
+        '''
+        return self.controller.retError.value or self.controller.retAPIError.value
+
+    def Open(self):
+        '''
+        Initialise the session reference if not already done.
+        Returns:
+            bool: True if the session is open
+        '''
+        with self.lock:
+            if not self.opened:
+                self.controller.Initialise()
+                self.opened = self.LastError() == 0
+                if not self.opened:
+                    print(f'ERROR! {self.name} initialisation failed: {self.LastError()}')
+            return self.opened
+
+    def Close(self):
+        with self.lock:
+            if self.opened:
+                self.controller.Close()
+                self.opened = False
+
+    def Reopen(self):
+        '''
+        Drop the current session reference and initialise a new one.
+        '''
+        with self.lock:
+            try:
+                self.Close()
+            except OSError as e:
+                print(f'{self.name} close error ignored during re-initialisation: {e}')
+                self.opened = False
+            self.reinitialisations += 1
+            return self.Open()
+
+    def Call(self, method, *args, **kwargs):
+        '''
+        Call a controller method on the open session, re-initialising it if the DLL reports that it was lost.
+        '''
+        with self.lock:
+            for attempt in range(self.retries + 1):
+                if not self.Open():
+                    continue
+                self.controller.retError.value = 0
+                self.controller.retAPIError.value = 0
+                try:
+                    result = getattr(self.controller, method)(*args, **kwargs)
+                except OSError as e:
+                    print(f'{self.name} {method} failed: {e}')
+                else:
+                    if self.LastError() not in RECOVERABLE_ERRORS:
+                        return result
+                    print(f'{self.name} {method} failed with error {self.LastError()}')
+                if attempt < self.retries:
+                    self.Reopen()
+            print(f'ERROR! {self.name} {method} could not be completed')
+            return None
+
+    @contextmanager
+    def Transaction(self):
+        '''
+        Controller Transaction holding the device lock until the write is sent.
+        '''
+        with self.lock:
+            self.Open()
+            with self.controller.Transaction():
+                yield self
+
+    def IsHealthy(self):
+        '''
+        Health check: read the device state and check that the DLL and the device report no error.
+        '''
+        with self.lock:
+            if not self.opened:
+                return False
+            try:
+                result = self.controller.Refresh()
+            except OSError:
+                return False
+            return result == 0 and self.controller.retAPIError.value == 0
+
+    def Check(self):
+        '''
+        Re-initialise the session if the health check fails.
+        Returns:
+            bool: True if the device is usable
+        '''
+        with self.lock:
+            return self.IsHealthy() or (self.Reopen() and self.IsHealthy())
+
+
+class HardwareSession:
+    '''
+    Owns one session reference (apiRef) per device for the whole process lifetime instead of calling
+    Initialise/Close around every operation.
+    Can be used as a context manager:
+        with HardwareSession() as hw:
+            hw.stimulator.Configure(demand=2)
+            hw.selector.SetChannel(3)
+    or as the long-lived process-wide handle returned by get_session().
+    '''
+    def __init__(self, stimulator=None, selector=None, retries=1):
+        self.stimulator = ManagedDevice('DS8R', stimulator or DS8RController(), retries)
+        self.selector = ManagedDevice('D188', selector or D188Controller(), retries)
+
+    def devices(self):
+        return (self.stimulator, self.selector)
+
+    def Open(self):
+        '''
+        Initialise both devices.
+        Returns:
+            bool: True if both session references are valid
+        '''
+        return all([device.Open() for device in self.devices()])
+
+    def Close(self):
+        for device in self.devices():
+            device.Close()
+        get_recorder().Export()         # Latency report, only if recording is enabled (TTENS_LATENCY)
+
+    def IsHealthy(self):
+        return all(device.IsHealthy() for device in self.devices())
+
+    def Check(self):
+        '''
+        Health check of both devices, with re-initialisation of the ones that fail.
+        '''
+        return all([device.Check() for device in self.devices()])
+
+    def __enter__(self):
+        self.Open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+        return False
+
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    '''
+    Return the hardware session shared by the whole process. It is created on first use
+    and closed automatically when the interpreter exits.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = HardwareSession()
+            atexit.register(_session.Close)
+        return _session
+
+
+if __name__ == "__main__":
+    with HardwareSession() as hw:
+        print(f'Healthy: {hw.Check()}')
+        hw.stimulator.Configure(mode='Bi-phasic', polarity='Negative', demand=2, pulsewidth=50)
+        hw.selector.Configure(mode='USB', indicator='ON', delay=1, channel=1)
+        hw.stimulator.PrintState()
+        hw.selector.PrintState()
@@ -0,0 +1,351 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# In-process simulators of the DS8R stimulator and the D188 electrode selector
+import threading
+import time
+from ctypes import sizeof
+from API.backend import (ERROR_SUCCESS, ERROR_BAD_ARGUMENTS, ERROR_NOT_INITIALISED,
+                         ERROR_INVALID_PARAMETER, ERROR_INVALID_STRUCTURE)
+from API.ds8r_controller import D128, D128DEVICESTATE, DEVHDR
+from API.d188_controller import D188, D188DEVICESTATE_T
+
+def _target(arg):
+    '''
+    Return the ctypes object behind a byref()/pointer() argument, or None for a NULL pointer.
+    '''
+    if arg is None or (isinstance(arg, int) and arg == 0):
+        return None
+    if hasattr(arg, '_obj'):            # byref()
+        return arg._obj
+    if hasattr(arg, 'contents'):        # pointer()
+        return arg.contents
+    return arg
+
+def _value(arg):
+    return getattr(arg, 'value', arg)
+
+# ------------------------------------------------------------------------------
+# Declare simulator classes
+class SimulatedDevice:
+    '''
+    Pure-Python implementation of the Initialise/Update/Close semantics of the Digitimer DLLs:
+    session references, variable size state structures (header + one state per connected device),
+    size queries with a NULL CurrentState and validation of the new state.
+    Subclasses describe the device state and how it is applied and reported.
+    '''
+    STRUCTURE = None            # Single device structure (D128 or D188)
+    DEVICE_STATE = None         # Per device state structure
+
+    def __init__(self, devices=1, latency=0.0):
+        self.lock = threading.RLock()
+        self.latency = latency                  # Simulated duration of each DLL call [s]
+        self.sessions = set()
+        self.nextRef = 1
+        self.units = [self.NewUnit(i) for i in range(devices)]
+        self.stateOffset = self.STRUCTURE.State.offset
+
+    def Size(self):
+        return self.stateOffset + len(self.units) * sizeof(self.DEVICE_STATE)
+
+    def Connect(self):
+        '''
+        Hot-plug one more device: the state of the next Update no longer fits the buffers sized before.
+        Returns:
+            dict: the new unit
+        '''
+        with self.lock:
+            self.units.append(self.NewUnit(len(self.units)))
+            return self.units[-1]
+
+    def Disconnect(self, index=-1):
+        with self.lock:
+            return self.units.pop(index)
+
+    def Wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def Initialise(self, lpReference, lpInitResult, callback=0, param=0):
+        self.Wait()
+        with self.lock:
+            ref = self.nextRef
+            self.nextRef += 1
+            self.sessions.add(ref)
+            _target(lpReference).value = ref
+            _target(lpInitResult).value = ERROR_SUCCESS
+            return ERROR_SUCCESS
+
+    def Close(self, lpReference, lpCloseResult, callback=0, param=0):
+        with self.lock:
+            reference = _target(lpReference)
+            if reference.value not in self.sessions:
+                return ERROR_NOT_INITIALISED
+            self.sessions.discard(reference.value)
+            reference.value = 0
+            _target(lpCloseResult).value = ERROR_SUCCESS
+            return ERROR_SUCCESS
+
+    def Update(self, reference, lpUpdateResult, NewState, cbNewState, CurrentState, cbCurrentState, callback=0, param=0):
+        self.Wait()                 # Transfer time, outside the lock so that concurrent sessions overlap
+        with self.lock:
+            if _value(reference) not in self.sessions:
+                return ERROR_NOT_INITIALISED
+            result = _target(lpUpdateResult)
+            result.value = ERROR_SUCCESS
+            size = _target(cbCurrentState)
+            current = _target(CurrentState)
+            if size is not None and current is not None and (size.value < self.Size() or sizeof(current) < self.Size()):
+                return ERROR_BAD_ARGUMENTS          # CurrentState too small for the connected devices: nothing is applied
+
+            new = _target(NewState)
+            if new is not None:
+                count = DEVHDR.from_buffer(new).DeviceCount
+                required = self.stateOffset + count * sizeof(self.DEVICE_STATE)
+                if _value(cbNewState) < required or sizeof(new) < required:
+                    result.value = ERROR_INVALID_STRUCTURE
+                else:
+                    states = (self.DEVICE_STATE * count).from_buffer(new, self.stateOffset)
+                    for index, state in enumerate(states):
+                        error = self.Apply(self.Find(state, index), state)
+                        if error:
+                            result.value = error
+
+            if size is not None:
+                if current is not None:
+                    DEVHDR.from_buffer(current).DeviceCount = len(self.units)
+                    states = (self.DEVICE_STATE * len(self.units)).from_buffer(current, self.stateOffset)
+                    for unit, state in zip(self.units, states):
+                        self.Fill(unit, state)
+                size.value = self.Size()
+            return ERROR_SUCCESS
+
+    def Find(self, state, index):
+        '''
+        Device addressed by a state of NewState: by serial number when given, otherwise by position.
+        '''
+        serial = self.DeviceID(state)
+        for unit in self.units:
+            if serial and unit['serial'] == serial:
+                return unit
+        return self.units[index] if index < len(self.units) else None
+
+
+class SimulatedDS8R(SimulatedDevice):
+    '''
+    Simulated DS8R. Pulses are delivered by USB triggers (CONTROL.TRIGGER) or by ExternalTrigger(),
+    which stands for the rear panel trigger input driven by the microcontroller.
+    CPULSE, COOC and CTOOFAST behave as described in the programmers reference (reset when the output
+    is enabled again), FSTATE.OVERENERGY disables the output until ClearOverEnergy() is called.
+    ENABLE follows the encoding of DS8RController.DS8REnabled: 1 enabled, 0 disabled, 2 and 3 leave the output unchanged.
+    '''
+    STRUCTURE = D128
+    DEVICE_STATE = D128DEVICESTATE
+
+    def __init__(self, devices=1, latency=0.0, load=1000.0, compliance=400.0, max_energy=300.0, min_interval=1e-3):
+        self.load = load                    # Electrode and skin impedance [Ohm]
+        self.compliance = compliance        # Maximum output voltage [V]
+        self.max_energy = max_energy        # Pulse energy limit [mJ]
+        self.min_interval = min_interval    # Minimum time between the end of a pulse and the next trigger [s]
+        super().__init__(devices, latency)
+
+    def NewUnit(self, index):
+        return {
+            'serial': 8000 + index, 'version': 0x01000000,
+            'enable': False, 'mode': 2, 'polarity': 1, 'source': 1, 'nobuzzer': 0,
+            'demand': 0, 'width': 50, 'recovery': 100, 'dwell': 1,
+            'cpulse': 0, 'cooc': 0, 'ctoofast': 0, 'overenergy': False, 'hwerror': False,
+            'lastPulse': None,
+        }
+
+    def DeviceID(self, state):
+        return state.D128_DeviceID
+
+    def Apply(self, unit, device_state):
+        if unit is None:
+            return ERROR_INVALID_PARAMETER
+        state = device_state.D128_State
+        control = state.CONTROL
+        changes = {}
+        for name, value, valid in (('mode', control.MODE & 7, (1, 2)),
+                                   ('polarity', control.POLARITY & 7, (1, 2, 3)),
+                                   ('source', control.SOURCE & 7, (1, 2))):
+            if value in valid:
+                changes[name] = value
+            elif value not in (0, 7):                               # 7 = no change
+                return ERROR_INVALID_PARAMETER
+        for name, value, low, high in (('demand', state.DEMAND, 0, 10000),
+                                       ('width', state.WIDTH, 50, 2000),
+                                       ('recovery', state.RECOVERY, 10, 100),
+                                       ('dwell', state.DWELL, 1, 990)):
+            if low <= value <= high:
+                changes[name] = value
+            elif value not in (-1, 0):                              # -1 = no change
+                return ERROR_INVALID_PARAMETER
+        enable = control.ENABLE & 3
+        unit.update(changes)
+        if enable == 1 and not unit['enable'] and not unit['overenergy']:
+            unit.update(enable=True, cpulse=0, cooc=0, ctoofast=0, lastPulse=None)
+        elif enable == 0:
+            unit['enable'] = False
+        if control.TRIGGER & 3 == 1:
+            self.Pulse(unit, time.perf_counter())
+        return ERROR_SUCCESS
+
+    def Fill(self, unit, device_state):
+        device_state.D128_DeviceID = unit['serial']
+        device_state.D128_VersionID = unit['version']
+        device_state.D128_Error = ERROR_SUCCESS
+        state = device_state.D128_State
+        state.CONTROL.VALUE = 0
+        state.CONTROL.ENABLE = 1 if unit['enable'] else 0
+        state.CONTROL.MODE = unit['mode']
+        state.CONTROL.POLARITY = unit['polarity']
+        state.CONTROL.SOURCE = unit['source']
+        state.CONTROL.NOBUZZER = unit['nobuzzer']
+        state.DEMAND = unit['demand']
+        state.WIDTH = unit['width']
+        state.RECOVERY = unit['recovery']
+        state.DWELL = unit['dwell']
+        state.CPULSE = unit['cpulse']
+        state.COOC = unit['cooc']
+        state.CTOOFAST = unit['ctoofast']
+        state.FSTATE.VALUE = 0
+        state.FSTATE.OVERENERGY = unit['overenergy']
+        state.FSTATE.HWERROR = unit['hwerror']
+
+    def PulseDuration(self, unit):
+        '''
+        Duration of one stimulus [s]: first phase, plus dwell and recovery phase when bi-phasic.
+        '''
+        duration = unit['width']
+        if unit['mode'] == 2:
+            duration += unit['dwell'] + unit['width'] * 100 / unit['recovery']
+        return duration * 1e-6
+
+    def Pulse(self, unit, t):
+        '''
+        Deliver one pulse at time t [s] if the output allows it.
+        Returns:
+            bool: True if the pulse was delivered
+        '''
+        if not unit['enable'] or unit['overenergy'] or unit['hwerror']:
+            return False
+        duration = self.PulseDuration(unit)
+        if unit['lastPulse'] is not None and t - unit['lastPulse'] < duration + self.min_interval:
+            unit['ctoofast'] += 1
+            return False
+        unit['cpulse'] += 1
+        unit['lastPulse'] = t
+        current = unit['demand'] / 10 * 1e-3                        # [A]
+        voltage = current * self.load
+        if voltage > self.compliance:
+            unit['cooc'] += 1
+            voltage = self.compliance
+            current = voltage / self.load
+        if voltage * current * duration * 1e3 > self.max_energy:
+            unit.update(overenergy=True, enable=False)
+        return True
+
+    def ExternalTrigger(self, count=1, frequency=None, index=0):
+        '''
+        Rear panel trigger input: deliver a train of count pulses at the given frequency [Hz]
+        (simulated timestamps, the call does not wait).
+        Returns:
+            int: number of pulses delivered
+        '''
+        with self.lock:
+            unit = self.units[index]
+            start = time.perf_counter()
+            period = 1 / frequency if frequency else 0
+            return sum(self.Pulse(unit, start + i * period) for i in range(count))
+
+    def FrontPanel(self, index=0, **fields):
+        '''
+        Change the state as the front panel would (e.g. demand=25 in mA * 10, enable=False).
+        '''
+        with self.lock:
+            self.units[index].update(fields)
+
+    def ClearOverEnergy(self, index=0):
+        '''
+        The over energy error can only be cleared from the front panel.
+        '''
+        self.FrontPanel(index, overenergy=False)
+
+    def InjectFault(self, hwerror=True, index=0):
+        self.FrontPanel(index, hwerror=hwerror)
+
+
+class SimulatedD188(SimulatedDevice):
+    '''
+    Simulated D188. In USB mode the channel follows D188_Select, in the 8TTL (1:1) and 4TTL (binary)
+    modes it follows the digital inputs set with SetTTL(). Every change of active channel is logged.
+    '''
+    STRUCTURE = D188
+    DEVICE_STATE = D188DEVICESTATE_T
+
+    def NewUnit(self, index):
+        return {'serial': 1880 + index, 'version': 0x01000000,
+                'mode': 0, 'select': 0, 'indicator': 0, 'delay': 10, 'ttl': 0,
+                'switches': []}
+
+    def DeviceID(self, state):
+        return state.D188_DeviceID
+
+    def Apply(self, unit, device_state):
+        if unit is None:
+            return ERROR_INVALID_PARAMETER
+        state = device_state.D188_State
+        if state.D188_Mode > 3 or not 1 <= state.D188_Delay <= 10000:
+            return ERROR_INVALID_PARAMETER
+        if state.D188_Select & (state.D188_Select - 1):             # More than one channel
+            return ERROR_INVALID_PARAMETER
+        unit.update(mode=state.D188_Mode, indicator=state.D188_Indicator, delay=state.D188_Delay)
+        if unit['mode'] == 1:
+            self.Select(unit, state.D188_Select)
+        elif unit['mode'] in (2, 3):
+            self.Select(unit, self.Decode(unit))
+        else:
+            self.Select(unit, 0)
+        return ERROR_SUCCESS
+
+    def Fill(self, unit, device_state):
+        device_state.D188_DeviceID = unit['serial']
+        device_state.D188_VersionID = unit['version']
+        device_state.D188_Error = ERROR_SUCCESS
+        state = device_state.D188_State
+        state.D188_Mode = unit['mode']
+        state.D188_Select = unit['select']
+        state.D188_Indicator = unit['indicator']
+        state.D188_Delay = unit['delay']
+
+    def Decode(self, unit):
+        '''
+        Select mask corresponding to the digital inputs in the current TTL mode.
+        '''
+        ttl = unit['ttl']
+        if unit['mode'] == 2:                   # 1:1, more than one input high disables all outputs
+            return ttl if ttl & (ttl - 1) == 0 else 0
+        channel = ttl & 0x0F                    # 4:8 binary
+        return 1 << (channel - 1) if 1 <= channel <= 8 else 0
+
+    def Select(self, unit, select):
+        if select != unit['select']:
+            unit['select'] = select
+            unit['switches'].append((time.perf_counter(), self.Channel(select)))
+
+    def Channel(self, select):
+        return select.bit_length()
+
+    def SetTTL(self, bits, index=0):
+        '''
+        Drive the rear panel digital inputs (bit 0 = pin 1).
+        '''
+        with self.lock:
+            unit = self.units[index]
+            unit['ttl'] = bits
+            if unit['mode'] in (2, 3):
+                self.Select(unit, self.Decode(unit))
+
+    def ActiveChannel(self, index=0):
+        return self.Channel(self.units[index]['select'])
@@ -0,0 +1,173 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Background telemetry of the DS8R counters (CPULSE, COOC, CTOOFAST) and fault flags (FSTATE)
+import threading
+import time
+import numpy as np
+from API.ds8r_controller import DS8RController
+from API.session import RECOVERABLE_ERRORS
+
+# ------------------------------------------------------------------------------
+# One telemetry sample
+SAMPLE = np.dtype([
+    ('time', 'f8'),             # perf_counter [s]
+    ('cpulse', 'u4'),           # Pulses delivered since the output was enabled
+    ('cooc', 'u4'),             # Pulses out of compliance since the output was enabled
+    ('ctoofast', 'u4'),         # Triggers ignored because too fast since the output was enabled
+    ('overenergy', '?'),
+    ('hwerror', '?'),
+    ('enable', '?'),
+    ('error', 'i4'),            # Result of the DLL call, the other fields are not valid if not 0
+])
+COUNTERS = ('cpulse', 'cooc', 'ctoofast')
+FLAGS = ('overenergy', 'hwerror')
+
+# ------------------------------------------------------------------------------
+# Declare telemetry classes
+class TelemetryPoller:
+    '''
+    Polls the DS8R state on a background thread through its own DLL session, so the command traffic of the
+    experiment (session.stimulator) is neither locked nor delayed by the polling.
+    The samples are stored in a preallocated NumPy ring buffer, and the alarms are checked on the polling thread
+    right after each sample, i.e. they fire within one poll interval.
+    DGHost serves the state at 10 Hz at most, faster polling returns repeated samples.
+        poller = TelemetryPoller(interval=0.1)
+        poller.AddAlarm('cooc', lambda field, sample, increase: print('Out of compliance!'))
+        poller.Start()
+    '''
+    def __init__(self, interval=0.1, capacity=36000, deviceID=0, backend=None):
+        '''
+        Args:
+            interval (float): poll interval [s]
+            capacity (int): number of samples kept in the ring buffer (1 hour at 10 Hz by default)
+            deviceID (int): device ID of the polled DS8R, 0 for the first connected one
+            backend: backend of the controller (see API/backend.py)
+        '''
+        self.interval = interval
+        self.samples = np.zeros(capacity, dtype=SAMPLE)
+        self.count = 0                      # Number of samples taken, the last one is at (count - 1) % capacity
+        self.alarms = []
+        self.last = None                    # Last valid sample, reference of the alarms
+        self.controller = DS8RController(backend)
+        self.controller.SelectDevice(deviceID)
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def AddAlarm(self, field, callback, above=0):
+        '''
+        Call callback(field, sample, increase) from the polling thread when
+        - a counter ('cpulse', 'cooc', 'ctoofast') increased by more than above since the previous sample
+          (the counters are reset when the output is enabled again)
+        - a flag ('overenergy', 'hwerror') is set
+        '''
+        if field not in COUNTERS + FLAGS:
+            raise ValueError(f'Unknown telemetry field: {field}')
+        self.alarms.append((field, callback, above))
+
+    def Start(self):
+        '''
+        Open the polling session and start the polling thread.
+        Returns:
+            bool: True if the poller is running
+        '''
+        if self.thread is not None:
+            return True
+        self.controller.Initialise()
+        if self.controller.retError.value or self.controller.retAPIError.value:
+            print(f'ERROR! Telemetry initialisation failed: {self.controller.retError.value or self.controller.retAPIError.value}')
+            self.controller.Close()                 # Free the session reference the DLL may have allocated
+            return False
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.Loop, name='ds8r-telemetry', daemon=True)
+        self.thread.start()
+        return True
+
+    def Stop(self):
+        if self.thread is None:
+            return
+        self.stopEvent.set()
+        self.thread.join()
+        self.thread = None
+        self.controller.Close()
+
+    def __enter__(self):
+        self.Start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Stop()
+
+    def Loop(self):
+        deadline = time.perf_counter()
+        while not self.stopEvent.is_set():
+            self.Poll()
+            deadline += self.interval
+            delay = deadline - time.perf_counter()
+            if delay < 0:                               # Late (slow DLL call): skip the missed polls
+                deadline = time.perf_counter()
+                delay = 0
+            self.stopEvent.wait(delay)
+
+    def Poll(self):
+        '''
+        Take one sample into the ring buffer and check the alarms.
+        '''
+        controller = self.controller
+        error = controller.UpdateGet() or controller.retAPIError.value
+        if error in RECOVERABLE_ERRORS:                 # Session lost: open a new one for the next poll
+            controller.Close()
+            controller.Initialise()
+        state = controller.shadow.D128_State
+        with self.lock:
+            index = self.count % len(self.samples)
+            if error:
+                self.samples[index] = (time.perf_counter(), 0, 0, 0, False, False, False, error)
+            else:
+                self.samples[index] = (time.perf_counter(), state.CPULSE, state.COOC, state.CTOOFAST,
+                                       state.FSTATE.OVERENERGY, state.FSTATE.HWERROR, state.CONTROL.ENABLE == 1, 0)
+            self.count += 1
+        if not error:
+            sample = self.samples[index].copy()
+            if self.alarms:
+                self.Check(self.last, sample)
+            self.last = sample
+
+    def Check(self, previous, sample):
+        '''
+        Fire the alarms raised by sample, compared to the previous valid sample (None for the first one).
+        '''
+        for field, callback, above in self.alarms:
+            if field in FLAGS:
+                increase = int(sample[field] and (previous is None or not previous[field]))
+            elif previous is None or sample[field] < previous[field]:  # Counters reset by a new enable
+                increase = int(sample[field])
+            else:
+                increase = int(sample[field]) - int(previous[field])
+            if increase > above:
+                try:
+                    callback(field, sample, increase)
+                except Exception as e:
+                    print(f'ERROR! Telemetry alarm on {field} failed: {e}')
+
+    def Latest(self):
+        '''
+        Returns:
+            numpy record: last sample (None if no sample was taken)
+        '''
+        with self.lock:
+            if self.count == 0:
+                return None
+            return self.samples[(self.count - 1) % len(self.samples)].copy()
+
+    def History(self, n=None):
+        '''
+        Returns:
+            numpy array of SAMPLE: the last n samples (all the kept samples by default), oldest first
+        '''
+        with self.lock:
+            kept = min(self.count, len(self.samples))
+            n = kept if n is None else min(n, kept)
+            end = self.count % len(self.samples)
+            indices = np.arange(end - n, end) % len(self.samples)
+            return self.samples[indices]
@@ -0,0 +1,174 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Serial transport to the trigger board: port auto-discovery, readiness handshake, one shared connection
+import atexit
+import os
+import threading
+import time
+import serial
+from serial.tools import list_ports
+from API.instrumentation import instrument_serial
+from API.trigger_protocol import TriggerLink, OP_PING
+
+BAUDRATE = 115200
+BANNER = 'init succeed'     # Printed by the sketches at the end of setup()
+READY_TIMEOUT = 3.0         # Maximum wait for the banner after opening the port (the board resets on open) [s]
+PING_TIMEOUT = 0.3          # Handshake of a board that did not reset [s]
+
+# USB (VID, PID) of the boards used as trigger board, None matches any PID of the vendor
+USB_IDS = {
+    (0x2341, None): 'Arduino',
+    (0x2A03, None): 'Arduino',
+    (0x1A86, 0x7523): 'CH340',
+    (0x0403, 0x6001): 'FTDI',
+}
+
+# ------------------------------------------------------------------------------
+# Port discovery
+def find_ports(usb_ids=USB_IDS):
+    '''
+    List the serial ports that may be a trigger board.
+    Returns:
+        list of string: port names, the ones with a known USB VID/PID first, then the other USB serial ports
+    '''
+    known, others = [], []
+    for port in sorted(list_ports.comports(), key=lambda port: port.device):
+        if port.vid is None:
+            continue
+        if (port.vid, port.pid) in usb_ids or (port.vid, None) in usb_ids:
+            known.append(port.device)
+        else:
+            others.append(port.device)
+    return known + others
+
+# ------------------------------------------------------------------------------
+# Declare transport classes
+class TriggerTransport:
+    '''
+    One open connection to the trigger board (serial port + TriggerLink).
+    The board is found by USB VID/PID, or by probing the USB serial ports for a handshake reply, when no port is
+    given. The link is ready as soon as the banner of the firmware arrives (the board resets when the port is
+    opened) or, for a board that did not reset, as soon as it answers a ping, instead of a blind sleep.
+        transport = TriggerTransport()
+        if transport.Open():
+            transport.link.TriggerN(15, 10)
+    '''
+    def __init__(self, port=None, firmware=None, baudrate=BAUDRATE):
+        '''
+        Args:
+            port (string): serial port, e.g. 'COM5' (None: auto-discovery)
+            firmware (int or tuple of int): accepted firmware ids (1 Calibration_trigger, 2 TENS_controller), None: any
+            baudrate (int)
+        '''
+        self.port = port
+        self.firmware = (firmware,) if isinstance(firmware, int) else firmware
+        self.baudrate = baudrate
+        self.uC = None
+        self.link = None
+        self.firmwareID = None
+        self.readyTime = None           # From opening the port to the link ready [s]
+        self.banner = threading.Event()
+        self.lock = threading.RLock()
+
+    def __repr__(self):
+        state = f'firmware {self.firmwareID}, ready in {self.readyTime:.3f} s' if self.IsOpen() else 'closed'
+        return f'TriggerTransport({self.port}, {state})'
+
+    def IsOpen(self):
+        return self.link is not None and self.uC.is_open
+
+    def OnText(self, line):
+        if line == BANNER:
+            self.banner.set()
+        elif line:
+            print(f'Trigger board: {line}')
+
+    def Open(self, timeout=READY_TIMEOUT):
+        '''
+        Connect to the given port, or to the first discovered board. Does nothing if already open.
+        Returns:
+            bool: True if the link is ready
+        '''
+        with self.lock:
+            if self.IsOpen():
+                return True
+            ports = [self.port] if self.port else find_ports()
+            for port in ports:
+                if self.Connect(port, timeout):
+                    return True
+            print(f'ERROR! No trigger board found on {ports}')
+            return False
+
+    def Connect(self, port, timeout=READY_TIMEOUT):
+        '''
+        Open one port and wait for the board to be ready.
+        Returns:
+            bool: True if a board with an accepted firmware answered
+        '''
+        start = time.perf_counter()
+        try:
+            uC = instrument_serial(serial.Serial(port, self.baudrate, timeout=0.1))
+        except serial.SerialException as e:
+            print(f'ERROR! Serial error on {port}: {e}')
+            return False
+        self.banner.clear()
+        link = TriggerLink(uC, on_text=self.OnText)
+        if not self.banner.wait(PING_TIMEOUT):                  # Still booting, or the board did not reset on open
+            firmwareID = self.Handshake(link)
+            if firmwareID is None and self.banner.wait(max(0, timeout - (time.perf_counter() - start))):
+                firmwareID = self.Handshake(link)
+        else:
+            firmwareID = self.Handshake(link)
+        if firmwareID is None or (self.firmware is not None and firmwareID not in self.firmware):
+            if firmwareID is not None:
+                print(f'ERROR! Firmware {firmwareID} on {port}, expected {self.firmware}')
+            link.Close()
+            uC.close()
+            return False
+        self.port, self.uC, self.link, self.firmwareID = port, uC, link, firmwareID
+        self.readyTime = time.perf_counter() - start
+        return True
+
+    def Handshake(self, link):
+        '''
+        Returns:
+            int: firmware id answered to a ping, None if no answer
+        '''
+        pending = link.Send(OP_PING)
+        return pending.result if pending.Wait('done', PING_TIMEOUT) else None
+
+    def Close(self):
+        '''
+        Stop the link and close the serial port.
+        '''
+        with self.lock:
+            if self.link is not None:
+                self.link.Close()
+            if self.uC is not None and self.uC.is_open:
+                self.uC.close()
+            self.link = None
+            self.uC = None
+
+    def __enter__(self):
+        self.Open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+        return False
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport():
+    '''
+    Return the trigger board connection shared by all the windows of the process. The port is taken from the
+    TTENS_PORT environment variable, or discovered. It is closed automatically when the interpreter exits.
+    '''
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = TriggerTransport(os.environ.get('TTENS_PORT'))
+            atexit.register(_transport.Close)
+        return _transport
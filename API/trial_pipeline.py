@@ -0,0 +1,106 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Pipelined trials: the next stimulus is prepared on the hardware while the subject answers
+
+# ------------------------------------------------------------------------------
+# Declare pipeline classes
+class TrialPipeline:
+    '''
+    Between two stimulations the DS8R output is disabled, so the channel of the D188 and the variable parameter
+    of the DS8R can be written while the subject is still answering. The experiment window gives the next
+    stimulus for each possible answer once the stimulation is over (Prepare) and the one of the answer entered
+    so far each time it changes (Stage). When the answer is committed the stimulation still sends the channel and the
+    value with the enable, but the shadow copies of the devices drop the writes that already landed.
+        pipeline = TrialPipeline(scheduler, 'demand')
+        pipeline.Prepare([(1, 2.25), (1, 2.75)])       # both answers stay on channel 1: channel staged
+        pipeline.Stage(1, 2.75)                         # answer entered: demand staged
+        pipeline.Commit(1, 2.75)                        # True if both staged writes landed
+    The commands are queued without waiting (scheduler.Submit) and a newer staging of the same setter replaces a
+    pending one, so changing the answer several times costs at most one write per device. A staged write that was
+    refused, failed or was cancelled is staged again and is not counted as a hit.
+    '''
+    def __init__(self, scheduler, variable, stimulator='DS8R', selector='D188'):
+        '''
+        Args:
+            scheduler (HardwareScheduler): owner of the devices
+            variable (string): variable parameter of the DS8R (variable_param['variable'])
+            stimulator, selector (string): names of the devices in the scheduler
+        '''
+        self.scheduler = scheduler
+        self.variable = variable
+        self.stimulator = stimulator
+        self.selector = selector
+        self.candidates = []
+        self.channel = None             # Staged channel
+        self.value = None               # Staged value of the variable parameter
+        self.channelWrite = None        # Future of the staged writes, None once written by the stimulation
+        self.valueWrite = None
+        self.commits = 0
+        self.hits = 0
+
+    @staticmethod
+    def Landed(write):
+        '''
+        Returns:
+            bool: True if the staged write completed and the device accepted it (Configure returned True)
+        '''
+        if write is None:
+            return True
+        return write.done() and not write.cancelled() and write.exception() is None and write.result() is True
+
+    @staticmethod
+    def Failed(write):
+        return write is not None and write.done() and not TrialPipeline.Landed(write)
+
+    def StageChannel(self, channel):
+        if channel is not None and (channel != self.channel or self.Failed(self.channelWrite)):
+            self.channelWrite = self.scheduler.Submit(self.selector, 'Configure', channel=channel)
+            self.channel = channel
+
+    def StageValue(self, value):
+        if value is not None and (value != self.value or self.Failed(self.valueWrite)) and self.variable != 'frequency':    # The frequency is set by the trigger
+            self.valueWrite = self.scheduler.Submit(self.stimulator, 'Configure', **{self.variable: value})
+            self.value = value
+
+    def Prepare(self, candidates):
+        '''
+        Call once the output is disabled after a stimulation. Stages what every possible answer has in common.
+        Args:
+            candidates (list of tuple): (channel, stimulus) for each possible answer, stimulus None if finished
+        '''
+        self.candidates = [(channel, stimulus) for channel, stimulus in candidates if stimulus is not None]
+        channels = {channel for channel, _ in self.candidates}
+        values = {stimulus for _, stimulus in self.candidates}
+        if len(channels) == 1:
+            self.StageChannel(channels.pop())
+        if len(values) == 1:
+            self.StageValue(values.pop())
+
+    def Stage(self, channel, stimulus):
+        '''
+        Stage the next stimulus of the answer entered so far (the output must be disabled).
+        '''
+        if stimulus is not None:
+            self.StageChannel(channel)
+            self.StageValue(stimulus)
+
+    def Commit(self, channel, stimulus):
+        '''
+        Answer committed.
+        Returns:
+            bool: True if channel and stimulus were staged and both writes landed on the devices
+        '''
+        self.commits += 1
+        hit = (channel == self.channel and self.Landed(self.channelWrite)
+               and (self.variable == 'frequency' or (stimulus == self.value and self.Landed(self.valueWrite))))
+        self.hits += hit
+        self.channel, self.value = channel, stimulus                # Written by the stimulation in any case
+        self.channelWrite = self.valueWrite = None
+        return hit
+
+    def HitRate(self):
+        '''
+        Returns:
+            float: fraction of the committed answers whose stimulus was already staged (None before the first one)
+        '''
+        return self.hits / self.commits if self.commits else None
@@ -0,0 +1,199 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Trial plans: compile a multi-parameter grid into an ordered trial list with the least device reconfiguration
+import random
+from itertools import product, permutations
+from API.instrumentation import get_recorder
+
+# ------------------------------------------------------------------------------
+# Parameters written to the DS8R (one DGD128_Update per trial whatever the number of changed fields)
+DS8R_FIELDS = ('mode', 'polarity', 'source', 'demand', 'pulsewidth', 'dwell', 'recovery')
+CHANNEL = 'channel'                 # D188 output, one DGD188_Update per switch
+SWITCH_COST = 2                     # Default cost of a channel switch in DS8R writes, see measured_switch_cost
+RANDOMISE = ('channels', 'values', 'full')
+
+# ------------------------------------------------------------------------------
+# Declare trial plan classes
+class Trial:
+    '''
+    One trial of a plan.
+    Attributes:
+        index (int): position in the plan
+        repetition (int)
+        params (dict): full parameter set of the trial
+        delta (dict): DS8R fields that differ from the previous trial, i.e. the exact Configure to send
+        channel: D188 channel of the trial (None if the grid has no channel)
+        switch (bool): True if the channel differs from the previous trial
+        changed (set): every parameter that differs from the previous trial (DS8R, channel, uC, ...)
+    '''
+    def __init__(self, index, repetition, params, previous):
+        self.index = index
+        self.repetition = repetition
+        self.params = params
+        self.changed = {key for key, value in params.items() if key not in previous or previous[key] != value}
+        self.delta = {key: params[key] for key in DS8R_FIELDS if key in self.changed}
+        self.channel = params.get(CHANNEL)
+        self.switch = CHANNEL in self.changed
+
+    def __repr__(self):
+        return f'Trial({self.index}, {self.params}, delta={self.delta}, switch={self.switch})'
+
+
+def measured_switch_cost(selector=None, settle=0.0, recorder=None, default=SWITCH_COST):
+    '''
+    Cost of a channel switch in DS8R writes from the latencies measured on this workstation: mean duration of the
+    D188 switches (selector.SwitchLatency(), or the DGD188_Update histogram) plus the settling delay, divided by
+    the mean DGD128_Update of the latency recorder (TTENS_LATENCY).
+        plan = compile_plan(grid, switch_cost=measured_switch_cost(session.selector, settle=delay))
+    Args:
+        selector: D188Controller or TTLSelector that already switched channel in this session
+        settle (float): delay after a switch before stimulating [ms], e.g. the D188 de-bounce delay
+        recorder (LatencyRecorder): defaults to the process-wide recorder
+        default (float): returned if one of the latencies was not measured
+    Returns:
+        float
+    '''
+    recorder = recorder or get_recorder()
+    summary = recorder.Summary()
+    switch = selector.SwitchLatency()['mean'] if selector is not None else None
+    if switch is None and summary.get('DGD188_Update', {}).get('count'):
+        switch = summary['DGD188_Update']['mean'] / 1000
+    write = summary['DGD128_Update']['mean'] / 1000 if summary.get('DGD128_Update', {}).get('count') else None
+    if switch is None or not write:
+        return default
+    return (switch + settle) / write
+
+def transition_cost(previous, params, switch_cost=SWITCH_COST):
+    '''
+    Reconfiguration cost between two parameter sets: a channel switch weighs switch_cost, each changed DS8R field 1.
+    '''
+    fields = sum(previous.get(key) != params[key] for key in DS8R_FIELDS if key in params)
+    switch = CHANNEL in params and previous.get(CHANNEL) != params[CHANNEL]
+    return switch_cost * switch + fields
+
+def serpentine(dims):
+    '''
+    Reflected mixed-radix Gray code: all the combinations of the values of dims (list of (key, values),
+    outermost first), ordered so that consecutive combinations differ in a single parameter.
+    '''
+    if not dims:
+        return [{}]
+    (key, values), rest = dims[0], dims[1:]
+    inner = serpentine(rest)
+    order = []
+    for i, value in enumerate(values):
+        for combination in (inner if i % 2 == 0 else reversed(inner)):
+            order.append({key: value, **combination})
+    return order
+
+def dimension_order(grid, switch_cost=SWITCH_COST):
+    '''
+    Order of the dimensions of the serpentine, outermost first.
+    In a reflected Gray code the dimension at position i changes (n_1 * ... * n_(i-1)) * (n_i - 1) times, so the
+    device dimensions (channel and DS8R fields) are ordered to minimise the weighted number of changes, and the
+    parameters that need no device write (frequency, duration, ...) go innermost where their changes are free.
+    '''
+    keys = list(grid.keys())
+    device = [key for key in keys if key == CHANNEL or key in DS8R_FIELDS]
+    free = [key for key in keys if key not in device]
+
+    def cost(order):
+        total, outer = 0, 1
+        for key in order:
+            n = len(grid[key])
+            total += (switch_cost if key == CHANNEL else 1) * outer * (n - 1)
+            outer *= n
+        return total
+
+    best = None
+    for order in permutations(device):
+        if best is None or cost(order) < cost(best):
+            best = order
+    return list(best) + free
+
+def compile_plan(grid, fixed=None, repetitions=1, randomise=(), seed=None, initial=None, switch_cost=SWITCH_COST):
+    '''
+    Compile a multi-parameter grid into an ordered trial list with the fewest D188 switches and changed DS8R
+    fields between consecutive trials.
+    Args:
+        grid (dict): {parameter: list of values}, e.g. {'demand': [1, 1.5, 2], 'pulsewidth': [50, 100], 'channel': [1, 2, 3]}
+                     The parameters can be DS8R fields, 'channel' or anything else sent to the uC ('frequency', ...)
+        fixed (dict): parameters common to all the trials
+        repetitions (int): number of passes over the grid, each pass contains every combination once
+        randomise (tuple): randomisation constraints, any of
+                           'channels': random order of the channels
+                           'values': random order of the values of each parameter (consecutive trials still differ
+                                     in one parameter)
+                           'full': every pass fully shuffled (no ordering optimisation)
+        seed (int): seed of the randomisation, for reproducible plans
+        initial (dict): parameters already on the devices before the first trial
+        switch_cost (float): cost of a channel switch in DS8R writes, e.g. measured_switch_cost(session.selector)
+    Returns:
+        list of Trial
+    '''
+    unknown = set(randomise) - set(RANDOMISE)
+    if unknown:
+        raise ValueError(f'Unknown randomisation: {unknown}')
+    fixed = dict(fixed or {})
+    rng = random.Random(seed)
+    keys = dimension_order(grid, switch_cost)
+
+    order = []
+    previous = dict(initial or {})
+    for repetition in range(repetitions):
+        dims = []
+        for key in keys:
+            values = list(grid[key])
+            if ('values' in randomise and key != CHANNEL) or ('channels' in randomise and key == CHANNEL):
+                rng.shuffle(values)
+            dims.append((key, values))
+        if 'full' in randomise:
+            block = [dict(zip(keys, values)) for values in product(*(values for key, values in dims))]
+            rng.shuffle(block)
+        else:
+            block = serpentine(dims)
+            if order and transition_cost(previous, {**fixed, **block[-1]}, switch_cost) < transition_cost(previous, {**fixed, **block[0]}, switch_cost):
+                block.reverse()                 # Continue from where the previous pass ended
+        for combination in block:
+            params = {**fixed, **combination}
+            order.append(Trial(len(order), repetition, params, previous))
+            previous = params
+    return order
+
+def plan_cost(trials):
+    '''
+    Returns:
+        dict: number of trials, D188 switches, DS8R writes (trials with a non-empty delta) and changed DS8R fields
+    '''
+    return {
+        'trials': len(trials),
+        'switches': sum(trial.switch for trial in trials),
+        'ds8r_updates': sum(bool(trial.delta) for trial in trials),
+        'ds8r_fields': sum(len(trial.delta) for trial in trials),
+    }
+
+def apply_trial(trial, stimulator, selector=None):
+    '''
+    Send only the delta of a trial: one SetChannel if the channel changed, one Configure if DS8R fields changed.
+    Args:
+        trial (Trial)
+        stimulator: DS8RController, session.stimulator or scheduler proxy
+        selector: D188Controller, session.selector or scheduler proxy (None if the plan has no channel)
+    '''
+    if trial.switch and selector is not None:
+        selector.SetChannel(trial.channel)
+    if trial.delta:
+        stimulator.Configure(**trial.delta)
+
+
+if __name__ == "__main__":
+    grid = {'demand': [1, 1.5, 2, 2.5], 'pulsewidth': [50, 100, 200], 'channel': [1, 2, 3], 'frequency': [15, 30]}
+    previous = {}
+    naive = []
+    for values in product(*grid.values()):
+        params = dict(zip(grid.keys(), values))
+        naive.append(Trial(len(naive), 0, params, previous))
+        previous = params
+    print('Naive grid order:', plan_cost(naive))
+    print('Optimised plan:  ', plan_cost(compile_plan(grid, repetitions=1)))
+    print('Randomised plan: ', plan_cost(compile_plan(grid, randomise=('channels', 'values'), seed=0)))
@@ -0,0 +1,72 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Timing of one stimulation trial: completion signals with per-step timeouts, safety margins from a config
+import json
+import os
+import time
+
+# ------------------------------------------------------------------------------
+# Safety margins and timeouts of a trial [s]. Overridden by the JSON file given by the TTENS_TIMING environment variable
+TIMING = {
+    'enable_timeout': 1.0,      # Maximum wait for the DS8R state readback to show the output enabled
+    'enable_settle': 0.05,      # After the output is enabled, before the first trigger
+    'ack_timeout': 0.5,         # Maximum wait for the uC acknowledgement of the trigger command
+    'done_margin': 0.5,         # On top of the expected train duration before giving up on the completion frame
+    'post_train': 0.05,         # After the completion, before disabling the output (last pulse delivered)
+    'poll_interval': 0.02,      # Between two DS8R state readbacks while waiting
+}
+
+def load_timing(path=None):
+    '''
+    Update TIMING with the values of a JSON file.
+    Args:
+        path (string): defaults to the TTENS_TIMING environment variable, nothing is loaded if not set
+    Returns:
+        dict: TIMING
+    '''
+    path = path or os.environ.get('TTENS_TIMING')
+    if path:
+        try:
+            with open(path) as file:
+                values = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f'ERROR! Could not load the trial timing from {path}: {e}')
+        else:
+            unknown = set(values) - set(TIMING)
+            if unknown:
+                print(f'ERROR! Unknown trial timing entries ignored: {unknown}')
+            TIMING.update({key: float(value) for key, value in values.items() if key in TIMING})
+    return TIMING
+
+load_timing()
+
+def train_duration(freq, duration, numTriggers):
+    '''
+    Expected duration of the train sent to the uC [s].
+    Args:
+        freq (float): [Hz]
+        duration (float): [ms], used if not 0 (triggerD)
+        numTriggers (int): used if duration is 0 (triggerN)
+    '''
+    if duration:
+        return duration * 1e-3
+    return numTriggers / freq
+
+def wait_enabled(ds8r, timeout=None):
+    '''
+    Wait until the DS8R state reports the output enabled. The state returned by the enabling write is checked
+    first, then the device is read back every TIMING['poll_interval'].
+    Args:
+        ds8r: DS8RController or session.stimulator
+        timeout (float): [s], defaults to TIMING['enable_timeout']
+    Returns:
+        bool: True if the output is enabled
+    '''
+    deadline = time.perf_counter() + (TIMING['enable_timeout'] if timeout is None else timeout)
+    while True:
+        if ds8r.Cached('enable') == ds8r.DS8REnabled[True]:
+            return True
+        if time.perf_counter() >= deadline:
+            return False
+        time.sleep(TIMING['poll_interval'])
+        ds8r.Refresh()
@@ -0,0 +1,380 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Framed binary protocol between the host and the trigger microcontroller (Calibration_trigger, TENS_controller)
+import struct
+import threading
+import time
+
+'''
+Frame: SYNC | LEN | OPCODE | SEQ | PAYLOAD (LEN bytes) | CRC16
+- SYNC: 0xA5
+- LEN: payload length (at most MAX_PAYLOAD)
+- SEQ: sequence number of the command, echoed by its replies
+- CRC16: CRC-16/CCITT-FALSE of LEN, OPCODE, SEQ and PAYLOAD, little endian
+Integers of the payloads are little endian. Every command is answered by an ACK frame (opcode, status) as soon as
+it is received, then by a DONE frame (opcode, 32 bits result) once it is completed. A running schedule also sends
+an EVENT frame (opcode, 16 bits index, 32 bits result) after each of its trains.
+Bytes received outside frames are text lines (boot messages such as "init succeed").
+'''
+SYNC = 0xA5
+MAX_PAYLOAD = 16
+
+# Commands: opcode -> (name, payload format)
+OP_TRIGGER_D = 0x01         # freq [Hz], duration [ms]. DONE: expected number of pulses
+OP_TRIGGER_N = 0x02         # freq [Hz], number of triggers. DONE: pulses emitted
+OP_TRAIN = 0x03             # freq [Hz], pulses per burst, bursts, burst interval [ms]. DONE: pulses emitted
+OP_START = 0x04             # freq [Hz], continuous until OP_STOP. DONE once started
+OP_STOP = 0x05
+OP_AMP = 0x06               # DAC output [mV]
+OP_PING = 0x07              # DONE: firmware id (1 Calibration_trigger, 2 TENS_controller)
+OP_SCHED_CLEAR = 0x08       # Empty the schedule
+OP_SCHED_ADD = 0x09         # freq [Hz], pulses, interval [ms] start to start, DAC [mV] (DAC_UNCHANGED). DONE: trains stored
+OP_SCHED_RUN = 0x0A         # Run the schedule on the board timer. EVENT per train: pulses emitted. DONE: trains run
+OP_CHANNEL = 0x0B           # D188 channel on the TTL lines (4TTL mode, 0 all off), settle [us]. DONE: channel, once active
+OP_CHANNEL_TRIGGER_N = 0x0C # channel, settle [us], freq [Hz], number of triggers. DONE: pulses emitted
+COMMANDS = {
+    OP_TRIGGER_D: ('triggerD', '<HH'),
+    OP_TRIGGER_N: ('triggerN', '<HH'),
+    OP_TRAIN: ('train', '<HHHH'),
+    OP_START: ('start', '<H'),
+    OP_STOP: ('stop', ''),
+    OP_AMP: ('amp', '<H'),
+    OP_PING: ('ping', ''),
+    OP_SCHED_CLEAR: ('sched_clear', ''),
+    OP_SCHED_ADD: ('sched_add', '<HHHH'),
+    OP_SCHED_RUN: ('sched_run', ''),
+    OP_CHANNEL: ('channel', '<HH'),
+    OP_CHANNEL_TRIGGER_N: ('channel_triggerN', '<HHHH'),
+}
+MAX_TRAINS = 32             # Schedule length of the sketches
+DAC_UNCHANGED = 0xFFFF
+
+# Replies
+OP_ACK = 0x80               # opcode, status
+OP_DONE = 0x81              # opcode, result (uint32)
+OP_EVENT = 0x82             # opcode, index (uint16), result (uint32)
+STATUS_OK = 0
+STATUS_BAD_CRC = 1
+STATUS_UNKNOWN_OPCODE = 2
+STATUS_BAD_LENGTH = 3
+STATUS_FULL = 4             # Schedule full
+STATUS_BUSY = 5             # Refused while a schedule runs
+STATUS_NAMES = {STATUS_OK: 'ok', STATUS_BAD_CRC: 'bad CRC', STATUS_UNKNOWN_OPCODE: 'unknown opcode', STATUS_BAD_LENGTH: 'bad length',
+                STATUS_FULL: 'schedule full', STATUS_BUSY: 'busy'}
+
+# ------------------------------------------------------------------------------
+# Codec
+def crc16(data, crc=0xFFFF):
+    '''
+    CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF), as computed by the sketches.
+    '''
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+            crc &= 0xFFFF
+    return crc
+
+def encode(opcode, seq, payload=b''):
+    '''
+    Returns:
+        bytes: the frame
+    '''
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f'Payload of {len(payload)} bytes, at most {MAX_PAYLOAD}')
+    body = bytes((len(payload), opcode, seq & 0xFF)) + payload
+    return bytes((SYNC,)) + body + struct.pack('<H', crc16(body))
+
+def encode_command(opcode, seq, *params):
+    '''
+    Frame of a command of COMMANDS with its integer parameters.
+    '''
+    name, fmt = COMMANDS[opcode]
+    try:
+        payload = struct.pack(fmt, *(int(round(param)) for param in params)) if fmt else b''
+    except struct.error as e:
+        raise ValueError(f'Invalid parameters for {name}: {params} ({e})')
+    return encode(opcode, seq, payload)
+
+
+class Frame:
+    def __init__(self, opcode, seq, payload):
+        self.opcode = opcode
+        self.seq = seq
+        self.payload = payload
+
+    def __repr__(self):
+        return f'Frame(0x{self.opcode:02X}, seq={self.seq}, payload={self.payload.hex()})'
+
+    def Ack(self):
+        '''
+        Returns:
+            (int, int): acknowledged opcode and status of an ACK frame
+        '''
+        return self.payload[0], self.payload[1]
+
+    def Done(self):
+        '''
+        Returns:
+            (int, int): completed opcode and result of a DONE frame
+        '''
+        return self.payload[0], struct.unpack_from('<I', self.payload, 1)[0]
+
+    def Event(self):
+        '''
+        Returns:
+            (int, int, int): opcode, index and result of an EVENT frame
+        '''
+        index, result = struct.unpack_from('<HI', self.payload, 1)
+        return self.payload[0], index, result
+
+
+class FrameDecoder:
+    '''
+    Incremental decoder: Feed() the received bytes, get the complete frames and text lines back.
+    Frames with a wrong CRC are dropped (counted in errors) and the decoder resynchronises on the next SYNC.
+    '''
+    def __init__(self):
+        self.buffer = bytearray()
+        self.text = bytearray()
+        self.errors = 0
+
+    def Feed(self, data):
+        '''
+        Returns:
+            (list of Frame, list of string): frames and text lines completed by data
+        '''
+        self.buffer += data
+        frames, lines = [], []
+        while self.buffer:
+            if self.buffer[0] != SYNC:
+                byte = self.buffer.pop(0)
+                if byte == 0x0A:
+                    lines.append(self.text.decode(errors='replace').strip())
+                    self.text.clear()
+                else:
+                    self.text.append(byte)
+                continue
+            if len(self.buffer) < 2:
+                break
+            length = self.buffer[1]
+            if length > MAX_PAYLOAD:
+                self.errors += 1
+                del self.buffer[0]
+                continue
+            if len(self.buffer) < length + 6:
+                break
+            body = bytes(self.buffer[1:length + 4])
+            crc = struct.unpack_from('<H', self.buffer, length + 4)[0]
+            if crc != crc16(body):
+                self.errors += 1
+                del self.buffer[0]
+                continue
+            frames.append(Frame(body[1], body[2], body[3:]))
+            del self.buffer[:length + 6]
+        return frames, lines
+
+# ------------------------------------------------------------------------------
+# Declare link classes
+class Pending:
+    '''
+    Command sent and waiting for its replies. ack and done are set when the ACK and DONE frames arrive,
+    the EVENT frames are appended to events as (index, result, time) and passed to on_event.
+    '''
+    def __init__(self, opcode, seq, on_event=None):
+        self.opcode = opcode
+        self.seq = seq
+        self.sent = time.perf_counter()
+        self.ack = threading.Event()
+        self.done = threading.Event()
+        self.status = None
+        self.result = None
+        self.ackTime = None
+        self.doneTime = None
+        self.events = []
+        self.on_event = on_event
+
+    def __repr__(self):
+        name = COMMANDS[self.opcode][0]
+        return f'Pending({name}, seq={self.seq}, status={STATUS_NAMES.get(self.status)}, result={self.result})'
+
+    def Wait(self, what='done', timeout=None):
+        '''
+        Wait for the ACK ('ack') or for the completion ('done').
+        Returns:
+            bool: True if the reply arrived and the command was accepted
+        '''
+        if not self.ack.wait(timeout):
+            return False
+        if self.status != STATUS_OK:
+            return False
+        if what == 'ack':
+            return True
+        remaining = None if timeout is None else max(0, timeout - (time.perf_counter() - self.sent))
+        return self.done.wait(remaining)
+
+
+class TriggerLink:
+    '''
+    Framed link to the trigger microcontroller over an open serial port (serial.Serial).
+    A reader thread decodes the replies and sets the events of the pending commands, so waiting for an
+    acknowledgement or a completion is event-driven instead of a fixed sleep.
+        link = TriggerLink(uC)
+        link.TriggerN(15, 10, wait='done', timeout=2)
+    Each command method returns its Pending (wait=None), or waits for 'ack' or 'done' first.
+    '''
+    def __init__(self, port, on_text=None):
+        '''
+        Args:
+            port: open serial port (read/write, timeout set so that read returns regularly)
+            on_text (callable): called with every text line received (boot messages, legacy replies)
+        '''
+        self.port = port
+        self.on_text = on_text
+        self.decoder = FrameDecoder()
+        self.pending = {}
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.Reader, name='trigger-link', daemon=True)
+        self.thread.start()
+
+    def Reader(self):
+        while self.running:
+            try:
+                data = self.port.read(max(1, getattr(self.port, 'in_waiting', 0)))
+            except Exception as e:
+                if self.running:
+                    print(f'ERROR! Trigger link read failed: {e}')
+                return
+            if not data:
+                continue
+            frames, lines = self.decoder.Feed(data)
+            for line in lines:
+                if self.on_text is not None:
+                    self.on_text(line)
+            for frame in frames:
+                self.Dispatch(frame)
+
+    def Dispatch(self, frame):
+        with self.lock:
+            pending = self.pending.get(frame.seq)
+        if pending is None:
+            return
+        if frame.opcode == OP_ACK:
+            opcode, pending.status = frame.Ack()
+            pending.ackTime = time.perf_counter()
+            if pending.status != STATUS_OK:
+                print(f'ERROR! Trigger board rejected {COMMANDS[pending.opcode][0]}: {STATUS_NAMES.get(pending.status, pending.status)}')
+                self.Forget(frame.seq, pending)         # No DONE follows a rejected command
+            pending.ack.set()
+        elif frame.opcode == OP_EVENT:
+            opcode, index, result = frame.Event()
+            pending.events.append((index, result, time.perf_counter()))
+            if pending.on_event is not None:
+                pending.on_event(index, result)
+        elif frame.opcode == OP_DONE:
+            opcode, pending.result = frame.Done()
+            pending.doneTime = time.perf_counter()
+            pending.done.set()
+            self.Forget(frame.seq, pending)
+
+    def Forget(self, seq, pending):
+        '''
+        Remove a finished command from the pending table (unless its sequence number was already reused).
+        '''
+        with self.lock:
+            if self.pending.get(seq) is pending:
+                del self.pending[seq]
+
+    def Send(self, opcode, *params, wait=None, timeout=1.0, on_event=None):
+        '''
+        Send a command.
+        Args:
+            opcode (int): one of COMMANDS
+            params (int): parameters of the command
+            wait (string): None, 'ack' or 'done'
+            timeout (float): [s] for the wait
+            on_event (callable): called with (index, result) for every EVENT frame of the command, on the reader thread
+        Returns:
+            Pending
+        '''
+        with self.lock:
+            seq = self.seq
+            self.seq = (self.seq + 1) & 0xFF
+            pending = Pending(opcode, seq, on_event)
+            self.pending[seq] = pending
+            frame = encode_command(opcode, seq, *params)
+            pending.sent = time.perf_counter()
+            self.port.write(frame)
+        if wait is not None and not pending.Wait(wait, timeout):
+            print(f'ERROR! No {wait} from the trigger board for {COMMANDS[opcode][0]} {params}')
+        return pending
+
+    def TriggerD(self, freq, duration, wait='ack', timeout=None):
+        '''
+        Square wave at freq [Hz] during duration [ms]. The default timeout covers the duration.
+        '''
+        return self.Send(OP_TRIGGER_D, freq, duration, wait=wait, timeout=timeout or duration * 1e-3 + 1.0)
+
+    def TriggerN(self, freq, numTriggers, wait='ack', timeout=None):
+        return self.Send(OP_TRIGGER_N, freq, numTriggers, wait=wait, timeout=timeout or numTriggers / freq + 1.0)
+
+    def Train(self, freq, count, bursts=1, burst_interval=0, wait='ack', timeout=None):
+        duration = (max(bursts, 1) - 1) * max(count / freq, burst_interval * 1e-3) + count / freq
+        return self.Send(OP_TRAIN, freq, count, bursts, burst_interval, wait=wait, timeout=timeout or duration + 1.0)
+
+    def Start(self, freq, wait='ack', timeout=1.0):
+        return self.Send(OP_START, freq, wait=wait, timeout=timeout)
+
+    def Stop(self, wait='ack', timeout=1.0):
+        return self.Send(OP_STOP, wait=wait, timeout=timeout)
+
+    def Amp(self, voltage, wait='ack', timeout=1.0):
+        return self.Send(OP_AMP, voltage, wait=wait, timeout=timeout)
+
+    def Ping(self, timeout=1.0):
+        '''
+        Returns:
+            int: firmware id of the sketch, None if it does not answer
+        '''
+        pending = self.Send(OP_PING, wait='done', timeout=timeout)
+        return pending.result if pending.done.is_set() else None
+
+    def SchedClear(self, wait='ack', timeout=1.0):
+        return self.Send(OP_SCHED_CLEAR, wait=wait, timeout=timeout)
+
+    def SchedAdd(self, freq, count, interval, dac=DAC_UNCHANGED, wait=None, timeout=1.0):
+        '''
+        Append a train to the schedule of the board: count pulses at freq [Hz], next train interval [ms] after its start,
+        DAC output dac [mV] set before the train.
+        '''
+        return self.Send(OP_SCHED_ADD, freq, count, interval, dac, wait=wait, timeout=timeout)
+
+    def SchedRun(self, on_event=None, wait=None, timeout=None):
+        '''
+        Run the schedule. on_event(index, pulses emitted) is called after each train, the DONE result is the number
+        of trains run (fewer if stopped with Stop).
+        '''
+        return self.Send(OP_SCHED_RUN, wait=wait, timeout=timeout, on_event=on_event)
+
+    def Channel(self, channel, settle, wait='done', timeout=1.0):
+        '''
+        Select a D188 channel (0 all off) through its TTL inputs, the D188 must be in 4TTL mode.
+        The DONE frame is sent settle [us] after the lines are set.
+        '''
+        return self.Send(OP_CHANNEL, channel, settle, wait=wait, timeout=timeout)
+
+    def ChannelTriggerN(self, channel, settle, freq, numTriggers, wait='ack', timeout=None):
+        '''
+        Channel switch and TriggerN in one frame: the train starts settle [us] after the lines are set.
+        '''
+        return self.Send(OP_CHANNEL_TRIGGER_N, channel, settle, freq, numTriggers, wait=wait,
+                         timeout=timeout or settle * 1e-6 + numTriggers / freq + 1.0)
+
+    def Close(self):
+        '''
+        Stop the reader thread. The serial port itself is closed by its owner.
+        '''
+        self.running = False
+        self.thread.join(timeout=2)
@@ -0,0 +1,119 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Trial schedules uploaded to the trigger microcontroller and run on its own timer
+from API.trigger_protocol import MAX_TRAINS, DAC_UNCHANGED, STATUS_OK
+
+UPLOAD_WINDOW = 3           # Frames in flight during the upload, keeps the 64 bytes receive buffer of the board from overflowing
+
+# ------------------------------------------------------------------------------
+# Declare schedule classes
+class ScheduledTrain:
+    '''
+    One train of a schedule.
+    Args:
+        frequency (float): [Hz]
+        duration (float): [ms], used when count is not given
+        count (int): number of pulses
+        interval (float): from the start of this train to the start of the next one [ms]. A train longer than
+                          the interval is followed immediately by the next one
+        dac (float): DAC output set before the train [mV], None keeps the current output
+    '''
+    def __init__(self, frequency, duration=None, count=None, interval=0, dac=None):
+        if frequency <= 0:
+            raise ValueError('The frequency of a train must be positive')
+        if count is None and duration is None:
+            raise ValueError('A train needs a count or a duration')
+        self.frequency = frequency
+        self.count = count if count is not None else max(1, round(frequency * duration * 1e-3))
+        self.interval = interval
+        self.dac = dac
+
+    def __repr__(self):
+        dac = '' if self.dac is None else f', DAC {self.dac} mV'
+        return f'ScheduledTrain({self.frequency} Hz, {self.count} pulses, every {self.interval} ms{dac})'
+
+    def Duration(self):
+        return self.count / self.frequency
+
+
+class TrialSchedule:
+    '''
+    Block of trains uploaded to the trigger board in one transfer and run with the timer of the board, so the
+    host scheduling jitter and the USB latency are out of the timing between trains. Each completed train is
+    streamed back as a progress event.
+        schedule = TrialSchedule()
+        for freq in (10, 20, 40):
+            schedule.Add(freq, duration=500, interval=2000)
+        schedule.Upload(link)
+        pending = schedule.Run(link, on_progress=lambda index, pulses: print(index, pulses))
+    '''
+    def __init__(self, trains=()):
+        self.trains = list(trains)
+
+    def __len__(self):
+        return len(self.trains)
+
+    def __iter__(self):
+        return iter(self.trains)
+
+    def __repr__(self):
+        return f'TrialSchedule({len(self.trains)} trains, {self.Duration():.2f} s)'
+
+    def Add(self, frequency, duration=None, count=None, interval=0, dac=None):
+        '''
+        Append a train (see ScheduledTrain).
+        Returns:
+            TrialSchedule: self, so that calls can be chained
+        '''
+        if len(self.trains) >= MAX_TRAINS:
+            raise ValueError(f'A schedule holds at most {MAX_TRAINS} trains')
+        self.trains.append(ScheduledTrain(frequency, duration, count, interval, dac))
+        return self
+
+    def Duration(self):
+        '''
+        Expected duration of the whole schedule [s].
+        '''
+        if not self.trains:
+            return 0
+        return sum(max(train.Duration(), train.interval * 1e-3) for train in self.trains[:-1]) + self.trains[-1].Duration()
+
+    def Upload(self, link, timeout=1.0):
+        '''
+        Replace the schedule of the board. The frames are pipelined, UPLOAD_WINDOW of them in flight.
+        Args:
+            link (TriggerLink)
+        Returns:
+            bool: True if every train was stored
+        '''
+        if not link.SchedClear(timeout=timeout).Wait('ack', timeout):
+            return False
+        sent = []
+        for train in self.trains:
+            if len(sent) >= UPLOAD_WINDOW:
+                sent[-UPLOAD_WINDOW].Wait('ack', timeout)
+            dac = DAC_UNCHANGED if train.dac is None else train.dac
+            sent.append(link.SchedAdd(train.frequency, train.count, train.interval, dac))
+        stored = all(pending.Wait('done', timeout) for pending in sent)
+        if not stored:
+            failed = [index for index, pending in enumerate(sent) if pending.status != STATUS_OK or not pending.done.is_set()]
+            print(f'ERROR! Schedule upload failed for the trains {failed}')
+        return stored
+
+    def Run(self, link, on_progress=None, wait=True, margin=1.0):
+        '''
+        Start the uploaded schedule.
+        Args:
+            link (TriggerLink)
+            on_progress (callable): on_progress(index, pulses emitted) after each train, on the reader thread of the link
+            wait (bool): return once the schedule is completed, or after margin [s] on top of its duration
+        Returns:
+            Pending: events holds (index, pulses emitted, time) per train, result the number of trains run
+        '''
+        return link.SchedRun(on_event=on_progress, wait='done' if wait else 'ack', timeout=self.Duration() + margin)
+
+    def Stop(self, link):
+        '''
+        Abort the running schedule after the current train.
+        '''
+        return link.Stop()
@@ -0,0 +1,179 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# D188 channel switching through its rear TTL inputs, driven by the trigger board, and USB/TTL latency benchmark
+import os
+import statistics
+import time
+
+SWITCH_TIME = 1.0           # Pause after a TTL change recommended by the D188 manual (switching takes several hundred us) [ms]
+
+# ------------------------------------------------------------------------------
+# Declare selector classes
+class TTLSelector:
+    '''
+    Channel switching backend of the D188 in 4TTL mode: the trigger board sets the binary channel number on
+    pins 10 to 13 (D0 to D3 of the D188 rear socket), so a switch is one serial frame instead of a DGD188_Update
+    call, and it can share the frame of the trigger (TriggerN).
+    Same SetChannel/SwitchLatency interface as the D188Controller.
+        ttl = TTLSelector(link, session.selector)
+        ttl.Open()
+        ttl.TriggerN(3, 15, 10)                # channel 3, then 10 triggers at 15 Hz
+    '''
+    CHANNELS = range(0, 9)
+
+    def __init__(self, link, selector, delay=0.1):
+        '''
+        Args:
+            link (TriggerLink): framed link to the trigger board
+            selector: D188Controller, session.selector or scheduler proxy, used to change the mode
+            delay (float): de-bounce delay of the D188 [ms], between 0.1 and 1000
+        '''
+        self.link = link
+        self.selector = selector
+        self.delay = delay
+        self.settle = round((delay + SWITCH_TIME) * 1000)     # [us] between the TTL change and the stimulation
+        self.channel = None
+        self.lastSwitchLatency = None
+        self.switchCount = 0
+        self.switchTotal = 0.0
+        self.switchMax = 0.0
+
+    def Open(self):
+        '''
+        Put the D188 in 4TTL mode with all the channels off.
+        Returns:
+            bool: True if the D188 and the trigger board accepted
+        '''
+        if not self.selector.Configure(mode='4TTL', delay=self.delay):
+            return False
+        return self.SetChannel(0)
+
+    def Close(self):
+        '''
+        Switch all the channels off and give the control back to USB.
+        '''
+        self.SetChannel(0)
+        self.selector.Configure(mode='USB', channel=0)
+
+    def Record(self, pending):
+        if pending.done.is_set():
+            self.lastSwitchLatency = pending.doneTime - pending.sent
+            self.switchCount += 1
+            self.switchTotal += self.lastSwitchLatency
+            self.switchMax = max(self.switchMax, self.lastSwitchLatency)
+
+    def SetChannel(self, channel, timeout=0.5):
+        '''
+        Set which channel is active, returns once the D188 had time to switch.
+        Args:
+            channel (int): 0,1,2,...,8
+        Returns:
+            bool: True if the trigger board completed the switch
+        '''
+        if channel not in self.CHANNELS:
+            print('ERROR! Channel argument invalid')
+            return False
+        pending = self.link.Channel(channel, self.settle, wait='done', timeout=timeout)
+        self.Record(pending)
+        if pending.done.is_set():
+            self.channel = channel
+        return pending.done.is_set()
+
+    def TriggerN(self, channel, freq, numTriggers, wait='ack', timeout=None):
+        '''
+        Switch to channel and trigger numTriggers pulses at freq [Hz] with a single frame.
+        Returns:
+            Pending: DONE result is the number of pulses emitted
+        '''
+        if channel not in self.CHANNELS:
+            print('ERROR! Channel argument invalid')
+            return None
+        pending = self.link.ChannelTriggerN(channel, self.settle, freq, numTriggers, wait=wait, timeout=timeout)
+        self.channel = channel
+        return pending
+
+    def SwitchLatency(self):
+        '''
+        Measured duration of the channel switches, from the frame sent to the channel active.
+        Returns:
+            dict: 'count', 'last', 'mean' and 'max' in milliseconds (None if no switch was made yet)
+        '''
+        if not self.switchCount:
+            return {'count': 0, 'last': None, 'mean': None, 'max': None}
+        return {
+            'count': self.switchCount,
+            'last': self.lastSwitchLatency * 1e3,
+            'mean': self.switchTotal / self.switchCount * 1e3,
+            'max': self.switchMax * 1e3
+        }
+
+# ------------------------------------------------------------------------------
+# Benchmark
+def latency_summary(latencies):
+    '''
+    Returns:
+        dict: 'count', 'mean', 'median', 'p95' and 'max' in milliseconds
+    '''
+    ordered = sorted(latency * 1e3 for latency in latencies)
+    return {
+        'count': len(ordered),
+        'mean': statistics.fmean(ordered),
+        'median': statistics.median(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+        'max': ordered[-1]
+    }
+
+def compare_switch_latency(selector, ttl, channels=range(1, 9), repeats=10):
+    '''
+    Time the same sequence of channel switches through USB (DGD188_Update) and through the TTL lines.
+    The TTL figure includes the settle time the D188 needs after the lines change, the USB one is the
+    duration of the DLL call.
+    Args:
+        selector: D188Controller or session.selector
+        ttl (TTLSelector)
+        channels (iterable of int): sequence switched repeats times
+    Returns:
+        dict: {'USB': latency_summary, 'TTL': latency_summary}
+    '''
+    sequence = list(channels) * repeats
+    selector.Configure(mode='USB', channel=0)
+    usb = []
+    for channel in sequence:
+        start = time.perf_counter()
+        selector.SetChannel(channel)
+        usb.append(time.perf_counter() - start)
+    selector.Configure(channel=0)
+    ttl.Open()
+    switched = []
+    for channel in sequence:
+        start = time.perf_counter()
+        if ttl.SetChannel(channel):
+            switched.append(time.perf_counter() - start)
+    ttl.Close()
+    return {'USB': latency_summary(usb), 'TTL': latency_summary(switched) if switched else None}
+
+
+if __name__ == "__main__":
+    '''
+    Run with the hardware, or without it: TTENS_BACKEND=sim python -m API.ttl_selector uses the simulated
+    D188 and a virtual trigger board wired to its TTL inputs.
+    '''
+    from API.session import get_session
+    from API.transport import TriggerTransport
+    session = get_session()
+    session.Open()
+    board = None
+    if os.environ.get('TTENS_BACKEND') == 'sim' and not os.environ.get('TTENS_PORT'):
+        from API.backend import get_backend
+        from API.virtual_board import VirtualBoard
+        board = VirtualBoard('TENS_controller', boot=False, on_ttl=get_backend('D188', 'sim').SetTTL).Start()
+    transport = TriggerTransport(board.port if board else os.environ.get('TTENS_PORT'))
+    if transport.Open():
+        results = compare_switch_latency(session.selector, TTLSelector(transport.link, session.selector))
+        for path, summary in results.items():
+            print(f'{path}: ' + ', '.join(f'{key} {value:.3f}' if isinstance(value, float) else f'{key} {value}'
+                                          for key, value in summary.items()) + ' [ms]')
+        transport.Close()
+    session.Close()
+    if board is not None:
+        board.Stop()
@@ -0,0 +1,529 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Virtual trigger board: emulator of the Arduino sketches on a pseudo-terminal (Linux)
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import tty
+from collections import deque
+from API.trigger_protocol import (SYNC, MAX_PAYLOAD, COMMANDS, MAX_TRAINS, DAC_UNCHANGED, crc16, encode,
+                                  OP_TRIGGER_D, OP_TRIGGER_N, OP_TRAIN, OP_START, OP_STOP, OP_AMP, OP_PING,
+                                  OP_SCHED_CLEAR, OP_SCHED_ADD, OP_SCHED_RUN, OP_CHANNEL, OP_CHANNEL_TRIGGER_N, OP_ACK, OP_DONE, OP_EVENT,
+                                  STATUS_OK, STATUS_BAD_CRC, STATUS_UNKNOWN_OPCODE, STATUS_BAD_LENGTH,
+                                  STATUS_FULL, STATUS_BUSY)
+
+'''
+The emulator runs the loop() of a sketch on its own thread against a pseudo-terminal, so the serial code of the
+scripts runs unchanged (TTENS_PORT=<port of the board>). It models what shapes the timing of the real board:
+- the UART: 10 bits per byte at the baud rate in both directions and the 64 bytes receive buffer, whose
+  overflow drops bytes while the sketch is blocked
+- the parse time of each command
+- blocking delay(), readStringUntil() and its 1 s timeout
+- tone() on timer 2 of the ATmega328P: the generated frequency is quantised by the 8 bits compare register
+  (below 31 Hz it is not the requested one) and the number of pulses is given by the toggle count
+- the micros() timed pulse trains and schedules of the framed sketches
+Rising edges of the trigger pin are recorded in edges (time.perf_counter() values).
+'''
+SKETCHES = ('Calibration_trigger', 'TENS_controller', 'mapping_trigger')
+FIRMWARE_IDS = {'Calibration_trigger': 1, 'TENS_controller': 2}
+F_CPU = 16000000
+BAUDRATE = 115200
+RX_BUFFER = 64              # HardwareSerial receive buffer [bytes]
+SERIAL_TIMEOUT = 1.0        # Stream timeout of readStringUntil [s]
+BOOTLOADER_TIME = 0.5       # Bootloader after a reset, the received bytes are lost [s]
+PARSE_TIME = 200e-6         # String split and toInt of a text command on the AVR [s]
+FRAME_TIME = 30e-6          # CRC and dispatch of a frame [s]
+FRAME_TIMEOUT = 0.05        # Incomplete frame dropped by the framed sketches [s]
+STROBE_TIME = 100e-6        # Strobe on pin 7 after the channel lines of the framed sketches [s]
+
+def tone_frequency(frequency):
+    '''
+    Frequency generated by tone() on timer 2 (Tone.cpp): the smallest prescaler whose compare value fits in
+    8 bits, the low byte of the compare value if none does.
+    Returns:
+        float: [Hz]
+    '''
+    for prescale in (1, 8, 32, 64, 128, 256, 1024):
+        ocr = F_CPU // frequency // 2 // prescale - 1
+        if ocr <= 255:
+            break
+    return F_CPU / (2 * prescale * ((ocr & 0xFF) + 1))
+
+def to_int(text):
+    '''
+    String.toInt(): leading integer of the text, 0 if none.
+    '''
+    text = text.strip()
+    end = 1 if text[:1] in ('-', '+') else 0
+    while end < len(text) and text[end].isdigit():
+        end += 1
+    try:
+        return int(text[:end])
+    except ValueError:
+        return 0
+
+# ------------------------------------------------------------------------------
+# Declare virtual board classes
+class VirtualBoard:
+    '''
+    Emulator of one trigger board sketch exposed on a pseudo-terminal.
+        board = VirtualBoard('TENS_controller').Start()
+        transport = TriggerTransport(board.port)
+    '''
+    def __init__(self, sketch='TENS_controller', boot=True, parse_time=PARSE_TIME, baudrate=BAUDRATE, on_ttl=None):
+        '''
+        Args:
+            sketch (string): one of SKETCHES
+            boot (bool): run the bootloader and setup() (banner) at Start, False for a board already running
+            parse_time (float): processing time of a text command [s]
+            baudrate (int)
+            on_ttl (callable): called with the channel lines (bit 0 = pin 10) when they change, e.g. SimulatedD188.SetTTL
+        '''
+        if sketch not in SKETCHES:
+            raise ValueError(f'Unknown sketch {sketch}, one of {SKETCHES}')
+        self.sketch = sketch
+        self.framed = sketch in FIRMWARE_IDS
+        self.boot = boot
+        self.parse_time = parse_time
+        self.byteTime = 10 / baudrate
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        tty.setraw(self.master)
+        self.port = os.ttyname(self.slave)
+        self.incoming = deque()         # (time the byte is in the receive buffer, byte)
+        self.rx = deque()               # Receive buffer of the board
+        self.rxLock = threading.Condition()
+        self.rxCursor = 0
+        self.outgoing = deque()         # (time the last byte is sent, bytes)
+        self.txCursor = 0
+        self.txLock = threading.Condition()
+        self.overruns = 0               # Bytes dropped by the full receive buffer
+        self.lost = 0                   # Bytes received while in the bootloader
+        self.edges = []                 # Rising edges of the trigger pin
+        self.tone = None                # (start, frequency) of a continuous tone
+        self.commands = []              # (time, command) when each command is parsed
+        self.dac = 0
+        self.channel = 0
+        self.on_ttl = on_ttl
+        self.running = False
+        self.booting = False
+        # State of the framed sketches
+        self.rxActive = False
+        self.rxStart = 0
+        self.frame = bytearray()
+        self.schedule = []
+        self.threads = []
+
+    def __repr__(self):
+        return f'VirtualBoard({self.sketch}, {self.port})'
+
+    def Start(self):
+        self.running = True
+        for target in (self.Receiver, self.Transmitter, self.Loop):
+            thread = threading.Thread(target=target, name=f'{self.sketch}-{target.__name__}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def Stop(self):
+        self.running = False
+        with self.rxLock:
+            self.rxLock.notify_all()
+        with self.txLock:
+            self.txLock.notify_all()
+        for thread in self.threads:
+            thread.join(timeout=2)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def __enter__(self):
+        return self.Start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Stop()
+        return False
+
+    # UART ---------------------------------------------------------------------
+    def Receiver(self):
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            with self.rxLock:
+                now = time.perf_counter()
+                for byte in data:
+                    self.rxCursor = max(self.rxCursor, now) + self.byteTime
+                    self.incoming.append((self.rxCursor, byte))
+                self.rxLock.notify_all()
+
+    def Deliver(self):
+        # Move the bytes that went through the UART into the receive buffer, dropping them if it is full
+        now = time.perf_counter()
+        while self.incoming and self.incoming[0][0] <= now:
+            byte = self.incoming.popleft()[1]
+            if self.booting:
+                self.lost += 1
+            elif len(self.rx) >= RX_BUFFER:
+                self.overruns += 1
+            else:
+                self.rx.append(byte)
+
+    def Available(self):
+        with self.rxLock:
+            self.Deliver()
+            return len(self.rx)
+
+    def Peek(self):
+        with self.rxLock:
+            self.Deliver()
+            return self.rx[0] if self.rx else -1
+
+    def Read(self):
+        with self.rxLock:
+            self.Deliver()
+            return self.rx.popleft() if self.rx else -1
+
+    def WaitInput(self, timeout):
+        '''
+        Idle until a byte reaches the receive buffer or timeout [s].
+        '''
+        deadline = time.perf_counter() + timeout
+        with self.rxLock:
+            while self.running:
+                self.Deliver()
+                now = time.perf_counter()
+                if self.rx or now >= deadline:
+                    return
+                due = self.incoming[0][0] if self.incoming else deadline
+                self.rxLock.wait(max(0, min(due, deadline) - now))
+
+    def ReadLine(self):
+        '''
+        readStringUntil('\\n'): waits up to SERIAL_TIMEOUT for each byte.
+        '''
+        line = bytearray()
+        while self.running:
+            if not self.Available():
+                self.WaitInput(SERIAL_TIMEOUT)
+                if not self.Available():
+                    break
+            byte = self.Read()
+            if byte == 0x0A:
+                break
+            line.append(byte)
+        return line.decode(errors='replace')
+
+    def Write(self, data):
+        '''
+        Serial.write: the bytes reach the host after their transmission time.
+        '''
+        if isinstance(data, str):
+            data = data.encode()
+        with self.txLock:
+            self.txCursor = max(self.txCursor, time.perf_counter()) + len(data) * self.byteTime
+            self.outgoing.append((self.txCursor, data))
+            self.txLock.notify()
+
+    def Transmitter(self):
+        while self.running:
+            with self.txLock:
+                while self.running and not self.outgoing:
+                    self.txLock.wait(0.05)
+                if not self.outgoing:
+                    return
+                due, data = self.outgoing.popleft()
+            self.SleepUntil(due)
+            try:
+                os.write(self.master, data)
+            except OSError:
+                return
+
+    def Println(self, text):
+        self.Write(f'{text}\r\n')
+
+    # Timing -------------------------------------------------------------------
+    def Delay(self, ms):
+        self.SleepUntil(time.perf_counter() + ms * 1e-3)
+
+    def SleepUntil(self, deadline):
+        remaining = deadline - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def Tone(self, frequency, duration=0):
+        '''
+        tone(TRIGGER, frequency, duration): returns immediately, the pulses are generated by the timer.
+        '''
+        self.NoTone()
+        if frequency == 0:
+            return
+        start = time.perf_counter()
+        actual = tone_frequency(frequency)
+        if duration:
+            toggles = 2 * frequency * duration // 1000
+            self.edges.extend(start + (2 * k + 1) / (2 * actual) for k in range((toggles + 1) // 2))
+        else:
+            self.tone = (start, actual)
+
+    def NoTone(self):
+        if self.tone is not None:
+            start, actual = self.tone
+            pulses = int((time.perf_counter() - start) * actual + 0.5)
+            self.edges.extend(start + (2 * k + 1) / (2 * actual) for k in range(pulses))
+            self.tone = None
+
+    def PulseTrain(self, freq, count, bursts, burst_interval):
+        '''
+        pulse_train() of the framed sketches, timed on micros().
+        Returns:
+            int: pulses emitted
+        '''
+        if freq == 0:
+            return 0
+        bursts = max(1, bursts)
+        period = (1000000 // freq) * 1e-6
+        burstStart = time.perf_counter()
+        for b in range(bursts):
+            start = time.perf_counter()
+            self.edges.extend(start + i * period for i in range(count))
+            self.SleepUntil(start + count * period)
+            if b + 1 < bursts:
+                burstStart += burst_interval * 1e-3
+                self.SleepUntil(burstStart)
+        return count * bursts
+
+    # Sketches -----------------------------------------------------------------
+    def Loop(self):
+        if self.boot:
+            self.Setup()
+        while self.running:
+            if self.framed:
+                self.LoopFramed()
+            else:
+                self.LoopMapping()
+
+    def Setup(self):
+        self.booting = True
+        self.Delay(BOOTLOADER_TIME * 1000)
+        with self.rxLock:
+            self.Deliver()
+            self.booting = False
+        if self.framed:
+            self.dac = 5000
+            self.Delay(1000)
+            self.Println('init succeed')
+        else:
+            self.Println('init succeed')
+            self.dac = 5000
+            self.Delay(1000)
+
+    def LoopMapping(self):
+        if not self.Available():
+            self.WaitInput(0.01)
+            return
+        command = self.ReadLine()
+        self.Parsed(command)
+        if command[:5] == 'start':
+            freq = to_int(command[5:])
+            self.Tone(freq)
+            self.Println(freq)
+        elif command[:4] == 'stop':
+            self.NoTone()
+            self.Println('stopped')
+        elif command[:3] == 'amp':
+            self.dac = to_int(command[3:])
+        elif command[:7] == 'channel':
+            self.SetChannel(to_int(command[7:]))
+            self.Println(command)
+
+    def SetChannel(self, channel, settle=None):
+        '''
+        setChannel() of mapping_trigger (lines, 1 ms, strobe, 1 ms) or set_channel() of the framed sketches
+        (lines, strobe, until settle [us] after the lines).
+        '''
+        start = time.perf_counter()
+        self.channel = channel if 0 <= channel <= 8 else 0
+        if self.on_ttl is not None:
+            self.on_ttl(self.channel)
+        if settle is None:
+            self.Delay(2)
+        else:
+            self.SleepUntil(start + max(STROBE_TIME, settle * 1e-6))
+
+    def Parsed(self, command, cost=None):
+        self.Delay((self.parse_time if cost is None else cost) * 1000)
+        self.commands.append((time.perf_counter(), command))
+
+    def LoopFramed(self):
+        if self.rxActive and time.perf_counter() - self.rxStart > FRAME_TIMEOUT:
+            self.rxActive = False
+        if self.rxActive or (self.Available() and self.Peek() == SYNC):
+            if self.ReadFrame():
+                self.HandleFrame()
+            elif self.rxActive:
+                self.WaitInput(FRAME_TIMEOUT)
+        elif self.Available():
+            self.Text(self.ReadLine())
+        else:
+            self.WaitInput(0.01)
+
+    def Text(self, command):
+        parts = command.strip().split(':')
+        name = parts[0]
+        params = [to_int(part) for part in parts[1:5]] + [0] * (5 - len(parts[:5]))
+        self.Parsed(command)
+        if name == 'triggerD':
+            self.Tone(params[0], params[1])
+            self.Delay(params[1])
+        elif name == 'train':
+            self.Println('train:start')
+            self.Println(f'train:done:{self.PulseTrain(*params[:4])}')
+        elif name == 'triggerN':
+            half = (1000 // params[0]) // 2 if params[0] else 0
+            self.Println('done')
+            for _ in range(params[1]):
+                self.edges.append(time.perf_counter())
+                self.Delay(half)
+                self.Delay(half)
+        elif name == 'start' and self.sketch == 'TENS_controller':
+            self.Tone(params[0])
+        elif name == 'stop' and self.sketch == 'TENS_controller':
+            self.NoTone()
+        else:
+            self.NoTone()
+
+    def ReadFrame(self):
+        while self.Available():
+            byte = self.Read()
+            if not self.rxActive:
+                if byte == SYNC:
+                    self.rxActive = True
+                    self.frame.clear()
+                    self.rxStart = time.perf_counter()
+                continue
+            self.frame.append(byte)
+            if self.frame[0] > MAX_PAYLOAD:
+                self.rxActive = False
+                continue
+            if len(self.frame) == self.frame[0] + 5:
+                self.rxActive = False
+                return True
+        return False
+
+    def CheckFrame(self):
+        '''
+        Returns:
+            (int, int, bytes, int): opcode, seq, payload and status of the received frame
+        '''
+        length, opcode, seq = self.frame[0], self.frame[1], self.frame[2]
+        payload = bytes(self.frame[3:3 + length])
+        crc = struct.unpack_from('<H', self.frame, 3 + length)[0]
+        if crc != crc16(self.frame[:3 + length]):
+            return opcode, seq, payload, STATUS_BAD_CRC
+        if opcode not in COMMANDS:
+            return opcode, seq, payload, STATUS_UNKNOWN_OPCODE
+        if length != struct.calcsize(COMMANDS[opcode][1] or '<'):
+            return opcode, seq, payload, STATUS_BAD_LENGTH
+        if opcode == OP_SCHED_ADD and len(self.schedule) >= MAX_TRAINS:
+            return opcode, seq, payload, STATUS_FULL
+        return opcode, seq, payload, STATUS_OK
+
+    def HandleFrame(self):
+        opcode, seq, payload, status = self.CheckFrame()
+        self.SendFrame(OP_ACK, seq, bytes((opcode, status)))
+        if status != STATUS_OK:
+            return
+        self.Parsed(COMMANDS[opcode][0], FRAME_TIME)
+        params = struct.unpack(COMMANDS[opcode][1], payload) if payload else ()
+        result = 0
+        if opcode == OP_TRIGGER_D:
+            self.Tone(*params)
+            self.Delay(params[1])
+            result = params[0] * params[1] // 1000
+        elif opcode == OP_TRIGGER_N:
+            result = self.PulseTrain(params[0], params[1], 1, 0)
+        elif opcode == OP_TRAIN:
+            result = self.PulseTrain(*params)
+        elif opcode == OP_START:
+            self.Tone(params[0])
+        elif opcode == OP_STOP:
+            self.NoTone()
+        elif opcode == OP_AMP:
+            self.dac = params[0]
+        elif opcode == OP_PING:
+            result = FIRMWARE_IDS[self.sketch]
+        elif opcode == OP_SCHED_CLEAR:
+            self.schedule = []
+        elif opcode == OP_SCHED_ADD:
+            self.schedule.append(params)
+            result = len(self.schedule)
+        elif opcode == OP_SCHED_RUN:
+            result = self.RunSchedule(seq)
+        elif opcode == OP_CHANNEL:
+            self.SetChannel(*params)
+            result = self.channel
+        elif opcode == OP_CHANNEL_TRIGGER_N:
+            self.SetChannel(params[0], params[1])
+            result = self.PulseTrain(params[2], params[3], 1, 0)
+        self.SendFrame(OP_DONE, seq, bytes((opcode,)) + struct.pack('<I', result))
+
+    def RunSchedule(self, seq):
+        start = time.perf_counter()
+        for index, (freq, count, interval, dac) in enumerate(self.schedule):
+            if dac != DAC_UNCHANGED:
+                self.dac = dac
+            emitted = self.PulseTrain(freq, count, 1, 0)
+            self.SendFrame(OP_EVENT, seq, struct.pack('<BHI', OP_SCHED_RUN, index, emitted))
+            if index + 1 == len(self.schedule):
+                break
+            start += interval * 1e-3
+            while True:
+                if self.StopRequested():
+                    return index + 1
+                if time.perf_counter() >= start:
+                    break
+                self.WaitInput(start - time.perf_counter())
+        return len(self.schedule)
+
+    def StopRequested(self):
+        if not self.ReadFrame():
+            return False
+        opcode, seq, payload, status = self.CheckFrame()
+        if status == STATUS_BAD_CRC:
+            self.SendFrame(OP_ACK, seq, bytes((opcode, status)))
+            return False
+        if opcode != OP_STOP:
+            self.SendFrame(OP_ACK, seq, bytes((opcode, STATUS_BUSY)))
+            return False
+        self.SendFrame(OP_ACK, seq, bytes((opcode, STATUS_OK)))
+        self.NoTone()
+        self.SendFrame(OP_DONE, seq, bytes((opcode,)) + struct.pack('<I', 0))
+        return True
+
+    def SendFrame(self, opcode, seq, payload):
+        self.Write(encode(opcode, seq, payload))
+
+    def Pulses(self, since=0):
+        '''
+        Returns:
+            int: rising edges of the trigger pin after since (time.perf_counter() value)
+        '''
+        return sum(1 for edge in self.edges if edge >= since)
+
+
+if __name__ == '__main__':
+    sketch = sys.argv[1] if len(sys.argv) > 1 else 'TENS_controller'
+    with VirtualBoard(sketch) as board:
+        print(f'{sketch} emulated on {board.port}, run the scripts with TTENS_PORT={board.port} (Ctrl+C to stop)')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
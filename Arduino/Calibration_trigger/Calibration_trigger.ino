@@ -9,6 +9,9 @@ const int pin4 = 13;
 const int pin5 = 7; 
 unsigned int counter = 0;
 
+const unsigned long FIRMWARE_ID = 1;  // 1: Calibration_trigger, 2: TENS_controller
+#include <TriggerProtocol.h>   // Framed protocol: Arduino/libraries/TriggerProtocol
+
 void setup() {
   Serial.begin(115200);
 
@@ -16,7 +19,6 @@ void setup() {
     Serial.println("init error");
     delay(1000);
    }
-  Serial.println("init succeed");
   //Set DAC output range
   dac.setDACOutRange(dac.eOutputRange10V);
 
@@ -29,15 +31,23 @@ void setup() {
   pinMode(pin3, OUTPUT);
   pinMode(pin4, OUTPUT);
   pinMode(pin5, OUTPUT);
-  
+  Serial.println("init succeed");     // Ready banner: the host starts sending commands when it arrives
 }
 
 void loop() {
-  if (Serial.available()){
+  if (rx_active && millis() - rx_start > 50){
+    rx_active = false;                // Incomplete frame, resynchronise on the next SYNC
+  }
+  if (rx_active || (Serial.available() && Serial.peek() == SYNC)){
+    if (read_frame()){
+      handle_frame();
+    }
+  }
+  else if (Serial.available()){
     String command = Serial.readStringUntil('\n');
     String cmd_name;
-    unsigned int param1, param2;
-    parse_command(command, cmd_name, param1, param2);
+    unsigned int param1, param2, param3, param4;
+    parse_command(command, cmd_name, param1, param2, param3, param4);
 
     if (cmd_name == "triggerD"){
       // param1 -> freq
@@ -46,6 +56,16 @@ void loop() {
       tone(TRIGGER, param1, param2);
       delay(param2);
     }
+    else if (cmd_name == "train"){
+      // param1 -> freq
+      // param2 -> pulses per burst
+      // param3 -> number of bursts (0 -> 1)
+      // param4 -> burst interval in ms, start to start
+      Serial.println("train:start");
+      unsigned long emitted = pulse_train(param1, param2, param3, param4);
+      Serial.print("train:done:");
+      Serial.println(emitted);
+    }
     else if (cmd_name == "triggerN"){
       // param1 -> freq
       // param2 -> num_triggers
@@ -66,38 +86,16 @@ void loop() {
   }
 }
 
-void parse_command(String cmd, String &cmd_name, unsigned int &param1, unsigned int &param2){
-  // Split the command
-  int first_colon = cmd.indexOf(':');
-  int second_colon = cmd.indexOf(':', first_colon + 1);
-
-  cmd_name = cmd.substring(0, first_colon);
-  param1 = cmd.substring(first_colon + 1, second_colon).toInt();
-  param2 = cmd.substring(second_colon + 1).toInt();
+void parse_command(String cmd, String &cmd_name, unsigned int &param1, unsigned int &param2, unsigned int &param3, unsigned int &param4){
+  // Split the command: name:param1:param2:param3:param4, missing parameters are 0
+  unsigned int *params[4] = {&param1, &param2, &param3, &param4};
+  int colon = cmd.indexOf(':');
+  cmd_name = (colon < 0) ? cmd : cmd.substring(0, colon);
+  for (int i = 0; i < 4; i++){
+    *params[i] = 0;
+    if (colon < 0) continue;
+    int next = cmd.indexOf(':', colon + 1);
+    *params[i] = cmd.substring(colon + 1, (next < 0) ? cmd.length() : next).toInt();
+    colon = next;
+  }
 }
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
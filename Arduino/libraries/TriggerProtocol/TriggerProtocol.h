@@ -0,0 +1,312 @@
+// Framed protocol of the trigger boards, shared by the Calibration_trigger and TENS_controller sketches.
+// Install by setting the sketchbook location to the Arduino folder of the repository (File > Preferences),
+// or by copying this folder to the libraries folder of the sketchbook.
+// The sketch defines TRIGGER, pin1 to pin5 (D188 channel lines and strobe), dac and FIRMWARE_ID before
+// including this file, and calls read_frame()/handle_frame() from loop().
+#ifndef TRIGGER_PROTOCOL_H
+#define TRIGGER_PROTOCOL_H
+
+// Framed protocol: SYNC | LEN | OPCODE | SEQ | PAYLOAD (LEN bytes) | CRC16 (CCITT-FALSE of LEN..PAYLOAD, little endian)
+// Every command gets an ACK (opcode, status) when received and a DONE (opcode, uint32 result) when completed.
+// A running schedule also sends an EVENT (opcode, uint16 index, uint32 result) after each of its trains.
+// See API/trigger_protocol.py. Text lines are still accepted for manual tests from the serial monitor.
+const byte SYNC = 0xA5;
+const byte MAX_PAYLOAD = 16;
+const byte OP_TRIGGER_D = 0x01;  // freq, duration [ms]
+const byte OP_TRIGGER_N = 0x02;  // freq, num_triggers
+const byte OP_TRAIN = 0x03;      // freq, pulses per burst, bursts, burst interval [ms]
+const byte OP_START = 0x04;      // freq
+const byte OP_STOP = 0x05;
+const byte OP_AMP = 0x06;        // DAC output [mV]
+const byte OP_PING = 0x07;
+const byte OP_SCHED_CLEAR = 0x08;
+const byte OP_SCHED_ADD = 0x09;  // freq, pulses, interval [ms] start to start, DAC [mV] (0xFFFF unchanged)
+const byte OP_SCHED_RUN = 0x0A;  // EVENT per train (index, pulses emitted), DONE: trains run
+const byte OP_CHANNEL = 0x0B;    // D188 channel (0 all off), settle [us]. DONE once the channel is active
+const byte OP_CHANNEL_TRIGGER_N = 0x0C;  // channel, settle [us], freq, num_triggers. DONE: pulses emitted
+const byte OP_ACK = 0x80;
+const byte OP_DONE = 0x81;
+const byte OP_EVENT = 0x82;
+const byte STATUS_OK = 0;
+const byte STATUS_BAD_CRC = 1;
+const byte STATUS_UNKNOWN_OPCODE = 2;
+const byte STATUS_BAD_LENGTH = 3;
+const byte STATUS_FULL = 4;
+const byte STATUS_BUSY = 5;
+const unsigned int STROBE_US = 100;   // Strobe on pin 7 after the channel lines are set
+byte rx_buf[3 + MAX_PAYLOAD + 2];      // LEN OPCODE SEQ PAYLOAD CRC of the frame being received
+byte rx_count = 0;
+bool rx_active = false;
+unsigned long rx_start = 0;
+
+// Trial schedule uploaded by the host, run on the board timer without host round trips
+const byte MAX_TRAINS = 32;
+const unsigned int DAC_UNCHANGED = 0xFFFF;
+struct Train {
+  unsigned int freq;       // Hz
+  unsigned int count;      // pulses
+  unsigned int interval;   // ms, start of this train to start of the next one
+  unsigned int dac;        // mV, DAC_UNCHANGED keeps the output
+};
+Train schedule[MAX_TRAINS];
+byte schedule_length = 0;
+
+unsigned long pulse_train(unsigned int freq, unsigned int count, unsigned int bursts, unsigned int burst_interval);
+unsigned long run_schedule(byte seq);
+void set_channel(unsigned int channel, unsigned int settle);
+bool stop_requested();
+uint16_t crc16(const byte *data, byte n);
+void send_frame(byte opcode, byte seq, const byte *payload, byte n);
+void send_ack(byte opcode, byte seq, byte status);
+void send_done(byte opcode, byte seq, unsigned long result);
+void send_event(byte opcode, byte seq, unsigned int index, unsigned long result);
+
+unsigned long pulse_train(unsigned int freq, unsigned int count, unsigned int bursts, unsigned int burst_interval){
+  // Timed on micros() instead of delay() so that trains of hundreds of Hz keep their frequency
+  // Returns the number of pulses emitted
+  if (freq == 0) return 0;
+  if (bursts == 0) bursts = 1;
+  unsigned long period = 1000000UL / freq;          // us
+  unsigned long high_time = min(period / 2, 10000UL); // us, the DS8R triggers on the rising edge
+  unsigned long emitted = 0;
+  unsigned long burst_start = micros();
+  for (unsigned int b = 0; b < bursts; b++){
+    unsigned long next = micros();
+    for (unsigned int i = 0; i < count; i++){
+      while ((long)(micros() - next) < 0) {}
+      digitalWrite(TRIGGER, HIGH);
+      delayMicroseconds(high_time);
+      digitalWrite(TRIGGER, LOW);
+      emitted++;
+      next += period;
+    }
+    if (b + 1 < bursts){
+      burst_start += (unsigned long)burst_interval * 1000UL;
+      while ((long)(micros() - burst_start) < 0) {}
+    }
+  }
+  return emitted;
+}
+
+bool read_frame(){
+  // Collect the bytes of one frame without blocking. Returns true once a complete frame is in rx_buf
+  while (Serial.available()){
+    byte b = Serial.read();
+    if (!rx_active){
+      if (b == SYNC){
+        rx_active = true;
+        rx_count = 0;
+        rx_start = millis();
+      }
+      continue;
+    }
+    rx_buf[rx_count++] = b;
+    if (rx_buf[0] > MAX_PAYLOAD){
+      rx_active = false;
+      continue;
+    }
+    if (rx_count == rx_buf[0] + 5){
+      rx_active = false;
+      return true;
+    }
+  }
+  return false;
+}
+
+int payload_length(byte opcode){
+  switch (opcode){
+    case OP_TRIGGER_D: return 4;
+    case OP_TRIGGER_N: return 4;
+    case OP_TRAIN: return 8;
+    case OP_START: return 2;
+    case OP_STOP: return 0;
+    case OP_AMP: return 2;
+    case OP_PING: return 0;
+    case OP_SCHED_CLEAR: return 0;
+    case OP_SCHED_ADD: return 8;
+    case OP_SCHED_RUN: return 0;
+    case OP_CHANNEL: return 4;
+    case OP_CHANNEL_TRIGGER_N: return 8;
+    default: return -1;
+  }
+}
+
+unsigned int read_u16(const byte *payload, byte offset){
+  return payload[offset] | ((unsigned int)payload[offset + 1] << 8);
+}
+
+void handle_frame(){
+  byte len = rx_buf[0];
+  byte opcode = rx_buf[1];
+  byte seq = rx_buf[2];
+  const byte *payload = rx_buf + 3;
+  uint16_t crc = rx_buf[3 + len] | ((uint16_t)rx_buf[4 + len] << 8);
+  if (crc != crc16(rx_buf, 3 + len)){
+    send_ack(opcode, seq, STATUS_BAD_CRC);
+    return;
+  }
+  int expected = payload_length(opcode);
+  if (expected < 0){
+    send_ack(opcode, seq, STATUS_UNKNOWN_OPCODE);
+    return;
+  }
+  if (len != expected){
+    send_ack(opcode, seq, STATUS_BAD_LENGTH);
+    return;
+  }
+  if (opcode == OP_SCHED_ADD && schedule_length >= MAX_TRAINS){
+    send_ack(opcode, seq, STATUS_FULL);
+    return;
+  }
+  send_ack(opcode, seq, STATUS_OK);
+
+  unsigned long result = 0;
+  switch (opcode){
+    case OP_TRIGGER_D:
+      tone(TRIGGER, read_u16(payload, 0), read_u16(payload, 2));
+      delay(read_u16(payload, 2));
+      result = (unsigned long)read_u16(payload, 0) * read_u16(payload, 2) / 1000;
+      break;
+    case OP_TRIGGER_N:
+      result = pulse_train(read_u16(payload, 0), read_u16(payload, 2), 1, 0);
+      break;
+    case OP_TRAIN:
+      result = pulse_train(read_u16(payload, 0), read_u16(payload, 2), read_u16(payload, 4), read_u16(payload, 6));
+      break;
+    case OP_START:
+      tone(TRIGGER, read_u16(payload, 0));
+      break;
+    case OP_STOP:
+      noTone(TRIGGER);
+      digitalWrite(TRIGGER, LOW);
+      break;
+    case OP_AMP:
+      dac.setDACOutVoltage(read_u16(payload, 0), 0);
+      break;
+    case OP_PING:
+      result = FIRMWARE_ID;
+      break;
+    case OP_SCHED_CLEAR:
+      schedule_length = 0;
+      break;
+    case OP_SCHED_ADD:
+      schedule[schedule_length].freq = read_u16(payload, 0);
+      schedule[schedule_length].count = read_u16(payload, 2);
+      schedule[schedule_length].interval = read_u16(payload, 4);
+      schedule[schedule_length].dac = read_u16(payload, 6);
+      result = ++schedule_length;
+      break;
+    case OP_SCHED_RUN:
+      result = run_schedule(seq);
+      break;
+    case OP_CHANNEL:
+      set_channel(read_u16(payload, 0), read_u16(payload, 2));
+      result = read_u16(payload, 0);
+      break;
+    case OP_CHANNEL_TRIGGER_N:
+      set_channel(read_u16(payload, 0), read_u16(payload, 2));
+      result = pulse_train(read_u16(payload, 4), read_u16(payload, 6), 1, 0);
+      break;
+  }
+  send_done(opcode, seq, result);
+}
+
+void set_channel(unsigned int channel, unsigned int settle){
+  // D188 in 4TTL mode: binary channel number on pins 10 (D0) to 13 (D3), 0 switches all the channels off.
+  // Waits settle us for the de-bounce delay of the D188 and its switching time before returning
+  if (channel > 8) channel = 0;
+  digitalWrite(pin1, (channel & 1) ? HIGH : LOW);
+  digitalWrite(pin2, (channel & 2) ? HIGH : LOW);
+  digitalWrite(pin3, (channel & 4) ? HIGH : LOW);
+  digitalWrite(pin4, (channel & 8) ? HIGH : LOW);
+  unsigned long start = micros();
+  digitalWrite(pin5, HIGH);
+  delayMicroseconds(STROBE_US);
+  digitalWrite(pin5, LOW);
+  while (micros() - start < settle) {}
+}
+
+unsigned long run_schedule(byte seq){
+  // Trains back to back, timed start to start on millis(). Each train is reported by an EVENT frame.
+  // A STOP frame between two trains aborts the schedule. Returns the number of trains run
+  unsigned long start = millis();
+  for (byte i = 0; i < schedule_length; i++){
+    if (schedule[i].dac != DAC_UNCHANGED){
+      dac.setDACOutVoltage(schedule[i].dac, 0);
+    }
+    unsigned long emitted = pulse_train(schedule[i].freq, schedule[i].count, 1, 0);
+    send_event(OP_SCHED_RUN, seq, i, emitted);
+    if (i + 1 == schedule_length) break;
+    start += schedule[i].interval;
+    do {
+      if (stop_requested()) return i + 1;
+    } while ((long)(millis() - start) < 0);
+  }
+  return schedule_length;
+}
+
+bool stop_requested(){
+  // Frames received while a schedule runs: STOP aborts it, the other commands are refused as busy
+  if (!read_frame()) return false;
+  byte len = rx_buf[0];
+  byte opcode = rx_buf[1];
+  byte seq = rx_buf[2];
+  uint16_t crc = rx_buf[3 + len] | ((uint16_t)rx_buf[4 + len] << 8);
+  if (crc != crc16(rx_buf, 3 + len)){
+    send_ack(opcode, seq, STATUS_BAD_CRC);
+    return false;
+  }
+  if (opcode != OP_STOP){
+    send_ack(opcode, seq, STATUS_BUSY);
+    return false;
+  }
+  send_ack(opcode, seq, STATUS_OK);
+  noTone(TRIGGER);
+  digitalWrite(TRIGGER, LOW);
+  send_done(opcode, seq, 0);
+  return true;
+}
+
+uint16_t crc16(const byte *data, byte n){
+  // CRC-16/CCITT-FALSE
+  uint16_t crc = 0xFFFF;
+  for (byte i = 0; i < n; i++){
+    crc ^= (uint16_t)data[i] << 8;
+    for (byte b = 0; b < 8; b++){
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+void send_frame(byte opcode, byte seq, const byte *payload, byte n){
+  byte buf[3 + MAX_PAYLOAD];
+  buf[0] = n;
+  buf[1] = opcode;
+  buf[2] = seq;
+  for (byte i = 0; i < n; i++){
+    buf[3 + i] = payload[i];
+  }
+  uint16_t crc = crc16(buf, 3 + n);
+  Serial.write(SYNC);
+  Serial.write(buf, 3 + n);
+  Serial.write((byte)(crc & 0xFF));
+  Serial.write((byte)(crc >> 8));
+}
+
+void send_ack(byte opcode, byte seq, byte status){
+  byte payload[2] = {opcode, status};
+  send_frame(OP_ACK, seq, payload, 2);
+}
+
+void send_done(byte opcode, byte seq, unsigned long result){
+  byte payload[5] = {opcode, (byte)(result & 0xFF), (byte)((result >> 8) & 0xFF), (byte)((result >> 16) & 0xFF), (byte)((result >> 24) & 0xFF)};
+  send_frame(OP_DONE, seq, payload, 5);
+}
+
+void send_event(byte opcode, byte seq, unsigned int index, unsigned long result){
+  byte payload[7] = {opcode, (byte)(index & 0xFF), (byte)(index >> 8), (byte)(result & 0xFF), (byte)((result >> 8) & 0xFF), (byte)((result >> 16) & 0xFF), (byte)((result >> 24) & 0xFF)};
+  send_frame(OP_EVENT, seq, payload, 7);
+}
+
+#endif
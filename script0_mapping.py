@@ -4,14 +4,15 @@
 import sys
 from PyQt5.QtWidgets import QMainWindow, QDialog, QApplication
 from PyQt5.uic import loadUi
-import serial
-import time
-from API.ds8r_controller import DS8RController
-from API.d188_controller import D188Controller
+from API.session import get_session
+from API.transport import get_transport
 
-stimulator = DS8RController()
-selector = D188Controller()
+session = get_session()             # One DS8R and one D188 session for the whole process
+stimulator = session.stimulator
+selector = session.selector
+transport = get_transport()         # Trigger board connection shared by the windows of the process
 uC = None # Will take serial instance
+link = None # Framed protocol over uC (API/trigger_protocol.py)
 
 class Mapping_view(QMainWindow):
     def __init__(self):
@@ -72,99 +73,58 @@ class Mapping_view(QMainWindow):
         self.SB_F.setValue(1)
 
     def init_DS8RController(self):
-        stimulator.Initialise()
+        session.Open()
         stimulator.Enable(False)
-        stimulator.Close()  
-        time.sleep(0.1)
 
     def init_selector(self):
-        selector.Initialise()
-        selector.SetMode('USB')
-        selector.SetIndicator('ON')
-        selector.SetDelay(1) # 1ms (can go up to 0.1ms but don't need to here)
-        selector.SetChannel(1)
-        selector.Close()
+        '''
+        The selector session stays open until the window is closed so that channel switches are a single write
+        '''
+        selector.Configure(mode='USB', indicator='ON', delay=1, channel=1) # delay 1ms (can go up to 0.1ms but don't need to here)
 
     def init_uC_comm(self):
         '''
         Establish serial communication with uC
         '''
-        try:
-            # Attempt to open the serial port
-            global uC
-            uC = serial.Serial('COM5', 115200, timeout=1)  # Replace 'COM3' with your port
-            
-            # Allow time for the connection to establish
-            time.sleep(1.5)  
-            
-            # Check if the port is open
-            if uC.is_open:
-                print("Serial port opened successfully.")
-            else:
-                print("Failed to open the serial port.")
-        except serial.SerialException as e:
-            print(f"Serial error: {e}")
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
+        global uC, link
+        if transport.Open():                                                    # Port discovered, ready on the banner of the uC
+            uC, link = transport.uC, transport.link
+            print(f"Serial port {transport.port} opened successfully (ready in {transport.readyTime:.2f} s).")
+        else:
+            print("Failed to open the serial port.")
         
     def update_DS8R(self):
-
-        stimulator.Initialise()
-
-        stimulator.Cmd('mode', self.CB_M.currentText())
-        stimulator.Cmd('polarity', self.CB_POL.currentText())
-        stimulator.Cmd('source', self.CB_S.currentText())
-        stimulator.Cmd('demand', self.SB_PA.value())
-        stimulator.Cmd('pulsewidth', self.SB_PW.value())
-        stimulator.Cmd('dwell', self.SB_IP.value())
-        stimulator.Cmd('recovery', self.SB_RP.value())
-
-        stimulator.Close()
-        time.sleep(0.1)
+        stimulator.Configure(mode=self.CB_M.currentText(),             # Whole parameter set in one device write
+                             polarity=self.CB_POL.currentText(),
+                             source=self.CB_S.currentText(),
+                             demand=self.SB_PA.value(),
+                             pulsewidth=self.SB_PW.value(),
+                             dwell=self.SB_IP.value(),
+                             recovery=self.SB_RP.value())
 
     def on_channel_changed(self, channel_str):
         channel = int(channel_str)
-        selector.Initialise()
         selector.SetChannel(channel)
-        selector.Close()
-        time.sleep(0.2)
 
     def start_stop(self):
         freq = self.SB_F.value()
         if self.trigger == False:
             # Enable the device
-            stimulator.Initialise()
             stimulator.Enable(True)
-            stimulator.Close()                                
-            time.sleep(0.1)
-            command = 'start:' + str(freq) + '\n'
-            uC.write(command.encode())
+            link.Start(freq)
             self.trigger = True
         else:
-            command = 'stop\n'
-            uC.write(command.encode())
+            link.Stop()
             # disable the device
-            stimulator.Initialise()
             stimulator.Enable(False)
-            stimulator.Close()                                
-            time.sleep(0.1)
             self.trigger = False
 
     def close_uC_comm(self):
         if self.trigger == True:
-            command = 'stop\n'
-            uC.write(command.encode())
-        try:     
-            if uC.is_open:
-                uC.close()
-        except serial.SerialException as e:
-            print(f"Serial error: {e}")
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-        stimulator.Close()
-        time.sleep(0.1)
-        selector.Close()
-        time.sleep(0.1)
+            link.Stop()
+        transport.Close()
+        print(f'D188 switch latency [ms]: {selector.SwitchLatency()}')
+        session.Close()
 
     def closeEvent(self, event):
         self.close_uC_comm()  # Call your function before closing
@@ -6,26 +6,35 @@ from PyQt5.QtCore import QObject, QThread, pyqtSignal, QRegExp
 from PyQt5.QtGui import QRegExpValidator
 from PyQt5.uic import loadUi
 import sys
-import serial
 import time
 import csv
 import datetime
-from API.ds8r_controller import DS8RController
-from API.d188_controller import D188Controller
+from API.session import get_session
+from API.scheduler import HardwareScheduler
+from API.transport import get_transport
+from API.trial_timing import TIMING, train_duration, wait_enabled
+from API.trial_pipeline import TrialPipeline
+from script3_psychofunctions import MinThresholdStaircase, MinThresholdPsi, InterleavedStaircase, WidgetResponses, preview_stimulus, preview_stimuli
 
 '''
 The hardware instances are created globally because they need to be accessed by multiple classes in multiple threads.
-This was the best method found so that all hw communications are running correctly. 
-No locks or synchronization mechanisms are required for this specific usage
+The session keeps one DLL session per device open for the whole experiment. The devices and the serial port are owned
+by a single hardware scheduler thread: the GUI and the Worker threads only queue commands to it (stimulator.X(...) and
+selector.X(...) wait for the result), safety disables jump the queue and superseded setter calls are merged.
 '''
-stimulator = DS8RController()
-selector = D188Controller()
+session = get_session()
+scheduler = HardwareScheduler({'DS8R': session.stimulator, 'D188': session.selector})
+stimulator = scheduler.Device('DS8R')
+selector = scheduler.Device('D188')
+transport = get_transport()                             # Trigger board connection, opened once for all the windows
 uC = None                                               # Will take serial instance
+link = None                                             # Framed protocol over uC (API/trigger_protocol.py)
 
 class Experiment_view(QMainWindow):
     '''
     Experiment GUI and functions
     '''
+    CONTROL_SETTINGS = {'channels', 'interleave', 'switchCost', 'procedure', 'pipelined'}     # algo_settings that only control the procedure
     def __init__(self, fixed_param_hw, algo_settings, variable_param, subject_info):
         super(Experiment_view,self).__init__()
 
@@ -59,6 +68,8 @@ class Experiment_view(QMainWindow):
             'comment': None
         }
 
+        stimulator.Open()           # Open the DS8R and D188 sessions once for the whole experiment
+        selector.Open()
         self.init_DS8R_values()     # Set the constant parameters on the DS8R
         self.init_selector()        # Set proper selector modes
         self.init_uC_comm()         # Initialise serial connection to uC
@@ -88,46 +99,33 @@ class Experiment_view(QMainWindow):
         '''
         Establish serial communication with uC
         '''
-        try:
-            # Attempt to open the serial port
-            global uC
-            uC = serial.Serial('COM5', 115200, timeout=1)  # Replace 'COM3' with your port
-            
-            # Allow time for the connection to establish
-            time.sleep(1.5)  
-            
-            # Check if the port is open
-            if uC.is_open:
-                print("Serial port opened successfully.")
-            else:
-                print("Failed to open the serial port.")
-        except serial.SerialException as e:
-            print(f"Serial error: {e}")
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
+        global uC, link
+        if transport.Open():                                                    # Port discovered, ready on the banner of the uC
+            uC, link = transport.uC, transport.link
+            scheduler.Add('uC', link)                                           # Commands go through the scheduler thread
+            print(f"Serial port {transport.port} opened successfully (ready in {transport.readyTime:.2f} s).")
+        else:
+            print("Failed to open the serial port.")
 
     def init_DS8R_values(self):
         '''
         Set the fixed parameters on the DS8R
         '''
-        stimulator.Initialise()
-        stimulator.Enable(False)
-        for parameter in self.fixed_param_hw.keys():
-            if parameter != 'frequency':
-                stimulator.Cmd(parameter, self.fixed_param_hw[parameter])
-        if self.variable_param.keys() != 'frequency':
-            stimulator.Cmd(self.variable_param['variable'], self.variable_param['start'])
-        stimulator.Close()  
-        time.sleep(0.1)
+        def set_fixed_parameters(ds8r):
+            with ds8r.Transaction():                                    # All the parameters are sent in one device write
+                ds8r.Enable(False)
+                for parameter in self.fixed_param_hw.keys():
+                    if parameter != 'frequency':
+                        ds8r.Cmd(parameter, self.fixed_param_hw[parameter])
+                if self.variable_param.keys() != 'frequency':
+                    ds8r.Cmd(self.variable_param['variable'], self.variable_param['start'])
+        scheduler.Call('DS8R', set_fixed_parameters)                    # Runs on the hardware scheduler thread
 
     def init_selector(self):
-        selector.Initialise()
-        selector.SetMode('USB')
-        selector.SetIndicator('ON')
-        selector.SetDelay(1) # 1ms (can go up to 0.1ms but don't need to here)
-        selector.SetChannel(0)
-        selector.Close()
-        time.sleep(0.1)
+        '''
+        The selector session stays open for the whole experiment so that channel switches are a single write
+        '''
+        selector.Configure(mode='USB', indicator='ON', delay=1, channel=0) # delay 1ms (can go up to 0.1ms but don't need to here)
 
     def create_csv(self):
         '''
@@ -181,10 +179,20 @@ class Experiment_view(QMainWindow):
         self.L_LED.hide()
 
         self.exp_count = 0
-        self.minimums_list = []
-        self.channel_idx = 0
-        self.total_channels = len(self.algo_settings['channels'])                   # get total number of channels to be explored
-        self.SetChannelSequence(self.algo_settings['channels'][self.channel_idx])   # Turn on fist channel in the list
+        rule = MinThresholdPsi if self.algo_settings.get('procedure') == 'psi' else MinThresholdStaircase
+        if self.algo_settings.get('interleave'):                                    # One staircase per channel, the channel of each trial chosen by a policy
+            self.engine = InterleavedStaircase(rule, self.variable_param, self.algo_settings,
+                                               self.algo_settings['interleave'], self.algo_settings.get('switchCost', 0))
+        else:
+            self.engine = rule(self.variable_param, self.algo_settings)             # Decides on the stimulations, see script3
+        self.responses = WidgetResponses(self)
+        self.SetChannelSequence(self.engine.channel)                                # Turn on fist channel in the list
+        self.pipeline = None
+        if self.algo_settings.get('pipelined'):                                     # Prepare the next stimulus while the subject answers
+            self.pipeline = TrialPipeline(scheduler, self.variable_param['variable'])
+            self.CB_1.currentTextChanged.connect(self.stage_answer)
+            self.CB_2.currentTextChanged.connect(self.stage_answer)
+            self.SB_3.valueChanged.connect(self.stage_answer)
 
         self.PB_STIMULATE.clicked.connect(self.min_threshold_detection)             # The FSM is triggered when the stimulation button is pressed 
 
@@ -197,92 +205,44 @@ class Experiment_view(QMainWindow):
         for parameter in self.fixed_param_hw.keys():
             self.new_row[parameter] = self.fixed_param_hw[parameter]
         for parameter in self.algo_settings.keys():
-            if parameter != 'channels':
+            if parameter not in self.CONTROL_SETTINGS:                      # Not in the csv header
                 self.new_row[parameter] = self.algo_settings[parameter]
 
     def SetChannelSequence(self, channel):
-        selector.Initialise()
-        selector.SetChannel(channel)   
-        selector.Close()
-        time.sleep(0.1)
+        selector.SetChannel(channel)
 
     def min_threshold_detection(self):
         '''
         Finite State Machine to find the minimum detection threshold
-        This function dynamically decides on the next stimulation point
-        It cahnges the value of "self.stimuli" that will be used in "runLongTask_stimulation()"
+        The staircase engine decides on the next stimulation point from the response to the previous one
+        It changes the value of "self.stimuli" that will be used in "runLongTask_stimulation()"
         '''
-        if self.exp_count == 0:
-            self.count_inv_points = 0
-            self.list_inv_points = []
-            self.stimuli =  self.variable_param['start']
-            self.runLongTask_stimulation()                                          # run stimulation
-
-        elif self.exp_count == 1: 
+        response = None
+        if self.exp_count > 0:
             self.append_csv()                                                       # save entered response of the previous stimulation
-            self.feelSomething_1 = self.CB_1.currentText()                          # During each button press read feedback from stimulation  t-1
-            self.where_1 = self.CB_2.currentText()
-            self.stimuli = self.stimuli +  self.variable_param['step']              # Increment
-            self.runLongTask_stimulation()                                          # run stimulation
+            response = self.responses.GetResponse(self.engine.channel, self.stimuli)
 
-        else:
-            self.append_csv()
-
-            if self.count_inv_points == algo_settings['nbInversionPoints']:                     # Has reached the number of detection points required 
-                print(self.list_inv_points)
-                self.minimums_list.append(self.calculate_avg(self.list_inv_points))             # Calculate avg min point for this channel
-                print(self.minimums_list)
-                if self.channel_idx + 1 < self.total_channels:
-                    self.channel_idx += 1
-                    self.SetChannelSequence(self.algo_settings['channels'][self.channel_idx])   # Turn on next channel in the list
-
-                    self.exp_count = 0                                                          # Re-initialise necessary values for the new channel
-                    self.count_inv_points = 0
-                    self.list_inv_points = []
-                    self.stimuli =  self.variable_param['start']
-                else:                                                                           # Experiment finished, close window
-                    self.close_window()
-            else:
-                self.feelSomething_2 = self.feelSomething_1                                     # Save stimulation feedback from t-2 
-                self.where_2 = self.where_1
-                
-                self.feelSomething_1 = self.CB_1.currentText()                                  # Read stimulation of t-1
-                self.where_1 = self.CB_2.currentText()
-                
-                if self.feelSomething_1 == 'Yes' and self.where_1 == 'Referred area':           # Decide on next stimulation
-                    if self.feelSomething_2 == 'No' or (self.feelSomething_2 == 'Yes' and (self.where_2 == 'Near electrodes' or self.where_2 == 'Both')):
-                        self.count_inv_points += 1
-                        self.list_inv_points.append(self.stimuli)
-                        self.stimuli = self.stimuli -  self.variable_param['step']  # Decrement
-                    else:
-                        self.stimuli = self.stimuli -  self.variable_param['step']  # Decrement
-                elif self.feelSomething_1 == 'No' or (self.feelSomething_1 == 'Yes' and (self.where_1 == 'Near electrodes' or self.where_1 == 'Both')):
-                    if self.feelSomething_2 == 'Yes' and self.where_2 == 'Referred area': 
-                        self.count_inv_points += 1
-                        self.list_inv_points.append(self.stimuli)
-                        self.stimuli = self.stimuli +  self.variable_param['step']      # Increment
-                    else:
-                        self.stimuli = self.stimuli +  self.variable_param['step']      # Increment
-            
-            if self.stimuli < self.variable_param['stop']:     
-                self.runLongTask_stimulation()                                                  # run stimulation if safe
-            else:                                 
+        channel = self.engine.channel
+        done = len(self.engine.results)
+        stimuli = self.engine.next_stimulus(response)
+        if len(self.engine.results) > done:                                          # Channel done
+            if self.engine.results[channel] is None:
                 print('Stopped for this channel because cannot go beyond maximum threshold for safety reasons.')
-                if self.channel_idx + 1 < self.total_channels:
-                    self.channel_idx += 1
-                    self.SetChannelSequence(self.algo_settings['channels'][self.channel_idx])   # Turn on next channel in the list
-
-                    self.exp_count = 0                                                          # Re-initialise necessary values for the new channel
-                    self.count_inv_points = 0
-                    self.list_inv_points = []
-                    self.stimuli =  self.variable_param['start']
-                    self.runLongTask_stimulation()                                                  # run stimulation if safe
-                else:                                                                               # Experiment finished, close window
-                    self.close_window()
-                
-    def calculate_avg(self, list_points):
-        return sum(list_points) / len(list_points)     
-      
+            else:
+                print(self.engine.inversion_points[channel])
+            print(self.engine.results)                                              # Avg min point of each channel
+            if self.pipeline is not None:
+                print(f'Pipelined trials: {self.pipeline.hits} of {self.pipeline.commits} stimuli staged before the answer was committed')
+        if stimuli is None:                                                         # Experiment finished, close window
+            self.close_window()
+            return
+        if self.pipeline is not None:
+            self.pipeline.Commit(self.engine.channel, stimuli)                      # Hit count only, the stimulation sends the channel and value
+        if self.engine.channel != channel or self.pipeline is not None:             # Staged channel: skipped by the shadow copy of the D188
+            self.SetChannelSequence(self.engine.channel)                            # Turn on next channel in the list
+        self.stimuli = stimuli
+        self.runLongTask_stimulation()                                              # run stimulation
+
     def runLongTask_stimulation(self):
         '''
         The stimulation task can take a relatively long time to execute with all the delays, hw communications,...
@@ -328,17 +288,39 @@ class Experiment_view(QMainWindow):
         self.thread.finished.connect(
             lambda: self.increment_counter()
             )
+        self.thread.finished.connect(
+            lambda: self.prepare_next()
+            )
 
     def increment_counter(self):
         self.exp_count += 1
 
+    def prepare_next(self):
+        '''
+        Pipelined mode, once the stimulation is over and the output disabled: compute the next stimulus for every
+        possible answer and stage what they have in common, then the one of the answer already in the widgets
+        '''
+        if self.pipeline is None or self.engine.finished:
+            return
+        self.pipeline.Prepare([(channel, stimuli) for _, channel, stimuli in preview_stimuli(self.engine)])
+        self.stage_answer()
+
+    def stage_answer(self):
+        '''
+        Pipelined mode: stage the next stimulus of the answer entered so far (only between two stimulations)
+        '''
+        if self.pipeline is None or self.exp_count == 0 or self.engine.finished or not self.PB_STIMULATE.isEnabled():
+            return
+        response = self.responses.GetResponse(self.engine.channel, self.stimuli)
+        self.pipeline.Stage(*preview_stimulus(self.engine, response))
+
     def append_csv(self):
         '''
         Adds one row of values to csv
         '''
-        self.new_row['#'] = self.exp_count - 1
+        self.new_row['#'] = self.engine.trial - 1
         self.new_row[self.variable_param['variable']] = self.stimuli
-        self.new_row['currentChannel'] = self.algo_settings['channels'][self.channel_idx]
+        self.new_row['currentChannel'] = self.engine.channel
         self.new_row['feelSomething'] = self.CB_1.currentText()
         self.new_row['where'] = self.CB_2.currentText()
         self.new_row['pain'] = self.SB_3.value()
@@ -362,16 +344,15 @@ class Experiment_view(QMainWindow):
 
     def close_hw_comm(self):
         '''
-        Safely close the serial communication with the uC
-        For the DS8R and D188 they are closed after each usage so it's not needed here
+        Safely close the serial communication with the uC and the hardware session
         '''
-        try:     
-            if uC.is_open:
-                uC.close()
-        except serial.SerialException as e:
-            print(f"Serial error: {e}")
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
+        transport.Close()
+        if session.stimulator.opened:
+            scheduler.EmergencyStop().result()                          # Drop the queued commands and disable the output first
+        print(f'D188 switch latency [ms]: {selector.SwitchLatency()}')
+        if getattr(self, 'pipeline', None) is not None:
+            print(f'Pipelined trials: {self.pipeline.hits} of {self.pipeline.commits} stimuli staged before the answer was committed')
+        session.Close()
     
     def closeEvent(self, event):
         self.close_hw_comm()  
@@ -396,6 +377,7 @@ class Worker(QObject):
         try:
             self.long_stimulate()
         except Exception as e:
+            scheduler.Disable()                                                 # Never leave the output enabled after a failure
             self.error.emit(str(e))
         finally:
             self.finished.emit()
@@ -404,46 +386,44 @@ class Worker(QObject):
         '''
         Set the right parameter, Enable, trigger, disable.
         '''
-        stimulator.Initialise()
-
         if 'frequency' in self.gui_inst.fixed_param_hw.keys():                     
             freq = self.gui_inst.fixed_param_hw['frequency']
         
-        if self.gui_inst.variable_param.keys() != 'frequency':                      # Set variable parameter
-            stimulator.Cmd(self.gui_inst.variable_param['variable'], self.gui_inst.stimuli)
-        else:
+        def set_and_enable(ds8r):
+            with ds8r.Transaction():                                                # Variable parameter and enable in one device write
+                if self.gui_inst.variable_param.keys() != 'frequency':              # Set variable parameter
+                    ds8r.Cmd(self.gui_inst.variable_param['variable'], self.gui_inst.stimuli)
+                ds8r.Enable(True)                                                   # Enable
+            return wait_enabled(ds8r)                                               # DS8R state readback instead of a fixed delay
+        if self.gui_inst.variable_param.keys() == 'frequency':
             freq = self.gui_inst.stimuli
-         
-        stimulator.Enable(True)                                                     # Enable
-        time.sleep(1)
+        if not scheduler.Call('DS8R', set_and_enable):                              # Runs on the hardware scheduler thread, a staged value is not written again
+            raise RuntimeError('The DS8R output could not be enabled')
+        time.sleep(TIMING['enable_settle'])
         
-        self.uC_trigger(freq)                                                       # Trigger as specified 
+        pending = self.uC_trigger(freq)                                             # Trigger as specified 
         
-        if self.gui_inst.new_row['stimuDuration[ms]'] != 0 and self.gui_inst.new_row['numTriggers'] == 0:   # Wait until stimulation finished
-            time.sleep(self.gui_inst.new_row['stimuDuration[ms]'] * 10**-3 + 0.5) 
-        elif self.gui_inst.new_row['stimuDuration[ms]'] == 0 and self.gui_inst.new_row['numTriggers'] != 0:
-            T = 1 / freq + 1    
-            time.sleep(T)
-        time.sleep(0.5)                                                             # margin
+        expected = train_duration(freq, self.gui_inst.new_row['stimuDuration[ms]'], self.gui_inst.new_row['numTriggers'])
+        if pending is None or not pending.Wait('done', expected + TIMING['done_margin']):    # Wait until the uC reports the train done
+            print(f'ERROR! No completion from the trigger board within {expected + TIMING["done_margin"]:.2f} s')
+        time.sleep(TIMING['post_train'])                                            # margin
         
-        stimulator.Enable(False)                                                    # Disable after stimulation finished
-        stimulator.Close()
-        time.sleep(0.1)
+        scheduler.Disable().result()                                                # Disable after stimulation finished, ahead of queued commands
 
     def uC_trigger(self, freq):
         '''
         This function sends a trigger command to the microcontroller
         Args:
             freq (int)
+        Returns:
+            Pending: set once the uC reports the train done, None if no trigger was sent
         '''
         if self.gui_inst.new_row['stimuDuration[ms]'] != 0 and self.gui_inst.new_row['numTriggers'] == 0:
             duration = self.gui_inst.new_row['stimuDuration[ms]']
-            command = 'triggerD:' + str(freq) + ':' + str(duration) + '\n'
-            uC.write(command.encode())
+            return scheduler.Call('uC', 'TriggerD', freq, duration, 'ack', TIMING['ack_timeout'])   # Returns once the uC acknowledged
         elif self.gui_inst.new_row['stimuDuration[ms]'] == 0 and self.gui_inst.new_row['numTriggers'] != 0:
             numTriggers = self.gui_inst.new_row['numTriggers']
-            command = 'triggerN:' + str(freq) + ':' + str(numTriggers) + '\n'
-            uC.write(command.encode())
+            return scheduler.Call('uC', 'TriggerN', freq, numTriggers, 'ack', TIMING['ack_timeout'])   # Returns once the uC acknowledged
 
 
 if __name__ == '__main__':
@@ -473,7 +453,11 @@ if __name__ == '__main__':
         'numTriggers': 0,
         'numRepetition':None,
         'channels': [1,2,3], # set connected channels
-        'nbInversionPoints': 3
+        'nbInversionPoints': 3,
+        'procedure': 'staircase', # 'staircase' or 'psi' (Bayesian adaptive, nbInversionPoints unused)
+        'interleave': None, # None: one channel after another, or 'round_robin', 'random', 'convergence'
+        'switchCost': 0,    # Score lost by a channel switch when interleaved
+        'pipelined': False  # Stage the channel and the variable parameter of the next stimulus while the subject answers
     } 
     variable_param = {
         'variable': 'demand',
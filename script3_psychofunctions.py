@@ -0,0 +1,642 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Psychophysical procedures independent of the GUI: staircase engines and response sources
+import copy
+import math
+import random
+import time
+import numpy as np
+
+'''
+The staircases of script1 (minimum detection threshold) and script2 (maximum threshold based on pain) without
+any widget, CSV or thread: the engine only decides on the next stimulus from the answer to the previous one.
+    engine = MinThresholdStaircase(variable_param, algo_settings)
+    stimulus = engine.next_stimulus()                       # first stimulus of the first channel
+    while stimulus is not None:
+        response = source.GetResponse(engine.channel, stimulus)
+        stimulus = engine.next_stimulus(response)
+    engine.results                                          # {channel: threshold, None if stopped for safety}
+The answers come from a response source: the Qt widgets of the experiment window, a serial response box or a
+simulated observer, so the same procedure runs with a subject or headless.
+'''
+
+# ------------------------------------------------------------------------------
+# Declare response classes
+class Response:
+    '''
+    Answer of the subject to one stimulation, with the values of the experiment window widgets.
+    Args:
+        feelSomething (string): 'Yes' or 'No'
+        where (string): 'Referred area', 'Near electrodes' or 'Both'
+        pain (int): 0 to 10
+    '''
+    __slots__ = ('feelSomething', 'where', 'pain')
+
+    def __init__(self, feelSomething='No', where='Near electrodes', pain=0):
+        self.feelSomething = feelSomething
+        self.where = where
+        self.pain = pain
+
+    def __repr__(self):
+        return f'Response({self.feelSomething}, {self.where}, pain {self.pain})'
+
+
+class ResponseSource:
+    '''
+    Gives the answer to the stimulation just delivered.
+    '''
+    def GetResponse(self, channel, stimulus):
+        raise NotImplementedError
+
+
+class WidgetResponses(ResponseSource):
+    '''
+    Answers entered in the experiment window (CB_1: feel something, CB_2: where, SB_3: pain).
+    '''
+    def __init__(self, window):
+        self.window = window
+
+    def GetResponse(self, channel, stimulus):
+        return Response(self.window.CB_1.currentText(), self.window.CB_2.currentText(), self.window.SB_3.value())
+
+
+class SerialResponses(ResponseSource):
+    '''
+    Answers from a response box on a serial port, one line per answer: <feel>:<where>:<pain>
+    with feel Y or N, where R (referred area), E (near electrodes) or B (both), e.g. "Y:R:3".
+    '''
+    FEEL = {'Y': 'Yes', 'N': 'No'}
+    WHERE = {'R': 'Referred area', 'E': 'Near electrodes', 'B': 'Both'}
+
+    def __init__(self, port):
+        '''
+        Args:
+            port: open serial port (serial.Serial)
+        '''
+        self.port = port
+
+    def GetResponse(self, channel, stimulus):
+        while True:
+            line = self.port.readline().decode(errors='replace').strip()
+            if not line:
+                continue                        # Read timeout, the subject did not answer yet
+            response = self.Parse(line)
+            if response is not None:
+                return response
+            print(f'ERROR! Invalid answer from the response box: {line}')
+
+    def Parse(self, line):
+        fields = line.upper().split(':')
+        if len(fields) != 3 or fields[0] not in self.FEEL or fields[1] not in self.WHERE or not fields[2].isdigit():
+            return None
+        return Response(self.FEEL[fields[0]], self.WHERE[fields[1]], min(int(fields[2]), 10))
+
+
+class SimulatedObserver(ResponseSource):
+    '''
+    Observer whose detection in the referred area follows a logistic psychometric function and whose pain
+    ratings grow with the stimulus.
+    Args:
+        threshold (float or dict): stimulus detected half of the time, per channel if a dict
+        spread (float): slope parameter of the logistic function (stimulus units)
+        lapse (float): probability of a random answer
+        pain_threshold (float or dict): stimulus rated 7 on average, per channel if a dict (None: never painful)
+        pain_noise (float): standard deviation of the ratings
+        seed (int)
+    '''
+    def __init__(self, threshold, spread=0.1, lapse=0.0, pain_threshold=None, pain_noise=1.0, seed=None):
+        self.threshold = threshold
+        self.spread = spread
+        self.lapse = lapse
+        self.pain_threshold = pain_threshold
+        self.pain_noise = pain_noise
+        self.rng = random.Random(seed)
+
+    def Value(self, parameter, channel):
+        return parameter[channel] if isinstance(parameter, dict) else parameter
+
+    def GetResponse(self, channel, stimulus):
+        if self.rng.random() < self.lapse:
+            detected = self.rng.random() < 0.5
+        else:
+            z = (stimulus - self.Value(self.threshold, channel)) / self.spread
+            detected = self.rng.random() < 1 / (1 + math.exp(-max(-50, min(50, z))))
+        pain = 0
+        if self.pain_threshold is not None:
+            z = (stimulus - self.Value(self.pain_threshold, channel)) / self.spread + math.log(7 / 3)
+            expected = 10 / (1 + math.exp(-max(-50, min(50, z))))
+            pain = max(0, min(10, round(self.rng.gauss(expected, self.pain_noise))))
+        if detected:
+            return Response('Yes', 'Referred area', pain)
+        return Response('No', 'Near electrodes', pain)
+
+# ------------------------------------------------------------------------------
+# Declare staircase classes
+class Staircase:
+    '''
+    Up/down staircase run on each channel of algo_settings['channels'] in turn.
+    The first stimulus of a channel is variable_param['start']. After each answer the stimulus moves by
+    variable_param['step']; the stimuli where the direction changes are the inversion points. Once
+    algo_settings['nbInversionPoints'] inversions are found, the answer to the next stimulus is recorded and
+    the threshold of the channel is the mean of the inversion points.
+    Subclasses give the rule (Step) and what happens when the next stimulus is unsafe (Abort).
+    '''
+    STOP_ENDS_EXPERIMENT = False
+    def __init__(self, variable_param, algo_settings):
+        self.start = variable_param['start']
+        self.stop = variable_param['stop']
+        self.step = variable_param['step']
+        self.channels = list(algo_settings['channels'])
+        self.nbInversionPoints = algo_settings.get('nbInversionPoints')
+        self.channel_idx = 0
+        self.results = {}                   # {channel: threshold}, None if the channel was stopped for safety
+        self.inversion_points = {}          # {channel: inversion points}
+        self.history = []                   # (channel, stimulus, response) of every answered stimulation
+        self.finished = not self.channels
+        self.Reset()
+
+    @property
+    def channel(self):
+        '''
+        Channel of the current stimulus (None once finished).
+        '''
+        return None if self.finished else self.channels[self.channel_idx]
+
+    def Reset(self):
+        self.trial = 0                      # Stimuli delivered on the current channel
+        self.stimulus = self.start
+        self.inversions = []
+        self.previous = None                # Answer to the stimulus before the last one, as used by Step
+
+    def NextChannel(self, threshold):
+        self.results[self.channels[self.channel_idx]] = threshold
+        self.inversion_points[self.channels[self.channel_idx]] = self.inversions
+        self.channel_idx += 1
+        if self.channel_idx < len(self.channels):
+            self.Reset()
+        else:
+            self.finished = True
+
+    def next_stimulus(self, response=None):
+        '''
+        Args:
+            response (Response): answer to the previous stimulus, None for the first one
+        Returns:
+            float: next stimulus, on self.channel. None once the procedure is finished
+        '''
+        if self.finished:
+            return None
+        if self.trial > 0:
+            if response is None:
+                raise ValueError('The answer to the previous stimulus is needed')
+            self.history.append((self.channel, self.stimulus, response))
+            if self.Done():
+                self.NextChannel(self.Estimate())
+            else:
+                self.Step(response)
+                if self.Unsafe(self.stimulus):
+                    self.Abort()
+            if self.finished:
+                return None
+        self.trial += 1
+        return self.stimulus
+
+    def Done(self):
+        return len(self.inversions) >= self.nbInversionPoints
+
+    def Remaining(self):
+        '''
+        How far the current channel is from its threshold, used to interleave channels (inversion points still needed).
+        '''
+        return self.nbInversionPoints - len(self.inversions)
+
+    def Estimate(self):
+        return sum(self.inversions) / len(self.inversions)
+
+    def Candidates(self):
+        '''
+        One answer of each kind the rule tells apart, used to look ahead of the subject (preview_stimuli).
+        '''
+        raise NotImplementedError
+
+    def Step(self, response):
+        raise NotImplementedError
+
+    def Unsafe(self, stimulus):
+        raise NotImplementedError
+
+    def Abort(self):
+        raise NotImplementedError
+
+
+class MinThresholdStaircase(Staircase):
+    '''
+    Minimum detection threshold (script1): a stimulus is detected when it is felt in the referred area.
+    Goes up after a miss and down after a detection. Reaching variable_param['stop'] stops the channel.
+    '''
+    def Detected(self, response):
+        return response.feelSomething == 'Yes' and response.where == 'Referred area'
+
+    def Candidates(self):
+        return [Response('Yes', 'Referred area'), Response('No', 'Near electrodes')]
+
+    def Step(self, response):
+        detected = self.Detected(response)
+        if self.trial > 1 and detected != self.previous:
+            self.inversions.append(self.stimulus)
+        self.stimulus += -self.step if (detected and self.trial > 1) else self.step
+        self.previous = detected
+
+    def Unsafe(self, stimulus):
+        return stimulus >= self.stop
+
+    def Abort(self):
+        self.NextChannel(None)
+
+
+class MaxThresholdStaircase(Staircase):
+    '''
+    Maximum threshold based on pain (script2): goes down after a rating above PAIN_THRESHOLD, up otherwise.
+    Only the up to down changes are inversion points. Going beyond variable_param['stop'] ends the experiment.
+    '''
+    PAIN_THRESHOLD = 7
+    STOP_ENDS_EXPERIMENT = True
+
+    def Candidates(self):
+        return [Response(pain=0), Response(pain=self.PAIN_THRESHOLD), Response(pain=10)]
+
+    def Step(self, response):
+        pain = response.pain
+        if self.trial == 1:
+            self.stimulus += self.step if pain < self.PAIN_THRESHOLD else -self.step
+        elif pain > self.PAIN_THRESHOLD:
+            if self.previous < self.PAIN_THRESHOLD:
+                self.inversions.append(self.stimulus)
+            self.stimulus -= self.step
+        else:
+            self.stimulus += self.step
+        self.previous = pain
+
+    def Unsafe(self, stimulus):
+        return stimulus > self.stop
+
+    def Abort(self):
+        self.results[self.channel] = None
+        self.inversion_points[self.channel] = self.inversions
+        self.finished = True
+
+
+class PsiStaircase(Staircase):
+    '''
+    Bayesian adaptive procedure (Psi, Kontsevich & Tyler 1999) with the channel loop of the Staircase engines.
+    A posterior over the threshold and the spread of a logistic psychometric function is kept on a grid; each
+    stimulus is the candidate with the highest expected information gain (lowest expected entropy of the
+    posterior), and a channel is done once the posterior standard deviation of its threshold is below width.
+    The candidates go from variable_param['start'] by variable_param['step'] and never include an unsafe
+    stimulus, so the safety stop of the rule is never crossed. The first stimulus of a channel is 'start'.
+    Subclasses give the binary outcome of an answer and the stop rule (MinThresholdPsi, MaxThresholdPsi).
+    '''
+    def __init__(self, variable_param, algo_settings, lapse=0.02, guess=0.02, width=None, max_trials=40,
+                 thresholds=None, spreads=None):
+        '''
+        Args:
+            variable_param (dict), algo_settings (dict): as for the Staircase engines ('nbInversionPoints' unused)
+            lapse (float): probability of a negative outcome far above threshold
+            guess (float): probability of a positive outcome far below threshold
+            width (float): target posterior standard deviation of the threshold (default: variable_param['step'])
+            max_trials (int): a channel stops there with the current estimate
+            thresholds, spreads (array): grids of the posterior (default: 81 thresholds from 'start' minus 4 steps
+                                         to 'stop', 21 spreads from step / 4 to half the range, log spaced)
+        '''
+        start, stop, step = variable_param['start'], variable_param['stop'], variable_param['step']
+        self.width = step if width is None else width
+        self.max_trials = max_trials
+        self.stop = stop
+        candidates = np.round(start + step * np.arange(int((stop - start) / step + 1e-9) + 1), 9)
+        self.stimuli = np.array([x for x in candidates if not self.Unsafe(x)])
+        self.thresholds = np.linspace(max(0, start - 4 * step), stop, 81) if thresholds is None else np.asarray(thresholds)
+        self.spreads = np.geomspace(step / 4, (stop - start) / 2, 21) if spreads is None else np.asarray(spreads)
+        z = (self.stimuli[:, None, None] - self.thresholds[None, :, None]) / self.spreads[None, None, :]
+        self.likelihood = guess + (1 - guess - lapse) / (1 + np.exp(-np.clip(z, -50, 50)))    # P(positive | stimulus, threshold, spread)
+        super().__init__(variable_param, algo_settings)
+
+    def Reset(self):
+        super().Reset()
+        self.posterior = np.full((self.thresholds.size, self.spreads.size), 1 / (self.thresholds.size * self.spreads.size))
+
+    def Outcome(self, response):
+        raise NotImplementedError
+
+    def Marginal(self):
+        '''
+        Returns:
+            tuple: posterior mean and standard deviation of the threshold
+        '''
+        marginal = self.posterior.sum(axis=1)
+        mean = marginal @ self.thresholds
+        return float(mean), math.sqrt(max(0.0, marginal @ (self.thresholds - mean) ** 2))
+
+    def Done(self):
+        return False                        # Checked right after the update in Step, no extra trial
+
+    def Remaining(self):
+        return self.Marginal()[1] / self.width
+
+    def Estimate(self):
+        return self.Marginal()[0]
+
+    def Step(self, response):
+        index = int(np.argmin(np.abs(self.stimuli - self.stimulus)))
+        p = self.likelihood[index] if self.Outcome(response) else 1 - self.likelihood[index]
+        self.posterior = self.posterior * p
+        self.posterior /= self.posterior.sum()
+        if self.Marginal()[1] <= self.width or self.trial >= self.max_trials:
+            self.NextChannel(self.Estimate())
+            return
+        # Expected entropy of the posterior after each candidate, both outcomes weighted by their predicted probability
+        positive = self.posterior[None] * self.likelihood
+        negative = self.posterior[None] - positive
+        expected = 0
+        for joint in (positive, negative):
+            outcome = joint.sum(axis=(1, 2))
+            conditional = joint / np.maximum(outcome, 1e-300)[:, None, None]
+            entropy = -np.sum(conditional * np.log(np.maximum(conditional, 1e-300)), axis=(1, 2))
+            expected = expected + outcome * entropy
+        self.stimulus = float(self.stimuli[int(np.argmin(expected))])
+
+
+class MinThresholdPsi(PsiStaircase, MinThresholdStaircase):
+    '''
+    Minimum detection threshold with the Psi procedure: positive outcome when felt in the referred area.
+    '''
+    def Outcome(self, response):
+        return self.Detected(response)
+
+
+class MaxThresholdPsi(PsiStaircase, MaxThresholdStaircase):
+    '''
+    Maximum threshold with the Psi procedure: positive outcome for a pain rating above PAIN_THRESHOLD.
+    '''
+    def Outcome(self, response):
+        return response.pain > self.PAIN_THRESHOLD
+
+
+class InterleavedStaircase:
+    '''
+    One independent staircase per channel, the channel of each trial chosen by a policy instead of finishing the
+    channels one after another. Same interface as the Staircase engines (next_stimulus, channel, trial, results,
+    inversion_points, history, finished).
+    Policies, the channel with the highest score is stimulated next:
+        'round_robin': trials since the channel was last stimulated
+        'random': uniform between 0 and 1
+        'convergence': Remaining() of the engine, e.g. inversion points still needed (the furthest from convergence)
+    switch_cost is subtracted from the score of every channel other than the current one, so a switch is only
+    made when it is worth it (in the units of the policy score: trials for round_robin, inversions for convergence).
+    Ties go to the first channel of algo_settings['channels'].
+    '''
+    POLICIES = ('round_robin', 'random', 'convergence')
+
+    def __init__(self, rule, variable_param, algo_settings, policy='round_robin', switch_cost=0.0, seed=None):
+        '''
+        Args:
+            rule: MinThresholdStaircase or MaxThresholdStaircase
+            variable_param (dict), algo_settings (dict): as for the Staircase engines
+            policy (string): 'round_robin', 'random' or 'convergence'
+            switch_cost (float)
+            seed (int): for the random policy
+        '''
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown interleaving policy {policy}, expected one of {self.POLICIES}')
+        self.rule = rule
+        self.policy = policy
+        self.switch_cost = switch_cost
+        self.rng = random.Random(seed)
+        self.channels = list(dict.fromkeys(algo_settings['channels']))
+        self.staircases = {channel: rule(variable_param, dict(algo_settings, channels=[channel])) for channel in self.channels}
+        self.pending = {channel: staircase.next_stimulus() for channel, staircase in self.staircases.items()}
+        self.lastTrial = {channel: -1 for channel in self.channels}
+        self.trials = 0
+        self.switches = 0
+        self.results = {}
+        self.inversion_points = {}
+        self.history = []
+        self.current = None
+        self.finished = not self.channels
+
+    @property
+    def channel(self):
+        return None if self.finished else self.current
+
+    @property
+    def trial(self):
+        '''
+        Stimuli delivered on the current channel.
+        '''
+        return self.staircases[self.current].trial if self.current is not None else 0
+
+    def Candidates(self):
+        return self.staircases[self.current].Candidates()
+
+    def Score(self, channel):
+        if self.policy == 'round_robin':
+            score = self.trials - self.lastTrial[channel]
+        elif self.policy == 'random':
+            score = self.rng.random()
+        else:
+            score = self.staircases[channel].Remaining()
+        if self.current is not None and channel != self.current:
+            score -= self.switch_cost
+        return score
+
+    def next_stimulus(self, response=None):
+        '''
+        Args:
+            response (Response): answer to the previous stimulus, None for the first one
+        Returns:
+            float: next stimulus, on self.channel. None once every channel is finished
+        '''
+        if self.finished:
+            return None
+        if self.current is not None:
+            if response is None:
+                raise ValueError('The answer to the previous stimulus is needed')
+            staircase = self.staircases[self.current]
+            self.pending[self.current] = staircase.next_stimulus(response)
+            self.history.append(staircase.history[-1])
+            if staircase.finished:
+                self.results[self.current] = staircase.results[self.current]
+                self.inversion_points[self.current] = staircase.inversion_points[self.current]
+                if self.results[self.current] is None and self.rule.STOP_ENDS_EXPERIMENT:
+                    self.pending = {}
+        candidates = [channel for channel in self.channels if self.pending.get(channel) is not None]
+        if not candidates:
+            self.finished = True
+            return None
+        channel = max(candidates, key=self.Score)
+        if channel != self.current:
+            self.switches += self.current is not None
+            self.current = channel
+        self.lastTrial[channel] = self.trials
+        self.trials += 1
+        return self.pending[channel]
+
+# ------------------------------------------------------------------------------
+# Headless runs
+def preview_stimulus(engine, response):
+    '''
+    Next stimulus the engine would give for response, without changing the engine.
+    Returns:
+        tuple: (channel, stimulus), stimulus None if the procedure would be finished
+    '''
+    ahead = copy.deepcopy(engine)
+    stimulus = ahead.next_stimulus(response)
+    return ahead.channel, stimulus
+
+def preview_stimuli(engine):
+    '''
+    Next stimulus for each kind of answer to the stimulus just delivered (engine.Candidates()), computed while
+    the subject answers.
+    Returns:
+        list of tuple: (response, channel, stimulus)
+    '''
+    return [(response, *preview_stimulus(engine, response)) for response in engine.Candidates()]
+
+def run_staircase(engine, source):
+    '''
+    Drive an engine with a response source until it is finished.
+    Returns:
+        dict: engine.results
+    '''
+    stimulus = engine.next_stimulus()
+    while stimulus is not None:
+        stimulus = engine.next_stimulus(source.GetResponse(engine.channel, stimulus))
+    return engine.results
+
+
+# ------------------------------------------------------------------------------
+# Monte Carlo simulation of the staircase rules
+def simulate_staircase(rule, variable_param, nbInversionPoints, observers=10000, threshold=2.0, spread=0.1, lapse=0.0,
+                       pain_threshold=None, pain_noise=1.0, seed=None, max_trials=1000):
+    '''
+    Run the rule of a staircase engine on one channel for a population of simulated observers (same observer
+    model as SimulatedObserver). All the observers advance together as arrays, one iteration per trial.
+    Args:
+        rule: MinThresholdStaircase or MaxThresholdStaircase
+        variable_param (dict): 'start', 'stop' and 'step', each a float or an array with one value per observer
+        nbInversionPoints (int)
+        observers (int)
+        threshold, pain_threshold (float or array): per observer if arrays (pain_threshold defaults to threshold)
+        max_trials (int): observers still running after max_trials stimuli are counted as unfinished
+    Returns:
+        dict: 'estimate' (nan if stopped for safety or unfinished), 'trials' (answered stimuli), 'truth' (threshold
+              of the observer the rule converges to), 'stopped' and 'finished', one value per observer
+    '''
+    rng = np.random.default_rng(seed)
+    pain_rule = issubclass(rule, MaxThresholdStaircase)
+    pain_threshold = threshold if pain_threshold is None else pain_threshold
+    full = lambda value: np.broadcast_to(np.asarray(value, dtype=float), (observers,)).copy()
+    step, stop = full(variable_param['step']), full(variable_param['stop'])
+    detection, pain = full(threshold), full(pain_threshold)
+    stimulus = full(variable_param['start'])
+    previous = np.zeros(observers)
+    inversions = np.zeros(observers, dtype=int)
+    inversion_sum = np.zeros(observers)
+    trials = np.zeros(observers, dtype=int)
+    estimate = np.full(observers, np.nan)
+    stopped = np.zeros(observers, dtype=bool)
+    finished = np.zeros(observers, dtype=bool)
+    active = np.arange(observers)
+    for trial in range(1, max_trials + 1):
+        if not active.size:
+            break
+        s = stimulus[active]
+        trials[active] = trial
+        done = inversions[active] >= nbInversionPoints                      # Answer to the extra stimulus recorded, channel done
+        if pain_rule:
+            z = (s - pain[active]) / spread + math.log(7 / 3)
+            expected = 10 / (1 + np.exp(-np.clip(z, -50, 50)))
+            answer = np.clip(np.rint(rng.normal(expected, pain_noise)), 0, 10)
+            down = answer > rule.PAIN_THRESHOLD if trial > 1 else answer >= rule.PAIN_THRESHOLD
+            inversion = down & (previous[active] < rule.PAIN_THRESHOLD) if trial > 1 else np.zeros(s.size, dtype=bool)
+        else:
+            z = (s - detection[active]) / spread
+            answer = rng.random(s.size) < 1 / (1 + np.exp(-np.clip(z, -50, 50)))
+            lapsed = rng.random(s.size) < lapse
+            answer = np.where(lapsed, rng.random(s.size) < 0.5, answer)
+            down = answer & (trial > 1)
+            inversion = (answer != previous[active].astype(bool)) if trial > 1 else np.zeros(s.size, dtype=bool)
+        inversion &= ~done
+        inversion_sum[active] += np.where(inversion, s, 0)
+        inversions[active] += inversion
+        s = np.where(down, s - step[active], s + step[active])
+        stimulus[active] = s
+        previous[active] = answer
+        unsafe = ~done & ((s > stop[active]) if pain_rule else (s >= stop[active]))
+        finished[active[done]] = True
+        stopped[active[unsafe]] = True
+        active = active[~(done | unsafe)]
+    estimate[finished] = inversion_sum[finished] / inversions[finished]
+    return {'estimate': estimate, 'trials': trials, 'truth': pain if pain_rule else detection,
+            'stopped': stopped, 'finished': finished}
+
+def staircase_summary(simulation):
+    '''
+    Returns:
+        dict: 'bias' and 'variance' of the thresholds found, 'rmse', mean and 95th percentile of the trial count,
+              fraction of the observers stopped for safety and unfinished
+    '''
+    finished = simulation['finished']
+    error = simulation['estimate'][finished] - simulation['truth'][finished]
+    trials = simulation['trials']
+    return {
+        'bias': float(error.mean()) if error.size else math.nan,
+        'variance': float(error.var()) if error.size else math.nan,
+        'rmse': float(np.sqrt(np.mean(error ** 2))) if error.size else math.nan,
+        'trials': float(trials.mean()),
+        'trials_p95': float(np.percentile(trials, 95)),
+        'stopped': float(simulation['stopped'].mean()),
+        'unfinished': float(np.mean(~finished & ~simulation['stopped']))
+    }
+
+def sweep_staircase(rule, variable_param, nbInversionPoints, steps, observers=10000, **kwargs):
+    '''
+    Simulate the rule for several step sizes in a single vectorised run (observers per step size).
+    kwargs are passed to simulate_staircase (thresholds given as arrays must have observers values).
+    Returns:
+        dict: {step: staircase_summary}
+    '''
+    steps = list(steps)
+    param = dict(variable_param, step=np.repeat(steps, observers))
+    for key in ('threshold', 'pain_threshold'):
+        if np.ndim(kwargs.get(key)) == 1:
+            kwargs[key] = np.tile(kwargs[key], len(steps))
+    simulation = simulate_staircase(rule, param, nbInversionPoints, observers * len(steps), **kwargs)
+    summaries = {}
+    for index, step in enumerate(steps):
+        part = slice(index * observers, (index + 1) * observers)
+        summaries[step] = staircase_summary({key: value[part] for key, value in simulation.items()})
+    return summaries
+
+
+if __name__ == '__main__':
+    variable_param = {'variable': 'demand', 'start': 1.0, 'stop': 5.0, 'step': 0.25}
+    algo_settings = {'channels': [1, 2, 3], 'nbInversionPoints': 3}
+    thresholds = {1: 2.0, 2: 2.6, 3: 3.1}
+    runs = 2000
+    start = time.perf_counter()
+    trials = 0
+    for seed in range(runs):
+        engine = MinThresholdStaircase(variable_param, algo_settings)
+        run_staircase(engine, SimulatedObserver(thresholds, spread=0.15, seed=seed))
+        trials += len(engine.history)
+    elapsed = time.perf_counter() - start
+    print(f'{runs} simulated experiments, {trials} trials in {elapsed:.2f} s ({trials / elapsed:.0f} trials/s)')
+    print(f'Last run: {engine.results}')
+
+    start = time.perf_counter()
+    population = np.random.default_rng(0).normal(2.5, 0.3, 10000)
+    sweep = sweep_staircase(MinThresholdStaircase, variable_param, algo_settings['nbInversionPoints'], (0.1, 0.25, 0.5),
+                            threshold=population, spread=0.15, lapse=0.02, seed=0)
+    print(f'Step sweep, 10000 observers per step in {time.perf_counter() - start:.2f} s')
+    for step, summary in sweep.items():
+        print(f'step {step}: ' + ', '.join(f'{key} {value:.3f}' for key, value in summary.items()))
@@ -0,0 +1,262 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Batch maximum likelihood fit of psychometric functions to the recorded sessions, with bootstrap confidence intervals
+import csv
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from script3_psychofunctions import MaxThresholdStaircase
+
+'''
+Every channel of every session CSV written by scripts 1 and 2 is one dataset (stimulus, binary outcome per trial).
+All the datasets are fitted together: the log-likelihood is evaluated as arrays over datasets x parameter grid x
+trials, on a coarse grid then on finer grids around the best point. The bootstrap resamples the trials of each
+channel and the replicates are fitted in chunks spread over a process pool.
+    python script4_psychometric_fitting.py recorded_data demand detection
+writes recorded_data/psychometric_fits.csv with one row per session, channel and function.
+'''
+
+FUNCTIONS = ('logistic', 'weibull', 'gaussian')
+GRID = (30, 15)             # Coarse grid (location, spread)
+ZOOM = (3, 11)              # Refinement passes, points per parameter and pass
+BATCH = 256                 # Datasets fitted at once, bounds the memory of the grid evaluation
+BOOT_CHUNK = 100            # Bootstrap replicates per task of the process pool
+OUTPUT = 'psychometric_fits.csv'
+
+# ------------------------------------------------------------------------------
+# Psychometric functions
+def erf(x):
+    '''
+    Vectorised error function (Abramowitz & Stegun 7.1.26, absolute error below 1.5e-7).
+    '''
+    sign = np.sign(x)
+    x = np.abs(x)
+    t = 1 / (1 + 0.3275911 * x)
+    y = 1 - (((((1.061405429 * t - 1.453152027) * t) + 1.421413741) * t - 0.284496736) * t + 0.254829592) * t * np.exp(-x * x)
+    return sign * y
+
+def psychometric(function, x, location, spread):
+    '''
+    Args:
+        function (string): 'logistic', 'weibull' or 'gaussian' (cumulative Gaussian)
+        location: stimulus at 50 % for logistic and gaussian, scale of the Weibull
+        spread: slope parameter (stimulus units), shape of the Weibull
+    Returns:
+        array: F(x) between 0 and 1, broadcast over the arguments
+    '''
+    if function == 'logistic':
+        return 1 / (1 + np.exp(-np.clip((x - location) / spread, -50, 50)))
+    if function == 'gaussian':
+        return 0.5 * (1 + erf((x - location) / (spread * math.sqrt(2))))
+    if function == 'weibull':
+        return 1 - np.exp(-(np.maximum(x, 0) / location) ** spread)
+    raise ValueError(f'Unknown psychometric function {function}, expected one of {FUNCTIONS}')
+
+def threshold_of(function, location, spread):
+    '''
+    Stimulus where F is 0.5.
+    '''
+    if function == 'weibull':
+        return location * math.log(2) ** (1 / spread)
+    return location
+
+# ------------------------------------------------------------------------------
+# Datasets
+def outcome_of(row, outcome):
+    if outcome == 'detection':
+        return row['feelSomething'] == 'Yes' and row['where'] == 'Referred area'
+    if outcome == 'pain':
+        return int(row['pain']) > MaxThresholdStaircase.PAIN_THRESHOLD
+    raise ValueError(f'Unknown outcome {outcome}, expected detection or pain')
+
+def load_sessions(root, variable='demand', outcome='detection'):
+    '''
+    Read every CSV under root with a currentChannel column (sessions of scripts 1 and 2).
+    Args:
+        root (string): file or folder, searched recursively
+        variable (string): column of the stimulus (variable_param['variable'])
+        outcome (string): 'detection' (felt in the referred area) or 'pain' (rating above 7)
+    Returns:
+        list of dict: 'session', 'channel', 'x' and 'y' arrays, one per channel of each session
+    '''
+    paths = [root] if os.path.isfile(root) else sorted(
+        os.path.join(folder, name) for folder, _, names in os.walk(root) for name in names if name.endswith('.csv') and name != OUTPUT)
+    datasets = []
+    for path in paths:
+        with open(path, newline='') as file:
+            reader = csv.DictReader(file)
+            if not reader.fieldnames or not {'currentChannel', variable}.issubset(reader.fieldnames):
+                print(f'ERROR! {path} skipped, no currentChannel or {variable} column')
+                continue
+            channels = {}
+            for row in reader:
+                x, y = channels.setdefault(row['currentChannel'], ([], []))
+                x.append(float(row[variable]))
+                y.append(outcome_of(row, outcome))
+        for channel, (x, y) in channels.items():
+            datasets.append({'session': os.path.relpath(path, root) if os.path.isdir(root) else path,
+                             'channel': channel, 'x': np.array(x), 'y': np.array(y, dtype=float)})
+    return datasets
+
+def pad(datasets):
+    '''
+    The trials of a dataset are grouped in cells (stimulus, outcome) weighted by their count: a staircase only
+    visits a few stimuli, so the arrays are several times shorter than the trial lists.
+    Returns:
+        tuple of arrays (datasets x most cells): stimuli, outcomes and counts (0 for the padding)
+    '''
+    cells = [np.unique(np.column_stack((data['x'], data['y'])), axis=0, return_counts=True) for data in datasets]
+    length = max(len(count) for _, count in cells)
+    x = np.zeros((len(datasets), length))
+    y = np.zeros((len(datasets), length))
+    w = np.zeros((len(datasets), length))
+    for index, (values, count) in enumerate(cells):
+        n = len(count)
+        x[index, :n], y[index, :n], w[index, :n] = values[:, 0], values[:, 1], count
+    return x, y, w
+
+# ------------------------------------------------------------------------------
+# Maximum likelihood
+def log_likelihood(function, x, y, w, location, spread, guess, lapse):
+    '''
+    Args:
+        x, y, w (arrays): datasets x trials
+        location, spread (arrays): datasets x grid points
+    Returns:
+        array: datasets x grid points
+    '''
+    p = guess + (1 - guess - lapse) * psychometric(function, x[:, None, :], location[:, :, None], spread[:, :, None])
+    p = np.where(y[:, None, :] > 0, p, 1 - p)                             # Probability of the observed outcome
+    return np.sum(w[:, None, :] * np.log(np.maximum(p, 1e-12)), axis=2)
+
+def fit_batch(function, x, y, w, guess=0.02, lapse=0.02):
+    '''
+    Fit all the datasets of the padded arrays at once: coarse grid, then ZOOM finer grids around each best point.
+    The location grid spans the stimuli of each dataset, the spread grid is log spaced.
+    Returns:
+        tuple of arrays: location, spread and log-likelihood per dataset
+    '''
+    n = x.shape[0]
+    big = np.where(w > 0, x, -np.inf).max(axis=1)
+    small = np.where(w > 0, x, np.inf).min(axis=1)
+    span = np.maximum(big - small, 1e-6)
+    if function == 'weibull':
+        low, high = np.maximum(small - 0.25 * span, 1e-3 * span), big + 0.5 * span
+        spread_low, spread_high = np.full(n, math.log(0.5)), np.full(n, math.log(20.0))
+    else:
+        low, high = small - 0.25 * span, big + 0.25 * span
+        spread_low, spread_high = np.log(span / 100), np.log(span * 2)
+    points = GRID
+    for _ in range(ZOOM[0] + 1):
+        locations = low[:, None] + (high - low)[:, None] * np.linspace(0, 1, points[0])[None, :]
+        spreads = spread_low[:, None] + (spread_high - spread_low)[:, None] * np.linspace(0, 1, points[1])[None, :]
+        location = np.repeat(locations, points[1], axis=1)
+        spread = np.exp(np.tile(spreads, (1, points[0])))
+        ll = log_likelihood(function, x, y, w, location, spread, guess, lapse)
+        best = np.argmax(ll, axis=1)
+        rows = np.arange(n)
+        best_location, best_spread, best_ll = location[rows, best], np.log(spread[rows, best]), ll[rows, best]
+        step_location = (high - low) / (points[0] - 1)
+        step_spread = (spread_high - spread_low) / (points[1] - 1)
+        low, high = best_location - step_location, best_location + step_location
+        spread_low, spread_high = best_spread - step_spread, best_spread + step_spread
+        points = (ZOOM[1], ZOOM[1])
+    return best_location, np.exp(best_spread), best_ll
+
+def fit_datasets(function, datasets, guess=0.02, lapse=0.02):
+    '''
+    Fit a list of datasets ('x', 'y') in batches of BATCH.
+    Returns:
+        tuple of arrays: location, spread and log-likelihood per dataset
+    '''
+    results = [fit_batch(function, *pad(datasets[start:start + BATCH]), guess, lapse)
+               for start in range(0, len(datasets), BATCH)]
+    return tuple(np.concatenate(values) for values in zip(*results))
+
+def bootstrap_chunk(function, datasets, replicates, seed, guess=0.02, lapse=0.02):
+    '''
+    Fit replicates resamples (trials drawn with replacement) of every dataset. Runs in the process pool.
+    Resampling the trials is drawing the counts of the cells from a multinomial distribution.
+    Returns:
+        array: datasets x replicates thresholds
+    '''
+    rng = np.random.default_rng(seed)
+    x, y, w = pad(datasets)
+    trials = w.sum(axis=1).astype(int)
+    thresholds = np.empty((len(datasets), replicates))
+    for start in range(0, replicates, max(1, BATCH // len(datasets))):
+        count = min(replicates - start, max(1, BATCH // len(datasets)))
+        bw = rng.multinomial(trials, w / trials[:, None], size=(count, len(datasets))).reshape(-1, x.shape[1]).astype(float)
+        bx = np.broadcast_to(x, (count, *x.shape)).reshape(-1, x.shape[1])
+        by = np.broadcast_to(y, (count, *y.shape)).reshape(-1, x.shape[1])
+        location, spread, _ = fit_batch(function, bx, by, bw, guess, lapse)
+        if function == 'weibull':
+            location = location * np.log(2) ** (1 / spread)
+        thresholds[:, start:start + count] = location.reshape(count, len(datasets)).T
+    return thresholds
+
+def fit_archive(datasets, functions=FUNCTIONS, n_boot=1000, workers=None, guess=0.02, lapse=0.02, seed=0):
+    '''
+    Fit every dataset with every function, with percentile bootstrap confidence intervals of the threshold.
+    Args:
+        datasets (list of dict): from load_sessions
+        n_boot (int): bootstrap replicates per dataset (0: no confidence interval)
+        workers (int): processes of the pool (None: one per CPU)
+    Returns:
+        list of dict: results table, one row per dataset and function (empty if there is no dataset)
+    '''
+    rows = []
+    if not datasets:
+        return rows
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for function in functions:
+            location, spread, ll = fit_datasets(function, datasets, guess, lapse)
+            groups = range(0, len(datasets), BATCH)
+            chunks = [[pool.submit(bootstrap_chunk, function, datasets[group:group + BATCH], min(BOOT_CHUNK, n_boot - start),
+                                   seed + group * n_boot + start, guess, lapse) for start in range(0, n_boot, BOOT_CHUNK)]
+                      for group in groups]
+            boot = np.concatenate([np.concatenate([chunk.result() for chunk in group], axis=1) for group in chunks]) if n_boot else None
+            for index, data in enumerate(datasets):
+                ci = np.percentile(boot[index], (2.5, 97.5)) if boot is not None else (math.nan, math.nan)
+                rows.append({
+                    'session': data['session'],
+                    'channel': data['channel'],
+                    'function': function,
+                    'trials': len(data['x']),
+                    'threshold': float(threshold_of(function, location[index], spread[index])),
+                    'ci_low': float(ci[0]),
+                    'ci_high': float(ci[1]),
+                    'location': float(location[index]),
+                    'spread': float(spread[index]),
+                    'logLikelihood': float(ll[index]),
+                })
+    return rows
+
+def write_results(path, rows):
+    with open(path, mode='w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=rows[0].keys())
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    '''
+    python script4_psychometric_fitting.py [root=recorded_data] [variable=demand] [outcome=detection] [n_boot=1000]
+    '''
+    root = sys.argv[1] if len(sys.argv) > 1 else 'recorded_data'
+    variable = sys.argv[2] if len(sys.argv) > 2 else 'demand'
+    outcome = sys.argv[3] if len(sys.argv) > 3 else 'detection'
+    n_boot = int(sys.argv[4]) if len(sys.argv) > 4 else 1000
+    start = time.perf_counter()
+    datasets = load_sessions(root, variable, outcome)
+    if not datasets:
+        print(f'ERROR! No session with a {variable} column found in {root}')
+        sys.exit(1)
+    rows = fit_archive(datasets, n_boot=n_boot)
+    output = os.path.join(root if os.path.isdir(root) else os.path.dirname(root), OUTPUT)
+    write_results(output, rows)
+    print(f'{len(datasets)} channels fitted with {len(FUNCTIONS)} functions and {n_boot} bootstrap replicates '
+          f'in {time.perf_counter() - start:.1f} s, results in {output}')
@@ -0,0 +1,43 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Tests of the DS8R and D188 controllers against the simulated devices
+from API.ds8r_controller import DS8RController
+from API.d188_controller import D188Controller
+from API.simulator import SimulatedDS8R, SimulatedD188
+
+
+def test_ds8r_write_survives_hot_plug():
+    backend = SimulatedDS8R()
+    ds8r = DS8RController(backend)
+    ds8r.Initialise()
+    assert ds8r.Configure(demand=2)
+    backend.Connect()                                           # Device count changes between two writes
+    assert ds8r.Configure(demand=3, pulsewidth=100)
+    assert backend.units[0]['demand'] == 30 and backend.units[0]['width'] == 100
+    assert backend.units[1]['demand'] == 0
+    assert ds8r.Devices() == [8000, 8001]
+    backend.Disconnect()
+    assert ds8r.Configure(demand=4)
+    assert backend.units[0]['demand'] == 40 and ds8r.Devices() == [8000]
+    ds8r.Close()
+
+def test_ds8r_write_to_selected_device_after_hot_plug():
+    backend = SimulatedDS8R(devices=2)
+    ds8r = DS8RController(backend)
+    ds8r.SelectDevice(8001)
+    ds8r.Initialise()
+    assert ds8r.Configure(demand=2)
+    backend.Connect()
+    assert ds8r.Configure(demand=5)
+    assert [unit['demand'] for unit in backend.units] == [0, 50, 0]
+    ds8r.Close()
+
+def test_d188_switch_survives_hot_plug():
+    backend = SimulatedD188()
+    d188 = D188Controller(backend)
+    d188.Initialise()
+    assert d188.Configure(mode='USB', channel=2)
+    backend.Connect()
+    assert d188.Configure(channel=5)
+    assert backend.ActiveChannel() == 5 and backend.ActiveChannel(1) == 0
+    d188.Close()
@@ -0,0 +1,89 @@
+# Author: Mohamed Habib Ben Abda
+# Date: Fall semester 2024
+# Tests of the framed trigger board protocol against the emulated TENS_controller sketch
+import asyncio
+import sys
+import threading
+import pytest
+from API.trigger_protocol import FrameDecoder, encode_command, OP_PING, STATUS_OK, STATUS_BAD_CRC, STATUS_BUSY
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='the virtual board needs a pseudo-terminal')
+
+@pytest.fixture
+def board():
+    from API.virtual_board import VirtualBoard
+    board = VirtualBoard('TENS_controller', boot=False).Start()
+    yield board
+    board.Stop()
+
+@pytest.fixture
+def link(board):
+    from API.transport import TriggerTransport
+    transport = TriggerTransport(board.port)
+    assert transport.Open()
+    yield transport.link
+    transport.Close()
+
+
+def test_decoder_drops_corrupted_frame():
+    frame = encode_command(OP_PING, 1)
+    corrupted = frame[:-1] + bytes((frame[-1] ^ 0xFF,))
+    decoder = FrameDecoder()
+    frames, lines = decoder.Feed(b'init succeed\n' + corrupted + frame[:4])
+    assert frames == [] and lines == ['init succeed'] and decoder.errors == 1
+    frames, lines = decoder.Feed(frame[4:])                        # Frame split over two reads
+    assert [(f.opcode, f.seq) for f in frames] == [(OP_PING, 1)]
+
+def test_ack_and_done(board, link):
+    pending = link.TriggerN(200, 10, wait=None)
+    assert pending.Wait('ack', 1.0) and pending.status == STATUS_OK
+    assert pending.Wait('done', 2.0) and pending.result == 10
+    assert board.Pulses(pending.sent) == 10
+    assert pending.seq not in link.pending
+
+def test_corrupted_crc(link):
+    write = link.port.write
+    link.port.write = lambda frame: write(frame[:-1] + bytes((frame[-1] ^ 0xFF,)))
+    try:
+        pending = link.TriggerN(200, 10, wait=None)
+        assert not pending.Wait('ack', 1.0)
+    finally:
+        link.port.write = write
+    assert pending.ack.is_set() and pending.status == STATUS_BAD_CRC
+    assert not pending.done.is_set()
+    assert pending.seq not in link.pending                      # No DONE follows a rejected command
+    assert link.Ping() == 2
+
+def test_stop_during_train(link):
+    first = threading.Event()
+    link.SchedClear(wait='done')
+    for _ in range(3):
+        link.SchedAdd(100, 5, 500, wait='done')
+    run = link.SchedRun(on_event=lambda index, emitted: first.set(), wait='ack', timeout=1.0)
+    assert run.status == STATUS_OK and first.wait(1.0)
+    busy = link.TriggerN(200, 10, wait=None)
+    assert not busy.Wait('ack', 1.0) and busy.status == STATUS_BUSY
+    assert busy.seq not in link.pending
+    stop = link.Stop(wait='done')
+    assert stop.status == STATUS_OK
+    assert run.Wait('done', 1.0) and run.result == 1
+    assert [index for index, _, _ in run.events] == [0]
+    assert run.seq not in link.pending and stop.seq not in link.pending
+
+def test_async_trigger(board, link):
+    from API.async_devices import AsyncTrigger
+    trigger = AsyncTrigger(link)
+    try:
+        pending = asyncio.run(trigger.TriggerN(200, 10))
+        assert pending.result == 10
+        write = link.port.write
+        link.port.write = lambda frame: write(frame[:-1] + bytes((frame[-1] ^ 0xFF,)))
+        try:
+            with pytest.raises(RuntimeError, match='bad CRC'):
+                asyncio.run(trigger.TriggerN(200, 10))
+        finally:
+            link.port.write = write
+        with pytest.raises(TimeoutError):
+            asyncio.run(trigger.Run('TriggerN', 20, 10, timeout=0.1))
+    finally:
+        trigger.Shutdown()